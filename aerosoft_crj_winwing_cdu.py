@@ -4,10 +4,17 @@ import json
 import struct
 import logging
 import asyncio
+import concurrent.futures
 import websockets.asyncio.client as ws_client
 from typing import Optional, List, Dict, Union, Any
 from SimConnect import SimConnect, Enum
 from SimConnect.Enum import SIMCONNECT_CLIENT_DATA_ID, SIMCONNECT_RECV_ID, SIMCONNECT_RECV_CLIENT_DATA
+from cdu_capture import CaptureWriter, open_capture_from_env
+from cdu_keys import expects_update, parse_key_event
+from cdu_logging import setup_logging
+from cdu_metrics import metrics
+from cdu_profiler import start_control_from_env
+from cdu_watchdog import StreamWatchdog
 
 
 class SimConnectMobiFlight(SimConnect):
@@ -89,6 +96,7 @@ class MobiFlightClient:
         self.websocket_uri: str = websocket_uri
         self.retries: int = 0
         self.max_retries: int = max_retries
+        self.watchdog: Optional[StreamWatchdog] = None
 
     async def run(self) -> None:
         while self.retries < self.max_retries:
@@ -98,9 +106,13 @@ class MobiFlightClient:
                     self.websocket = await ws_client.connect(self.websocket_uri, ping_interval=None)
                     logging.info("MobiFlight connected at %s", self.websocket_uri)
                     self.connected.set()
-                await self.websocket.recv()
+                message = await self.websocket.recv()
+                if self.watchdog is not None and expects_update(parse_key_event(message)):
+                    # a key pressed on the CDU, the page should change soon
+                    self.watchdog.input_seen()
             except Exception as e: 
                 self.retries += 1
+                metrics.count("reconnects")
                 logging.info(f"Failed to connect to {self.websocket_uri}: {e} with retries {self.retries}")
                 self.websocket = None
                 self.connected.clear()
@@ -110,9 +122,15 @@ class MobiFlightClient:
 
 
 
-    async def send(self, data: str) -> None:
+    async def send(self, data: str, queued: float = 0.0, frame: int = 0) -> None:
+        metrics.observe("queue", queued, frame)
         if self.websocket and self.connected.is_set():
+            started = metrics.now()
             await self.websocket.send(data)
+            metrics.observe("send", started, frame)
+            metrics.count("frames_out")
+        else:
+            metrics.count("frames_skipped")
 
     async def close(self) -> None:
         if self.websocket:
@@ -170,45 +188,47 @@ def create_mobi_json(data: bytes) -> str:
 
 
 class CRJCDUClient:
-    def __init__(self, sc_mobiflight: SimConnectMobiFlight, websocket_uri: str, cdu_name: str, cdu_id: int, cdu_definition: int) -> None:
+    def __init__(self, sc_mobiflight: SimConnectMobiFlight, websocket_uri: str, cdu_name: str, cdu_id: int, cdu_definition: int, capture: Optional[CaptureWriter] = None) -> None:
         self.sc_mobiflight: SimConnectMobiFlight = sc_mobiflight
         self.mobiflight: MobiFlightClient = MobiFlightClient(websocket_uri)
         self.event_loop: Optional[asyncio.AbstractEventLoop] = None
         self.cdu_definition: int = cdu_definition
         self.cdu_name: str = cdu_name
         self.cdu_id: int = cdu_id
+        self.client_data_mapped: bool = False
+        self.capture: Optional[CaptureWriter] = capture
+        # sends handed to the event loop and sends finished, each only written by one thread
+        self.sends_queued: int = 0
+        self.sends_done: int = 0
+        self.watchdog: StreamWatchdog = StreamWatchdog(cdu_name, self.resubscribe, self.sim_running)
+        self.mobiflight.watchdog = self.watchdog
 
     def failed_to_connect(self) -> bool:
         return self.mobiflight.retries >= self.mobiflight.max_retries
 
     def setup_simconnect(self) -> bool:
         try:
-            # Map and define the CDU data area
-            self.sc_mobiflight.dll.MapClientDataNameToID(
-                self.sc_mobiflight.hSimConnect, 
-                self.cdu_name.encode(), 
-                self.cdu_id
-            )
-
-            self.sc_mobiflight.dll.AddToClientDataDefinition(
-                self.sc_mobiflight.hSimConnect,
-                self.cdu_definition,
-                0, # offset to start
-                CDU_COLUMNS * CDU_ROWS * ENTRY_BYTE_COUNT, # size client data in bytes
-                0,
-                0
-            )
+            # Map and define the CDU data area only once per SimConnect session,
+            # a second AddToClientDataDefinition would grow the definition
+            if not self.client_data_mapped:
+                self.sc_mobiflight.dll.MapClientDataNameToID(
+                    self.sc_mobiflight.hSimConnect, 
+                    self.cdu_name.encode(), 
+                    self.cdu_id
+                )
+
+                self.sc_mobiflight.dll.AddToClientDataDefinition(
+                    self.sc_mobiflight.hSimConnect,
+                    self.cdu_definition,
+                    0, # offset to start
+                    CDU_COLUMNS * CDU_ROWS * ENTRY_BYTE_COUNT, # size client data in bytes
+                    0,
+                    0
+                )
+                self.client_data_mapped = True
 
             # Request data updates
-            self.sc_mobiflight.dll.RequestClientData(
-                self.sc_mobiflight.hSimConnect,
-                self.cdu_id,
-                self.cdu_id,
-                self.cdu_definition,
-                Enum.SIMCONNECT_CLIENT_DATA_PERIOD.SIMCONNECT_CLIENT_DATA_PERIOD_VISUAL_FRAME,
-                Enum.SIMCONNECT_CLIENT_DATA_REQUEST_FLAG.SIMCONNECT_CLIENT_DATA_REQUEST_FLAG_CHANGED,
-                0, 0, 0
-            )
+            self.request_client_data(Enum.SIMCONNECT_CLIENT_DATA_PERIOD.SIMCONNECT_CLIENT_DATA_PERIOD_VISUAL_FRAME)
 
             # Set up the handler
             self.sc_mobiflight.register_client_data_handler(self.handle_cdu_data)
@@ -217,11 +237,41 @@ class CRJCDUClient:
         except Exception as e:
             logging.error(f"SimConnect setup failed for {self.cdu_name}: {e}")
             return False
+
+    def teardown_simconnect(self) -> None:
+        """Stop the CDU data stream while keeping the SimConnect session open."""
+        try:
+            self.sc_mobiflight.unregister_client_data_handler(self.handle_cdu_data)
+            self.request_client_data(Enum.SIMCONNECT_CLIENT_DATA_PERIOD.SIMCONNECT_CLIENT_DATA_PERIOD_NEVER)
+            logging.info("SimConnect stopped for %s", self.cdu_name)
+        except Exception as e:
+            logging.error(f"SimConnect teardown failed for {self.cdu_name}: {e}")
+
+    def request_client_data(self, period: int) -> None:
+        self.sc_mobiflight.dll.RequestClientData(
+            self.sc_mobiflight.hSimConnect,
+            self.cdu_id,
+            self.cdu_id,
+            self.cdu_definition,
+            period,
+            Enum.SIMCONNECT_CLIENT_DATA_REQUEST_FLAG.SIMCONNECT_CLIENT_DATA_REQUEST_FLAG_CHANGED,
+            0, 0, 0
+        )
+
+    def resubscribe(self) -> None:
+        self.request_client_data(Enum.SIMCONNECT_CLIENT_DATA_PERIOD.SIMCONNECT_CLIENT_DATA_PERIOD_VISUAL_FRAME)
+
+    def sim_running(self) -> bool:
+        return self.sc_mobiflight is not None and self.sc_mobiflight.running and not self.sc_mobiflight.paused
     
 
     def handle_cdu_data(self, client_data: Any) -> None:
         try:
             if client_data.dwDefineID == self.cdu_definition and hasattr(client_data, 'dwData'):                
+                received: float = metrics.now()
+                frame: int = metrics.frame()
+                metrics.count("frames_in")
+                self.watchdog.updated()
                 int_count : int = int(CDU_COLUMNS * CDU_ROWS * ENTRY_BYTE_COUNT / 4)              
                 if len(client_data.dwData) >= int_count:
                     data_list : bytearray = bytearray()                  
@@ -229,10 +279,27 @@ class CRJCDUClient:
                         my_bytes : bytes = struct.pack("I", client_data.dwData[i])
                         data_list.extend(my_bytes)                
                     data: bytes = bytes(data_list)                                       
-                    asyncio.run_coroutine_threadsafe(self.mobiflight.send(create_mobi_json(data)), self.event_loop)
+                    metrics.observe("decode", received, frame)
+                    if self.capture is not None:
+                        self.capture.record(self.cdu_name, data)
+                    encode_started: float = metrics.now()
+                    mobi_json: str = create_mobi_json(data)
+                    metrics.observe("encode", encode_started, frame)
+                    future = asyncio.run_coroutine_threadsafe(self.mobiflight.send(mobi_json, metrics.now(), frame), self.event_loop)
+                    self.sends_queued += 1
+                    future.add_done_callback(self.send_done)
+                metrics.observe("receive", received, frame)
         except Exception as e:
             logging.error(f"Error handling CDU data: {e}")
 
+    def send_done(self, future: concurrent.futures.Future) -> None:
+        self.sends_done += 1
+        if not future.cancelled() and future.exception() is not None:
+            logging.error(f"Sending to MobiFlight failed for {self.cdu_name}: {future.exception()}")
+
+    def pending_sends(self) -> int:
+        return self.sends_queued - self.sends_done
+
 
     async def run(self) -> None:
         self.event_loop = asyncio.get_running_loop()
@@ -248,7 +315,11 @@ class CRJCDUClient:
 
             # Initialize SimConnect
             if self.setup_simconnect():               
-                await asyncio.gather(mobiflight_task)
+                watchdog_task: asyncio.Task = asyncio.create_task(self.watchdog.run())
+                try:
+                    await asyncio.gather(mobiflight_task)
+                finally:
+                    watchdog_task.cancel()
             else:
                 logging.error("Failed to start - SimConnect initialization failed")
         except KeyboardInterrupt:
@@ -260,16 +331,16 @@ class CRJCDUClient:
 
 
 if __name__ == "__main__":
-    logging.basicConfig(
-        level=logging.INFO,
-        format='%(asctime)s - %(levelname)s - %(message)s'
-    )     
+    setup_logging(logging.INFO)
     
     sc_mobiflight: SimConnectMobiFlight = SimConnectMobiFlight()
-    captain_client: CRJCDUClient = CRJCDUClient(sc_mobiflight, CAPTAIN_CDU_URL, CRJ_CDU_0_NAME, CRJ_CDU_0_CLIENT_DATA_ID, CRJ_CDU_0_DEFINITION)
-    co_pilot_client: CRJCDUClient = CRJCDUClient(sc_mobiflight, CO_PILOT_CDU_URL, CRJ_CDU_1_NAME, CRJ_CDU_1_CLIENT_DATA_ID, CRJ_CDU_1_DEFINITION)
+    capture: Optional[CaptureWriter] = open_capture_from_env("crj")
+    captain_client: CRJCDUClient = CRJCDUClient(sc_mobiflight, CAPTAIN_CDU_URL, CRJ_CDU_0_NAME, CRJ_CDU_0_CLIENT_DATA_ID, CRJ_CDU_0_DEFINITION, capture)
+    co_pilot_client: CRJCDUClient = CRJCDUClient(sc_mobiflight, CO_PILOT_CDU_URL, CRJ_CDU_1_NAME, CRJ_CDU_1_CLIENT_DATA_ID, CRJ_CDU_1_DEFINITION, capture)
     
     async def run_clients():
+        await metrics.start_from_env("crj")
+        await start_control_from_env("crj")
         await asyncio.gather(
             captain_client.run(), 
             co_pilot_client.run(),
@@ -283,4 +354,6 @@ if __name__ == "__main__":
     except Exception as e:
         logging.error(f"Error: {e}")
     finally:
+        if capture is not None:
+            capture.close()
         sc_mobiflight.exit()
@@ -0,0 +1,406 @@
+"""
+Benchmarks the CDU encoders of all bridges without a simulator.
+
+For every encoder and input case it reports frames/s, per frame latency
+percentiles, the peak memory allocated while encoding one frame and how often
+the garbage collector's youngest generation ran, as a proxy for allocation
+churn. Windows-only or hardware modules are replaced by stubs when they can't
+be imported, so this runs headless on Linux.
+
+    python cdu_bench.py --output before.json
+    python cdu_bench.py --capture logs/pmdg737-20250601-101500.wwcap --compare before.json
+"""
+import argparse
+import gc
+import json
+import logging
+import platform
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+import types
+from abc import ABC, abstractmethod
+from typing import Callable, Dict, List, Optional, Tuple
+from xml.sax.saxutils import escape
+
+CDU_COLUMNS: int = 24
+CDU_ROWS: int = 14
+CDU_CELLS: int = CDU_COLUMNS * CDU_ROWS
+
+# modules the bridges import that only work on Windows or need hardware
+STUBBED_MODULES = ["SimConnect", "SimConnect.Enum", "pygame", "gql", "gql.transport", "gql.transport.websockets",
+                   "numpy", "bs4"]
+
+
+class StubMeta(type):
+    def __getattr__(cls, name):
+        return cls
+
+
+class Stub(metaclass=StubMeta):
+    """Stands in for any class, constant or function of a stubbed module."""
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __getattr__(self, name):
+        return Stub
+
+    def __call__(self, *args, **kwargs):
+        return Stub()
+
+
+def stub_missing_modules() -> List[str]:
+    stubbed = []
+    for name in STUBBED_MODULES:
+        try:
+            __import__(name)
+        except Exception:
+            module = types.ModuleType(name)
+            module.__getattr__ = lambda attr: Stub
+            sys.modules[name] = module
+            stubbed.append(name)
+    return stubbed
+
+
+# --------- INPUTS -----------
+
+TEXT_CHARS = "ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789/.-+<> "
+
+
+class Inputs(ABC):
+    """Synthetic frames for one encoder: a base page plus single cell and full page variations."""
+
+    @abstractmethod
+    def page(self, rng: random.Random):
+        pass
+
+    @abstractmethod
+    def change_cell(self, frame, rng: random.Random):
+        pass
+
+    def cases(self, frames: int, seed: int = 530) -> Dict[str, List]:
+        rng = random.Random(seed)
+        base = self.page(rng)
+        single = []
+        frame = base
+        for _ in range(frames):
+            frame = self.change_cell(frame, rng)
+            single.append(frame)
+        full = [self.page(rng) for _ in range(min(frames, 256))]
+        return {
+            "static": [base] * frames,
+            "single-cell": single,
+            "full-page": [full[i % len(full)] for i in range(frames)],
+        }
+
+
+class PmdgInputs(Inputs):
+    """Column-major symbol/colour/flags triplets as broadcast by PMDG."""
+
+    def page(self, rng):
+        data = bytearray()
+        for _ in range(CDU_CELLS):
+            data += bytes([ord(rng.choice(TEXT_CHARS)), rng.randrange(6), rng.choice((0, 0, 1, 2))])
+        return bytes(data)
+
+    def change_cell(self, frame, rng):
+        data = bytearray(frame)
+        cell = rng.randrange(CDU_CELLS) * 3
+        data[cell] = ord(rng.choice(TEXT_CHARS))
+        return bytes(data)
+
+
+class CrjInputs(Inputs):
+    """Row-major symbol/format pairs as broadcast by the Aerosoft CRJ."""
+
+    def page(self, rng):
+        data = bytearray()
+        for _ in range(CDU_CELLS):
+            data += bytes([ord(rng.choice(TEXT_CHARS)), rng.randrange(8) | rng.choice((0, 0x80))])
+        return bytes(data)
+
+    def change_cell(self, frame, rng):
+        data = bytearray(frame)
+        data[rng.randrange(CDU_CELLS) * 2] = ord(rng.choice(TEXT_CHARS))
+        return bytes(data)
+
+
+class FenixInputs(Inputs):
+    """Fenix display XML, one element per row with inline colour and size markers."""
+
+    def row(self, rng):
+        text = ""
+        for _ in range(3):
+            text += rng.choice("acgwmy") + rng.choice(("", "s", "l"))
+            text += "".join(rng.choice(TEXT_CHARS.replace(" ", "")) for _ in range(8))
+        return text
+
+    def page(self, rng):
+        return [self.row(rng) for _ in range(CDU_ROWS)]
+
+    def change_cell(self, frame, rng):
+        rows = list(frame)
+        row = rng.randrange(CDU_ROWS)
+        text = list(rows[row])
+        text[-1] = rng.choice("0123456789")
+        rows[row] = "".join(text)
+        return rows
+
+    def cases(self, frames, seed=530):
+        return {case: [self.to_xml(rows) for rows in pages] for case, pages in super().cases(frames, seed).items()}
+
+    def to_xml(self, rows):
+        return "<root>" + "".join(f"<line>{escape(row)}</line>" for row in rows) + "</root>"
+
+
+class FbwInputs(Inputs):
+    """FlyByWire SimBridge page content with colour, size and alignment tags."""
+
+    def segment(self, rng, length=8):
+        text = "".join(rng.choice(TEXT_CHARS) for _ in range(length))
+        colour = rng.choice(("cyan", "green", "white", "amber", "magenta"))
+        return rng.choice((f"{{{colour}}}{text}{{end}}", f"{{small}}{{{colour}}}{text}{{end}}{{end}}", text))
+
+    def page(self, rng):
+        return {
+            "title": self.segment(rng, 12),
+            "titleLeft": "",
+            "page": "{small}1/2{end}",
+            "arrows": [rng.random() < 0.5 for _ in range(4)],
+            "lines": [[self.segment(rng), self.segment(rng), ""] for _ in range(12)],
+            "scratchpad": self.segment(rng, 10),
+        }
+
+    def change_cell(self, frame, rng):
+        content = dict(frame)
+        lines = [list(line) for line in content["lines"]]
+        lines[rng.randrange(12)][rng.randrange(2)] = self.segment(rng)
+        content["lines"] = lines
+        return content
+
+
+class FbwSegmentInputs(FbwInputs):
+    def page(self, rng):
+        return self.segment(rng, 20)
+
+    def change_cell(self, frame, rng):
+        return self.segment(rng, 20)
+
+
+class FslInputs(Inputs):
+    """FSLabs HTTP Value arrays: [ascii, colour, size] per cell, [] for empty cells."""
+
+    def page(self, rng):
+        return [[ord(rng.choice(TEXT_CHARS)), rng.randrange(8), rng.randrange(2)] if rng.random() > 0.2 else []
+                for _ in range(CDU_CELLS)]
+
+    def change_cell(self, frame, rng):
+        cells = list(frame)
+        cells[rng.randrange(CDU_CELLS)] = [ord(rng.choice(TEXT_CHARS)), rng.randrange(8), 0]
+        return cells
+
+
+class Gns530Inputs(Inputs):
+    """GNS530 app simvars, quantized as its MAIN page shows them."""
+
+    def page(self, rng):
+        return {
+            "COM_ACTIVE_FREQUENCY:1": round(rng.uniform(118, 137), 3),
+            "COM_STANDBY_FREQUENCY:1": round(rng.uniform(118, 137), 3),
+            "NAV_ACTIVE_FREQUENCY:1": round(rng.uniform(108, 118), 3),
+            "NAV_STANDBY_FREQUENCY:1": round(rng.uniform(108, 118), 3),
+            "TRANSPONDER CODE:1": rng.randrange(7778),
+            "GPS_GROUND_SPEED": rng.randrange(500),
+            "GPS_GROUND_MAGNETIC_TRACK": rng.randrange(360),
+        }
+
+    def change_cell(self, frame, rng):
+        return {**frame, "GPS_GROUND_SPEED": rng.randrange(500)}
+
+
+# --------- ENCODERS -----------
+
+def load_encoders() -> Dict[str, Tuple[Callable, Inputs, Optional[str]]]:
+    """name -> (encode one frame, synthetic inputs, bridge name used in captures)"""
+    import aerosoft_crj_winwing_cdu
+    import fbw_a32nx_winwing_cdu
+    import fenix_winwing_cdu
+    import fslabs_winwing_cdu
+    import pmdg_737_winwing_cdu
+    import pmdg_777_winwing_cdu
+    import test_winwing_cdu
+
+    gns530_frame = test_winwing_cdu.DisplayFrame()
+    gns530_page = test_winwing_cdu.MainPage(types.SimpleNamespace(fpl=None, scratchpad=""))
+
+    def render_gns530_page(data):
+        # the frame keeps the last page, like the app's, so only changed slots are written
+        gns530_frame.update(*gns530_page.render(data))
+        return gns530_frame.message()
+
+    def parse_fbw_segment(segment):
+        return fbw_a32nx_winwing_cdu.parse_fbw_segment(segment, False)
+
+    return {
+        "fenix.create_mobi_json": (fenix_winwing_cdu.create_mobi_json, FenixInputs(), "fenix"),
+        "fbw.create_mobi_json": (fbw_a32nx_winwing_cdu.create_mobi_json, FbwInputs(), "fbw"),
+        "fbw.parse_fbw_segment": (parse_fbw_segment, FbwSegmentInputs(), None),
+        "fslabs.parse_fsl_mcdu": (fslabs_winwing_cdu.parse_fsl_mcdu, FslInputs(), "fslabs"),
+        "pmdg737.create_mobi_json": (pmdg_737_winwing_cdu.create_mobi_json, PmdgInputs(), "pmdg737"),
+        "pmdg777.create_mobi_json": (pmdg_777_winwing_cdu.create_mobi_json, PmdgInputs(), "pmdg777"),
+        "crj.create_mobi_json": (aerosoft_crj_winwing_cdu.create_mobi_json, CrjInputs(), "crj"),
+        "gns530.render": (render_gns530_page, Gns530Inputs(), None),
+    }
+
+
+def recorded_frames(path: str, frames: int) -> Tuple[str, List]:
+    """Turns the records of a capture into encoder inputs, returns the bridge name and the frames."""
+    from cdu_capture import CaptureReader
+    reader = CaptureReader(path)
+    inputs = []
+    for record in reader:
+        payload = record.payload
+        if reader.bridge == "fbw":
+            if not payload.startswith("update:"):
+                continue
+            data = json.loads(payload[payload.index(":") + 1:])
+            inputs += [data[side] for side in ("left", "right") if data.get(side)]
+        else:
+            inputs.append(payload)
+        if len(inputs) >= frames:
+            break
+    reader.close()
+    return reader.bridge, inputs
+
+
+# --------- MEASUREMENT -----------
+
+def percentile(sorted_values: List[int], fraction: float) -> float:
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def measure(encode: Callable, frames: List, warmup: int = 50, alloc_frames: int = 200) -> Dict:
+    for frame in frames[:warmup]:
+        encode(frame)
+
+    timings = []
+    gen0_before = gc.get_stats()[0]["collections"]
+    clock = time.perf_counter_ns
+    started = clock()
+    for frame in frames:
+        frame_started = clock()
+        encode(frame)
+        timings.append(clock() - frame_started)
+    elapsed = clock() - started
+    gen0 = gc.get_stats()[0]["collections"] - gen0_before
+
+    # separate pass, tracemalloc slows everything down
+    tracemalloc.start()
+    peaks = []
+    for frame in frames[:alloc_frames]:
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        encode(frame)
+        peaks.append(tracemalloc.get_traced_memory()[1] - current)
+    tracemalloc.stop()
+
+    timings.sort()
+    return {
+        "frames": len(frames),
+        "fps": round(len(frames) / (elapsed / 1e9), 1),
+        "p50_us": round(percentile(timings, 0.50) / 1000, 2),
+        "p90_us": round(percentile(timings, 0.90) / 1000, 2),
+        "p99_us": round(percentile(timings, 0.99) / 1000, 2),
+        "max_us": round(timings[-1] / 1000, 2),
+        "alloc_peak_bytes": int(sum(peaks) / len(peaks)),
+        "gc_gen0_per_1k_frames": round(gen0 * 1000 / len(frames), 2),
+    }
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def run(frames: int, captures: List[str], only: Optional[List[str]] = None) -> Dict:
+    stubbed = stub_missing_modules()
+    encoders = load_encoders()
+    recorded: Dict[str, List[List]] = {}
+    for path in captures:
+        bridge, inputs = recorded_frames(path, frames)
+        recorded.setdefault(bridge, []).append(inputs)
+
+    results = []
+    for name, (encode, inputs, bridge) in encoders.items():
+        if only and not any(part in name for part in only):
+            continue
+        cases = inputs.cases(frames)
+        for i, recorded_inputs in enumerate(recorded.get(bridge, [])):
+            if recorded_inputs:
+                cases[f"recorded-{i}"] = recorded_inputs
+        for case, case_frames in cases.items():
+            result = {"encoder": name, "case": case, **measure(encode, case_frames)}
+            logging.info("%-28s %-12s %9.1f fps  p50 %7.2f us  p99 %7.2f us  %7d B/frame",
+                         name, case, result["fps"], result["p50_us"], result["p99_us"], result["alloc_peak_bytes"])
+            results.append(result)
+
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "revision": git_revision(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "stubbed_modules": stubbed,
+        },
+        "results": results,
+    }
+
+
+def compare(report: Dict, baseline: Dict) -> None:
+    """Prints the change of every metric against an earlier report."""
+    old = {(r["encoder"], r["case"]): r for r in baseline["results"]}
+    print(f"{'encoder':28} {'case':12} {'fps':>18} {'p99 us':>18} {'B/frame':>18}")
+    for result in report["results"]:
+        before = old.get((result["encoder"], result["case"]))
+        if before is None:
+            continue
+        columns = []
+        for key in ("fps", "p99_us", "alloc_peak_bytes"):
+            change = (result[key] - before[key]) / before[key] * 100 if before[key] else 0.0
+            columns.append(f"{result[key]:>10} {change:+6.1f}%")
+        print(f"{result['encoder']:28} {result['case']:12} " + " ".join(columns))
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark the CDU encoders of all bridges")
+    parser.add_argument("--frames", type=int, default=2000, help="frames per encoder and case")
+    parser.add_argument("--capture", action="append", default=[], help="add the frames of a capture file")
+    parser.add_argument("--only", action="append", help="only run encoders whose name contains this")
+    parser.add_argument("--output", help="write the JSON report to this file")
+    parser.add_argument("--compare", help="JSON report of an earlier run to compare against")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s - %(levelname)s - %(message)s"
+    )
+    args = parse_args()
+    report = run(args.frames, args.capture, args.only)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    if args.compare:
+        with open(args.compare) as file:
+            compare(report, json.load(file))
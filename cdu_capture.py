@@ -0,0 +1,490 @@
+"""
+Recording and replay of the raw CDU data the bridges receive from the sim.
+
+A capture file starts with a header, followed by one record per received frame
+and, once the file is closed, an index for seeking by time:
+
+    header  "<8sHqH" magic, version, wall clock start (ns), bridge name length + name
+    record  "<qBBI"  time since start (ns), kind, channel, payload length + payload
+    index   "<I"     entry count + "<qQ" (time, file offset) per entry,
+            "<I"     channel count + "<BH" (channel, name length) + name per channel
+    trailer "<Q8s"   index offset, index magic
+
+Channels are declared with a KIND_CHANNEL record the first time they are used.
+A file without trailer (bridge killed) can still be read, the index is then
+rebuilt by scanning.
+
+Recording is switched on by pointing WINWING_CDU_RECORD at a directory.
+
+'replay --feed-log' writes one line per display frame the bridge sends, with
+the endpoint, the SHA-1 of the frame and the wall clock time its source record
+was fed in; mobiflight_standin.py joins it with the arrival times.
+"""
+import argparse
+import asyncio
+import bisect
+import hashlib
+import json
+import logging
+import os
+import struct
+import threading
+import time
+from abc import ABC, abstractmethod
+from array import array
+from types import SimpleNamespace
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple, Union
+from urllib.parse import urlsplit
+
+MAGIC: bytes = b"WWCDUCAP"
+INDEX_MAGIC: bytes = b"WWCDUIDX"
+VERSION: int = 1
+
+HEADER = struct.Struct("<8sHqH")
+RECORD = struct.Struct("<qBBI")
+INDEX_COUNT = struct.Struct("<I")
+INDEX_ENTRY = struct.Struct("<qQ")
+INDEX_CHANNEL = struct.Struct("<BH")
+TRAILER = struct.Struct("<Q8s")
+
+KIND_CHANNEL: int = 0
+KIND_BYTES: int = 1
+KIND_TEXT: int = 2
+KIND_JSON: int = 3
+
+# One index entry every INDEX_INTERVAL records
+INDEX_INTERVAL: int = 64
+FLUSH_INTERVAL: float = 1.0
+
+RECORD_ENV: str = "WINWING_CDU_RECORD"
+
+Payload = Union[bytes, str, list, dict]
+
+
+class Record(NamedTuple):
+    t_ns: int
+    channel: str
+    payload: Payload
+
+
+class CaptureWriter:
+    """Appends timestamped records, safe to call from the SimConnect dispatch thread."""
+
+    def __init__(self, path: str, bridge: str) -> None:
+        self.path: str = path
+        self.bridge: str = bridge
+        self.lock = threading.Lock()
+        self.file = open(path, "wb")
+        self.started_ns: int = time.perf_counter_ns()
+        self.channels: Dict[str, int] = {}
+        self.index: List[Tuple[int, int]] = []
+        self.records: int = 0
+        self.last_flush: float = time.monotonic()
+        name = bridge.encode()
+        self.file.write(HEADER.pack(MAGIC, VERSION, time.time_ns(), len(name)) + name)
+
+    def record(self, channel: str, payload: Payload) -> None:
+        if isinstance(payload, (bytes, bytearray, memoryview)):
+            kind, data = KIND_BYTES, bytes(payload)
+        elif isinstance(payload, str):
+            kind, data = KIND_TEXT, payload.encode()
+        else:
+            kind, data = KIND_JSON, json.dumps(payload, separators=(",", ":")).encode()
+        t_ns = time.perf_counter_ns() - self.started_ns
+        with self.lock:
+            if self.file is None:
+                return
+            channel_id = self.channels.get(channel)
+            if channel_id is None:
+                channel_id = self.channels[channel] = len(self.channels)
+                name = channel.encode()
+                self.file.write(RECORD.pack(t_ns, KIND_CHANNEL, channel_id, len(name)) + name)
+            if self.records % INDEX_INTERVAL == 0:
+                self.index.append((t_ns, self.file.tell()))
+            self.file.write(RECORD.pack(t_ns, kind, channel_id, len(data)))
+            self.file.write(data)
+            self.records += 1
+            if time.monotonic() - self.last_flush > FLUSH_INTERVAL:
+                self.file.flush()
+                self.last_flush = time.monotonic()
+
+    def close(self) -> None:
+        with self.lock:
+            if self.file is None:
+                return
+            index_offset = self.file.tell()
+            self.file.write(INDEX_COUNT.pack(len(self.index)))
+            for entry in self.index:
+                self.file.write(INDEX_ENTRY.pack(*entry))
+            self.file.write(INDEX_COUNT.pack(len(self.channels)))
+            for channel, channel_id in self.channels.items():
+                name = channel.encode()
+                self.file.write(INDEX_CHANNEL.pack(channel_id, len(name)) + name)
+            self.file.write(TRAILER.pack(index_offset, INDEX_MAGIC))
+            self.file.close()
+            self.file = None
+        logging.info("Capture closed: %s (%d records)", self.path, self.records)
+
+
+def open_capture_from_env(bridge: str) -> Optional[CaptureWriter]:
+    """Start a capture in the directory named by WINWING_CDU_RECORD, if set."""
+    directory = os.environ.get(RECORD_ENV)
+    if not directory:
+        return None
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{bridge}-{time.strftime('%Y%m%d-%H%M%S')}.wwcap")
+    logging.info("Recording raw %s frames to %s", bridge, path)
+    return CaptureWriter(path, bridge)
+
+
+class CaptureReader:
+    def __init__(self, path: str) -> None:
+        self.path: str = path
+        self.file = open(path, "rb")
+        magic, version, self.wall_start_ns, name_length = HEADER.unpack(self.file.read(HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a CDU capture file")
+        self.bridge: str = self.file.read(name_length).decode()
+        self.data_start: int = self.file.tell()
+        self.channels: Dict[int, str] = {}
+        self.data_end, self.index = self.read_index()
+
+    def read_index(self) -> Tuple[int, List[Tuple[int, int]]]:
+        size = os.fstat(self.file.fileno()).st_size
+        if size - self.data_start >= TRAILER.size:
+            self.file.seek(size - TRAILER.size)
+            index_offset, magic = TRAILER.unpack(self.file.read(TRAILER.size))
+            if magic == INDEX_MAGIC:
+                self.file.seek(index_offset)
+                (count,) = INDEX_COUNT.unpack(self.file.read(INDEX_COUNT.size))
+                entries = [INDEX_ENTRY.unpack(self.file.read(INDEX_ENTRY.size)) for _ in range(count)]
+                (count,) = INDEX_COUNT.unpack(self.file.read(INDEX_COUNT.size))
+                for _ in range(count):
+                    channel_id, length = INDEX_CHANNEL.unpack(self.file.read(INDEX_CHANNEL.size))
+                    self.channels[channel_id] = self.file.read(length).decode()
+                return index_offset, entries
+        # no trailer, the writer did not close the file, so scan it
+        logging.info("Capture %s has no index, scanning", self.path)
+        entries = []
+        records = 0
+        self.file.seek(self.data_start)
+        while True:
+            offset = self.file.tell()
+            head = self.file.read(RECORD.size)
+            if len(head) < RECORD.size:
+                break
+            t_ns, kind, channel_id, length = RECORD.unpack(head)
+            data = self.file.read(length)
+            if len(data) < length:
+                break
+            if kind == KIND_CHANNEL:
+                self.channels[channel_id] = data.decode()
+            else:
+                if records % INDEX_INTERVAL == 0:
+                    entries.append((t_ns, offset))
+                records += 1
+        return offset, entries
+
+    def records(self, start_ns: int = 0) -> Iterator[Record]:
+        """Yields the records at or after start_ns, seeking via the index."""
+        offset = self.data_start
+        position = bisect.bisect_right(self.index, (start_ns, float("inf"))) - 1
+        if position >= 0:
+            offset = self.index[position][1]
+        self.file.seek(offset)
+        while self.file.tell() < self.data_end:
+            head = self.file.read(RECORD.size)
+            if len(head) < RECORD.size:
+                return
+            t_ns, kind, channel_id, length = RECORD.unpack(head)
+            data = self.file.read(length)
+            if len(data) < length:
+                return
+            if kind == KIND_CHANNEL:
+                self.channels[channel_id] = data.decode()
+                continue
+            if t_ns < start_ns:
+                continue
+            if kind == KIND_TEXT:
+                payload = data.decode()
+            elif kind == KIND_JSON:
+                payload = json.loads(data)
+            else:
+                payload = data
+            yield Record(t_ns, self.channels.get(channel_id, str(channel_id)), payload)
+
+    def __iter__(self) -> Iterator[Record]:
+        return self.records()
+
+    def close(self) -> None:
+        self.file.close()
+
+
+# --------- REPLAY -----------
+
+def rewrite_host(uri: str, host: Optional[str]) -> str:
+    if not host:
+        return uri
+    scheme, rest = uri.split("://", 1)
+    return f"{scheme}://{host}/{rest.split('/', 1)[1]}"
+
+
+class FeedLog:
+    """Logs the frames a replayed bridge sends, stamped with the time their source record was fed."""
+
+    def __init__(self, path: str) -> None:
+        self.file = open(path, "w")
+        self.fed_ns: int = 0
+
+    def write(self, uri: str, message: str) -> None:
+        digest = hashlib.sha1(message.encode()).hexdigest()
+        self.file.write(json.dumps({"endpoint": urlsplit(uri).path, "sha1": digest, "t_ns": self.fed_ns}) + "\n")
+
+    def trace(self, client, method: str, uri: str) -> None:
+        """Wraps an async send method, logging at call time so queued sends keep their feed time."""
+        send = getattr(client, method)
+
+        def traced_send(message, *args, **kwargs):
+            self.write(uri, message)
+            return send(message, *args, **kwargs)
+
+        setattr(client, method, traced_send)
+
+    def close(self) -> None:
+        self.file.close()
+
+
+class ReplayTarget(ABC):
+    """Runs one bridge's own decode/encode/send code for replayed records."""
+
+    def __init__(self, host: Optional[str]) -> None:
+        self.host: Optional[str] = host
+        self.tasks: List[asyncio.Task] = []
+        self.feed_log: Optional[FeedLog] = None
+
+    def trace(self, client, method: str, uri: str) -> None:
+        if self.feed_log is not None:
+            self.feed_log.trace(client, method, uri)
+
+    @abstractmethod
+    async def start(self) -> None:
+        pass
+
+    @abstractmethod
+    async def feed(self, record: Record) -> None:
+        pass
+
+    async def wait_connected(self, clients, timeout: float = 10.0) -> None:
+        try:
+            await asyncio.wait_for(asyncio.gather(*(c.connected.wait() for c in clients)), timeout)
+        except asyncio.TimeoutError:
+            logging.warning("Not all MobiFlight displays connected, replaying anyway")
+
+    async def stop(self) -> None:
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+
+class ClientDataReplay(ReplayTarget):
+    """PMDG and CRJ: records are the client data bytes, keyed by client data area name."""
+
+    def __init__(self, host, client_class, cdus) -> None:
+        super().__init__(host)
+        self.clients = {
+            name: client_class(None, rewrite_host(uri, host), name, cdu_id, definition)
+            for uri, name, cdu_id, definition in cdus
+        }
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        for client in self.clients.values():
+            client.event_loop = loop
+            self.trace(client.mobiflight, "send", client.mobiflight.websocket_uri)
+            self.tasks.append(asyncio.create_task(client.mobiflight.run()))
+        await self.wait_connected([c.mobiflight for c in self.clients.values()])
+
+    async def stop(self):
+        await super().stop()
+        for client in self.clients.values():
+            await client.mobiflight.close()
+
+    async def feed(self, record):
+        client = self.clients.get(record.channel)
+        if client is not None:
+            # same shape as SIMCONNECT_RECV_CLIENT_DATA, dwData is an array of DWORDs
+            client.handle_cdu_data(SimpleNamespace(dwDefineID=client.cdu_definition, dwData=array("I", record.payload)))
+
+
+def pmdg_replay(host, module) -> ClientDataReplay:
+    cdus = [(module.CAPTAIN_CDU_URL, module.PMDG_CDU_0_NAME, module.PMDG_CDU_0_ID, module.PMDG_CDU_0_DEFINITION),
+            (module.CO_PILOT_CDU_URL, module.PMDG_CDU_1_NAME, module.PMDG_CDU_1_ID, module.PMDG_CDU_1_DEFINITION)]
+    if hasattr(module, "PMDG_CDU_2_NAME"):
+        cdus.append((module.OBSERVER_CDU_URL, module.PMDG_CDU_2_NAME, module.PMDG_CDU_2_ID, module.PMDG_CDU_2_DEFINITION))
+    return ClientDataReplay(host, module.PMDGCDUClient, cdus)
+
+
+class FbwReplay(ReplayTarget):
+    async def start(self):
+        import fbw_a32nx_winwing_cdu as fbw
+        left = fbw.MobiFlightClient(rewrite_host(fbw.CAPTAIN_CDU_URL, self.host))
+        right = fbw.MobiFlightClient(rewrite_host(fbw.CO_PILOT_CDU_URL, self.host))
+        for mobiflight in (left, right):
+            self.trace(mobiflight, "send", mobiflight.websocket_uri)
+        self.tasks += [asyncio.create_task(left.run()), asyncio.create_task(right.run())]
+        self.client = fbw.FbwMcduClient(left, right)
+        await self.wait_connected([left, right])
+
+    async def stop(self):
+        await super().stop()
+        for mobiflight in self.client.mobiflight.values():
+            await mobiflight.close()
+
+    async def feed(self, record):
+        await self.client.handle_message(record.payload)
+
+
+class FenixReplay(ReplayTarget):
+    async def start(self):
+        import fenix_winwing_cdu as fenix
+        self.fenix = fenix
+        self.mobi_clients = [
+            fenix.Mobiflight_Client(rewrite_host("ws://localhost:8320/winwing/cdu-captain", self.host), "CDU-CAPTAIN"),
+            fenix.Mobiflight_Client(rewrite_host("ws://localhost:8320/winwing/cdu-co-pilot", self.host), "CDU-CO-PILOT"),
+        ]
+        for client in self.mobi_clients:
+            self.trace(client, "send_json_data", client.uri)
+        self.tasks += [asyncio.create_task(c.run_mobiflight_websocket_client()) for c in self.mobi_clients]
+        # Mobiflight_Client has no connected event, give it a moment
+        for _ in range(100):
+            if all(c.websocket_connection is not None for c in self.mobi_clients):
+                break
+            await asyncio.sleep(0.05)
+
+    async def stop(self):
+        await super().stop()
+        for client in self.mobi_clients:
+            if client.websocket_connection is not None:
+                await client.websocket_connection.close()
+
+    async def feed(self, record):
+        await self.fenix.handle_dataref(record.channel, record.payload, *self.mobi_clients)
+
+
+class FslabsReplay(ReplayTarget):
+    async def start(self):
+        import fslabs_winwing_cdu as fslabs
+        self.fslabs = fslabs
+        self.last_fetched_data = None
+        fslabs.MOBIFLIGHT_WS_URI = rewrite_host(fslabs.MOBIFLIGHT_WS_URI, self.host)
+        self.tasks += [asyncio.create_task(fslabs.run_mobiflight_websocket_client()),
+                       asyncio.create_task(fslabs.run_fsl_http_client())]
+        for _ in range(100):
+            if fslabs.mobi_websocket_connection is not None:
+                break
+            await asyncio.sleep(0.05)
+
+    async def stop(self):
+        await super().stop()
+        if self.fslabs.mobi_websocket_connection is not None:
+            await self.fslabs.mobi_websocket_connection.close()
+
+    async def feed(self, record):
+        parsed_data = await self.fslabs.handle_fsl_value(record.payload, self.last_fetched_data)
+        # sent from the queue later, log it now so the queueing counts towards the latency
+        if self.feed_log is not None and parsed_data != self.last_fetched_data:
+            self.feed_log.write(self.fslabs.MOBIFLIGHT_WS_URI, parsed_data)
+        self.last_fetched_data = parsed_data
+
+
+def create_replay_target(bridge: str, host: Optional[str]) -> ReplayTarget:
+    if bridge == "pmdg737":
+        import pmdg_737_winwing_cdu
+        return pmdg_replay(host, pmdg_737_winwing_cdu)
+    if bridge == "pmdg777":
+        import pmdg_777_winwing_cdu
+        return pmdg_replay(host, pmdg_777_winwing_cdu)
+    if bridge == "crj":
+        import aerosoft_crj_winwing_cdu as crj
+        return ClientDataReplay(host, crj.CRJCDUClient, [
+            (crj.CAPTAIN_CDU_URL, crj.CRJ_CDU_0_NAME, crj.CRJ_CDU_0_CLIENT_DATA_ID, crj.CRJ_CDU_0_DEFINITION),
+            (crj.CO_PILOT_CDU_URL, crj.CRJ_CDU_1_NAME, crj.CRJ_CDU_1_CLIENT_DATA_ID, crj.CRJ_CDU_1_DEFINITION),
+        ])
+    if bridge == "fbw":
+        return FbwReplay(host)
+    if bridge == "fenix":
+        return FenixReplay(host)
+    if bridge == "fslabs":
+        return FslabsReplay(host)
+    raise ValueError(f"No replay support for bridge {bridge}")
+
+
+async def replay(path: str, speed: Optional[float], start: float = 0.0,
+                 bridge: Optional[str] = None, host: Optional[str] = None,
+                 feed_log: Optional[str] = None) -> None:
+    """Feeds a capture through the bridge pipeline, at `speed` times real time or as fast as possible if None."""
+    reader = CaptureReader(path)
+    target = create_replay_target(bridge or reader.bridge, host)
+    target.feed_log = FeedLog(feed_log) if feed_log else None
+    await target.start()
+    loop = asyncio.get_running_loop()
+    start_ns = int(start * 1e9)
+    frames = 0
+    replay_started = loop.time()
+    try:
+        for record in reader.records(start_ns):
+            if speed is not None:
+                delay = replay_started + (record.t_ns - start_ns) / 1e9 / speed - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            if target.feed_log is not None:
+                target.feed_log.fed_ns = time.time_ns()
+            await target.feed(record)
+            frames += 1
+            # let the sends scheduled by the bridge go out
+            await asyncio.sleep(0)
+        await asyncio.sleep(0.1)
+    finally:
+        await target.stop()
+        reader.close()
+        if target.feed_log is not None:
+            target.feed_log.close()
+    elapsed = loop.time() - replay_started
+    logging.info("Replayed %d frames in %.3f s (%.1f frames/s)", frames, elapsed, frames / elapsed if elapsed else 0.0)
+
+
+def dump(path: str) -> None:
+    reader = CaptureReader(path)
+    print(f"bridge={reader.bridge} index_entries={len(reader.index)}")
+    for record in reader:
+        size = len(record.payload) if isinstance(record.payload, (bytes, str)) else len(json.dumps(record.payload))
+        print(f"{record.t_ns / 1e9:12.6f} {record.channel:24} {size}")
+    reader.close()
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Inspect or replay CDU capture files")
+    commands = parser.add_subparsers(dest="command", required=True)
+    dump_parser = commands.add_parser("dump", help="list the records of a capture")
+    dump_parser.add_argument("capture")
+    replay_parser = commands.add_parser("replay", help="feed a capture through its bridge")
+    replay_parser.add_argument("capture")
+    replay_parser.add_argument("--speed", default="1", help="multiple of real time, or 'max'")
+    replay_parser.add_argument("--start", type=float, default=0.0, help="seconds into the capture")
+    replay_parser.add_argument("--bridge", help="override the bridge stored in the capture")
+    replay_parser.add_argument("--host", help="MobiFlight host:port, e.g. localhost:8321 for a stand-in")
+    replay_parser.add_argument("--feed-log", help="log the sent frames for mobiflight_standin.py latency pairing")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s - %(levelname)s - %(message)s"
+    )
+    args = parse_args()
+    if args.command == "dump":
+        dump(args.capture)
+    else:
+        speed = None if args.speed == "max" else float(args.speed)
+        asyncio.run(replay(args.capture, speed, args.start, args.bridge, args.host, args.feed_log))
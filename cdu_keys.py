@@ -0,0 +1,208 @@
+"""
+Key events from the MobiFlight CDU websockets.
+
+parse_key_event turns what MobiFlight sends into the key names of the FBW
+SimBridge MCDU interface, which the other bridges use as well.
+
+Setting WINWING_CDU_ECHO=1 turns on the scratchpad echo: a typed character is
+drawn into the scratchpad of the last frame and sent right away instead of
+after its round trip through the sim. Frames from the sim are reconciled with
+the characters still waiting for it. Characters the sim has caught up with are
+dropped, the rest are drawn on top of its frame. Anything else, such as a
+scratchpad message or a key the sim did not take, rolls the display back to the
+sim's frame, as does the sim not catching up within ECHO_TIMEOUT.
+"""
+import asyncio
+import json
+import logging
+import os
+import re
+from typing import Awaitable, Callable, List, Optional, Union
+
+from cdu_metrics import metrics
+
+ECHO_ENV: str = "WINWING_CDU_ECHO"
+ECHO_TIMEOUT: float = 1.0
+
+CDU_COLUMNS: int = 24
+CDU_ROWS: int = 14
+CDU_CELLS: int = CDU_COLUMNS * CDU_ROWS
+SCRATCHPAD_START: int = (CDU_ROWS - 1) * CDU_COLUMNS
+# the last two columns of the scratchpad row hold the A320 up/down arrows
+SCRATCHPAD_COLUMNS: int = CDU_COLUMNS - 2
+
+# Key names of the SimBridge MCDU interface, sent as "event:<side>:<key>"
+FBW_KEYS = frozenset(
+    [f"L{i}" for i in range(1, 7)] + [f"R{i}" for i in range(1, 7)]
+    + ["DIR", "PROG", "PERF", "INIT", "DATA", "FPLN", "RAD", "FUEL", "SEC", "ATC", "MENU", "AIRPORT",
+       "PREVPAGE", "NEXTPAGE", "UP", "DOWN", "DIV", "DOT", "PLUSMINUS", "SP", "OVFY", "CLR"]
+    + [chr(c) for c in range(ord("A"), ord("Z") + 1)] + [str(i) for i in range(10)]
+)
+
+# Other spellings of the same keys in MobiFlight and WinWing key events
+KEY_ALIASES = {
+    "DIR_INTC": "DIR", "DIRECT": "DIR",
+    "F_PLN": "FPLN", "RAD_NAV": "RAD", "FUEL_PRED": "FUEL", "SEC_FPLN": "SEC", "SEC_F_PLN": "SEC",
+    "ATC_COMM": "ATC", "MCDU_MENU": "MENU", "AIRPT": "AIRPORT",
+    "PREV_PAGE": "PREVPAGE", "SLEW_LEFT": "PREVPAGE", "NEXT_PAGE": "NEXTPAGE", "SLEW_RIGHT": "NEXTPAGE",
+    "SLEW_UP": "UP", "SLEW_DOWN": "DOWN",
+    "/": "DIV", "SLASH": "DIV", ".": "DOT", "DECIMAL": "DOT", "+/-": "PLUSMINUS", "PLUS_MINUS": "PLUSMINUS",
+    "SPACE": "SP", "OVERFLY": "OVFY", "CLEAR": "CLR",
+}
+KEY_FIELDS = ("Key", "Button", "Event", "Data")
+LSK_REGEX = re.compile(r"LSK_?([1-6])_?([LR])")
+FBW_EVENT_REGEX = re.compile(r"(?:A32NX_)?MCDU_[LR]_(\w+?)_BUTTON_PRESSED")
+
+# keys that always change the display: the page keys and scratchpad entries. A line select or
+# slew key can leave the page as it is (an empty line, a single page), BRT/DIM only dim it.
+DISPLAY_KEYS = FBW_KEYS - {f"{side}{i}" for side in "LR" for i in range(1, 7)} - {"PREVPAGE", "NEXTPAGE", "UP", "DOWN"}
+
+# keys that append a character to the scratchpad; SP is left out, trailing blanks cannot be compared
+ECHO_CHARS = {**{key: key for key in FBW_KEYS if len(key) == 1}, "DOT": ".", "DIV": "/"}
+
+
+def parse_key_event(message: Union[str, bytes]) -> Optional[str]:
+    """
+    Returns the SimBridge name of the key pressed in a MobiFlight message, None for anything else.
+    Accepts a bare key name or a JSON object naming the key in one of KEY_FIELDS,
+    releases flagged by a false "Pressed" or "State" are ignored.
+    """
+    if isinstance(message, bytes):
+        message = message.decode(errors="replace")
+    name = message.strip()
+    if name.startswith("{"):
+        try:
+            event = json.loads(name)
+        except ValueError:
+            return None
+        if not isinstance(event, dict):
+            return None
+        if str(event.get("Pressed", event.get("State", True))).lower() in ("0", "false", "released"):
+            return None
+        name = next((event[field] for field in KEY_FIELDS if isinstance(event.get(field), str)), "")
+
+    key = name.strip().upper()
+    key = KEY_ALIASES.get(key, key)
+    key = re.sub(r"[\s-]+", "_", key)
+    key = KEY_ALIASES.get(key, key)
+    if match := FBW_EVENT_REGEX.fullmatch(key):
+        key = match.group(1)
+    if match := LSK_REGEX.fullmatch(key):
+        key = match.group(2) + match.group(1)
+    return key if key in FBW_KEYS else None
+
+
+def expects_update(key: Optional[str]) -> bool:
+    """Whether the sim should answer a key from parse_key_event with a new frame, for the stream watchdog."""
+    return key in DISPLAY_KEYS
+
+
+def echo_enabled() -> bool:
+    return os.environ.get(ECHO_ENV, "") not in ("", "0")
+
+
+def scratchpad_text(cells: List) -> Optional[str]:
+    """The scratchpad as text, None unless it holds white characters only."""
+    text = []
+    for cell in cells[SCRATCHPAD_START:SCRATCHPAD_START + SCRATCHPAD_COLUMNS]:
+        if not cell:
+            text.append(" ")
+        elif cell[1] != "w":
+            return None
+        else:
+            text.append(cell[0])
+    return "".join(text).rstrip()
+
+
+class ScratchpadEcho:
+    def __init__(self, send: Callable[[str], Awaitable[None]], name: str, timeout: float = ECHO_TIMEOUT) -> None:
+        # sends a frame to the CDU without going through reconcile()
+        self.send: Callable[[str], Awaitable[None]] = send
+        self.name: str = name
+        self.timeout: float = timeout
+        # last frame from the sim, decoded when a key needs it
+        self.frame: Optional[str] = None
+        self.cells: Optional[List] = None
+        # the sim's scratchpad and the characters drawn after it that the sim has not shown yet
+        self.base: str = ""
+        self.typed: str = ""
+        # whether the CDU shows something other than self.frame
+        self.shown: bool = False
+        self.rollback_task: Optional[asyncio.Task] = None
+
+    def decoded(self, frame: str) -> Optional[List]:
+        cells = json.loads(frame).get("Data")
+        return cells if isinstance(cells, list) and len(cells) == CDU_CELLS else None
+
+    def render(self) -> str:
+        cells = list(self.cells)
+        for column, char in enumerate(self.typed, SCRATCHPAD_START + len(self.base)):
+            cells[column] = [char, "w", 0]
+        return json.dumps({"Target": "Display", "Data": cells}, separators=(",", ":"))
+
+    async def key(self, key: str, received: float = 0.0) -> None:
+        char = ECHO_CHARS.get(key)
+        if char is None:
+            # CLR, page keys and so on: the sim's next frame decides, or the rollback timer
+            self.typed = ""
+            return
+        if self.frame is None:
+            return
+        if not self.typed:
+            if self.cells is None:
+                self.cells = self.decoded(self.frame)
+            base = scratchpad_text(self.cells) if self.cells is not None else None
+            if base is None:
+                return
+            self.base = base
+        if len(self.base) + len(self.typed) >= SCRATCHPAD_COLUMNS:
+            return
+        self.typed += char
+        self.shown = True
+        await self.send(self.render())
+        metrics.observe("echo", received)
+        if self.rollback_task is None:
+            self.rollback_task = asyncio.create_task(self.rollback_after(self.timeout))
+
+    def reconcile(self, frame: str) -> str:
+        """Takes a frame from the sim, returns the frame to send in its place."""
+        self.frame, self.cells = frame, None
+        if not self.shown:
+            return frame
+        if self.typed:
+            self.cells = self.decoded(frame)
+            text = scratchpad_text(self.cells) if self.cells is not None else None
+            expected = self.base + self.typed
+            if text == expected:
+                self.settle()
+                return frame
+            if text is not None and text.startswith(self.base) and expected.startswith(text):
+                # the sim has some or none of the characters yet, keep drawing the rest
+                self.base, self.typed = text, expected[len(text):]
+                self.restart_rollback()
+                return self.render()
+            logging.debug("Scratchpad echo for %s rolled back, expected %r, sim shows %r", self.name, expected, text)
+            metrics.count("echo_rollbacks")
+        self.settle()
+        return frame
+
+    def settle(self) -> None:
+        self.typed = ""
+        self.shown = False
+        if self.rollback_task is not None:
+            self.rollback_task.cancel()
+            self.rollback_task = None
+
+    def restart_rollback(self) -> None:
+        if self.rollback_task is not None:
+            self.rollback_task.cancel()
+        self.rollback_task = asyncio.create_task(self.rollback_after(self.timeout))
+
+    async def rollback_after(self, timeout: float) -> None:
+        await asyncio.sleep(timeout)
+        self.rollback_task = None
+        if self.shown and self.frame is not None:
+            logging.debug("Scratchpad echo for %s timed out", self.name)
+            metrics.count("echo_rollbacks")
+            self.settle()
+            await self.send(self.frame)
@@ -0,0 +1,103 @@
+"""
+Shared logging setup for the bridges.
+
+Records go through a QueueHandler, so writing to the console and the log file
+happens on the QueueListener's background thread and never blocks the event
+loop or the SimConnect dispatch thread. A filter in front of the queue lets
+each warning or error through at most RATE_LIMIT_BURST times per
+RATE_LIMIT_INTERVAL; repeats are counted and reported with the next message
+that gets through. Messages that differ only in numbers (retry counters,
+ports, ids) count as the same message. Lower levels always pass, so lifecycle
+lines such as the startup phases are never dropped.
+"""
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import re
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+DEFAULT_FORMAT: str = "%(asctime)s - %(levelname)s - %(message)s"
+RATE_LIMIT_INTERVAL: float = 60.0
+RATE_LIMIT_BURST: int = 5
+# only records at this level and above are limited
+RATE_LIMIT_LEVEL: int = logging.WARNING
+# forget messages not seen for an interval once this many are tracked
+RATE_LIMIT_KEYS: int = 1000
+
+NUMBERS = re.compile(r"\d+")
+
+
+class RateLimitFilter(logging.Filter):
+    def __init__(self, interval: float = RATE_LIMIT_INTERVAL, burst: int = RATE_LIMIT_BURST) -> None:
+        super().__init__()
+        self.interval: float = interval
+        self.burst: int = burst
+        self.lock = threading.Lock()
+        # message key -> [window start, messages in window, suppressed in window]
+        self.windows: Dict[Tuple[str, int, str], List] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno < RATE_LIMIT_LEVEL:
+            return True
+        try:
+            message = record.getMessage()
+        except Exception:
+            message = str(record.msg)
+        key = (record.name, record.levelno, NUMBERS.sub("#", message))
+        now = time.monotonic()
+        with self.lock:
+            window = self.windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                if window is None and len(self.windows) >= RATE_LIMIT_KEYS:
+                    self.windows = {k: w for k, w in self.windows.items() if now - w[0] < self.interval}
+                suppressed = window[2] if window is not None else 0
+                self.windows[key] = [now, 1, 0]
+                if suppressed:
+                    record.msg = f"{record.msg} [{suppressed} similar messages suppressed in the last {now - window[0]:.0f} s]"
+                return True
+            window[1] += 1
+            if window[1] <= self.burst:
+                return True
+            window[2] += 1
+            return False
+
+
+def setup_logging(level=logging.INFO, log_file: Optional[str] = None, fmt: str = DEFAULT_FORMAT,
+                  max_bytes: int = 500000, backup_count: int = 7, file_mode: str = "a",
+                  console: bool = True) -> logging.handlers.QueueListener:
+    """Routes the root logger through a queue to the console and an optional (rotating) log file."""
+    formatter = logging.Formatter(fmt)
+    handlers: List[logging.Handler] = []
+    if log_file:
+        base_path = os.path.dirname(log_file)
+        if base_path:
+            os.makedirs(base_path, exist_ok=True)
+        if max_bytes:
+            file_handler: logging.Handler = logging.handlers.RotatingFileHandler(
+                log_file, maxBytes=max_bytes, backupCount=backup_count)
+        else:
+            file_handler = logging.FileHandler(log_file, mode=file_mode)
+        handlers.append(file_handler)
+    if console:
+        handlers.append(logging.StreamHandler())
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(RateLimitFilter())
+    root_logger = logging.getLogger()
+    for handler in list(root_logger.handlers):
+        root_logger.removeHandler(handler)
+    root_logger.addHandler(queue_handler)
+    root_logger.setLevel(level)
+
+    listener = logging.handlers.QueueListener(log_queue, *handlers)
+    listener.start()
+    # flush what is still queued when the script exits
+    atexit.register(listener.stop)
+    return listener
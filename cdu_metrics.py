@@ -0,0 +1,249 @@
+"""
+Per-stage timing histograms and frame counters for the bridges.
+
+Every bridge reports the stages a frame goes through:
+
+    receive  handling one source message, from its arrival to the hand-off
+    decode   turning the source data into something the encoder can read
+    encode   building the MobiFlight display JSON
+    queue    waiting between the hand-off and the send starting
+    send     the websocket send
+
+and FBW reports key:<KEY>, from a CDU key press arriving to the frame that
+answers it being sent. The GNS530 app does the same with the joystick button
+number as KEY, from the press being captured, and reports the hand-off from
+its joystick thread as queue.
+
+plus the frames_in, frames_out, frames_skipped, reconnects and resubscribes
+counters and gauges read when the metrics are served, such as the
+display_staleness_seconds of each cdu_watchdog.StreamWatchdog.
+
+Setting WINWING_CDU_METRICS_PORT serves them on http://localhost:<port>/metrics
+in Prometheus text format and logs a summary every SUMMARY_INTERVAL seconds.
+Setting WINWING_CDU_TRACE also hands every stage timing to a cdu_trace.Tracer.
+For the trace, a frame gets a number from frame() where it enters the
+pipeline, and every stage of that frame passes it to observe(), so the trace
+can link them. With neither set, now() and frame() return 0 and observe() and
+count() return right away.
+
+    frame = metrics.frame()
+    started = metrics.now()
+    data = create_mobi_json(...)
+    metrics.observe("encode", started, frame)
+"""
+import asyncio
+import bisect
+import itertools
+import logging
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from cdu_trace import Tracer, tracer_from_env
+
+METRICS_PORT_ENV: str = "WINWING_CDU_METRICS_PORT"
+SUMMARY_INTERVAL: float = 60.0
+
+STAGES: Tuple[str, ...] = ("receive", "decode", "encode", "queue", "send")
+COUNTERS: Tuple[str, ...] = ("frames_in", "frames_out", "frames_skipped", "reconnects", "resubscribes")
+
+# upper bounds in seconds, from 50 µs to 1 s
+BUCKETS: Tuple[float, ...] = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                              0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self) -> None:
+        # one count per bucket plus the +Inf bucket
+        self.counts: List[int] = [0] * (len(BUCKETS) + 1)
+        self.sum: float = 0.0
+        self.count: int = 0
+
+    def observe(self, seconds: float) -> None:
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+    def copy(self) -> "Histogram":
+        histogram = Histogram()
+        histogram.counts, histogram.sum, histogram.count = list(self.counts), self.sum, self.count
+        return histogram
+
+    def since(self, earlier: "Histogram") -> "Histogram":
+        histogram = Histogram()
+        histogram.counts = [now - before for now, before in zip(self.counts, earlier.counts)]
+        histogram.sum, histogram.count = self.sum - earlier.sum, self.count - earlier.count
+        return histogram
+
+    def quantile(self, fraction: float) -> float:
+        """Upper bound of the bucket holding the quantile, infinite past the last bucket."""
+        rank, seen = fraction * self.count, 0
+        for bound, count in zip(BUCKETS + (float("inf"),), self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+class Metrics:
+    def __init__(self) -> None:
+        self.enabled: bool = False
+        self.tracer: Optional[Tracer] = None
+        # timings are taken when either the histograms or the tracer want them
+        self.timing: bool = False
+        self.bridge: str = ""
+        self.lock = threading.Lock()
+        self.histograms: Dict[str, Histogram] = {stage: Histogram() for stage in STAGES}
+        self.counters: Dict[str, int] = {name: 0 for name in COUNTERS}
+        # (name, source) -> function returning the current value
+        self.gauges: Dict[Tuple[str, str], Callable[[], float]] = {}
+        self.server: Optional[asyncio.AbstractServer] = None
+        self.tasks: List[asyncio.Task] = []
+        # next() on a count is atomic, frames may enter on the SimConnect dispatch thread
+        self.frames = itertools.count(1)
+
+    def now(self) -> float:
+        return time.perf_counter() if self.timing else 0.0
+
+    def frame(self) -> int:
+        """A number for a frame entering the pipeline, 0 when it is not traced."""
+        return next(self.frames) if self.tracer is not None else 0
+
+    def observe(self, stage: str, started: float, frame: int = 0) -> None:
+        """Records the time since `started`, a value returned by now(), for a stage of a frame."""
+        if not self.timing or not started:
+            return
+        ended = time.perf_counter()
+        if self.tracer is not None:
+            self.tracer.add(stage, started, ended, frame)
+        if not self.enabled:
+            return
+        elapsed = ended - started
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = Histogram()
+            histogram.observe(elapsed)
+
+    def count(self, name: str, value: int = 1) -> None:
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name: str, source: str, read: Callable[[], float]) -> None:
+        """Registers a gauge, replacing an earlier one for the same source."""
+        with self.lock:
+            self.gauges[(name, source)] = read
+
+    def read_gauges(self) -> Dict[Tuple[str, str], float]:
+        with self.lock:
+            gauges = dict(self.gauges)
+        return {key: read() for key, read in gauges.items()}
+
+    def snapshot(self) -> Tuple[Dict[str, Histogram], Dict[str, int]]:
+        with self.lock:
+            return ({stage: histogram.copy() for stage, histogram in self.histograms.items()},
+                    dict(self.counters))
+
+    def render(self) -> str:
+        """The metrics in Prometheus text exposition format."""
+        histograms, counters = self.snapshot()
+        lines = ["# HELP winwing_cdu_stage_seconds Time a frame spent in each pipeline stage.",
+                 "# TYPE winwing_cdu_stage_seconds histogram"]
+        for stage, histogram in histograms.items():
+            labels = f'bridge="{self.bridge}",stage="{stage}"'
+            cumulative = 0
+            for bound, count in zip(BUCKETS + (float("inf"),), histogram.counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f'winwing_cdu_stage_seconds_bucket{{{labels},le="{le}"}} {cumulative}')
+            lines.append(f"winwing_cdu_stage_seconds_sum{{{labels}}} {histogram.sum!r}")
+            lines.append(f"winwing_cdu_stage_seconds_count{{{labels}}} {histogram.count}")
+        for name, value in counters.items():
+            lines.append(f"# TYPE winwing_cdu_{name}_total counter")
+            lines.append(f'winwing_cdu_{name}_total{{bridge="{self.bridge}"}} {value}')
+        gauges = self.read_gauges()
+        for name in sorted({name for name, _ in gauges}):
+            lines.append(f"# TYPE winwing_cdu_{name} gauge")
+            for (gauge_name, source), value in gauges.items():
+                if gauge_name == name:
+                    lines.append(f'winwing_cdu_{name}{{bridge="{self.bridge}",source="{source}"}} {value:.3f}')
+        return "\n".join(lines) + "\n"
+
+    async def handle_request(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            request = await reader.readline()
+            while (await reader.readline()).strip():
+                pass
+            path = request.split()[1].decode() if len(request.split()) > 1 else "/"
+            if path.split("?")[0] in ("/", "/metrics"):
+                status, body = "200 OK", self.render().encode()
+            else:
+                status, body = "404 Not Found", b"not found\n"
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                         f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def summary(self, histograms: Dict[str, Histogram], counters: Dict[str, int]) -> str:
+        parts = []
+        for stage, histogram in histograms.items():
+            if histogram.count:
+                parts.append(f"{stage} p50<={histogram.quantile(0.5) * 1000:g} ms "
+                             f"p99<={histogram.quantile(0.99) * 1000:g} ms n={histogram.count}")
+        parts += [f"{name} {value}" for name, value in counters.items()]
+        parts += [f"{name} {source} {value:.1f}" for (name, source), value in self.read_gauges().items()]
+        return ", ".join(parts)
+
+    async def log_summaries(self, interval: float) -> None:
+        previous_histograms, previous_counters = self.snapshot()
+        while True:
+            await asyncio.sleep(interval)
+            histograms, counters = self.snapshot()
+            logging.info("Metrics for the last %.0f s: %s", interval, self.summary(
+                {stage: h.since(previous_histograms.get(stage, Histogram())) for stage, h in histograms.items()},
+                {name: value - previous_counters.get(name, 0) for name, value in counters.items()}))
+            previous_histograms, previous_counters = histograms, counters
+
+    def start_tracing(self, tracer: Tracer) -> None:
+        self.tracer = tracer
+        self.timing = True
+
+    async def start(self, bridge: str, port: int, interval: float = SUMMARY_INTERVAL) -> None:
+        self.bridge = bridge
+        self.enabled = True
+        self.timing = True
+        self.server = await asyncio.start_server(self.handle_request, "localhost", port)
+        self.tasks.append(asyncio.create_task(self.log_summaries(interval)))
+        logging.info("Serving metrics on http://localhost:%d/metrics", port)
+
+    async def start_from_env(self, bridge: str) -> None:
+        tracer = tracer_from_env(bridge)
+        if tracer is not None:
+            self.start_tracing(tracer)
+        port = os.environ.get(METRICS_PORT_ENV)
+        if not port:
+            return
+        try:
+            await self.start(bridge, int(port))
+        except (ValueError, OSError) as e:
+            logging.error(f"Could not serve metrics on port {port}: {e}")
+
+    async def stop(self) -> None:
+        for task in self.tasks:
+            task.cancel()
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        self.enabled = False
+        self.timing = self.tracer is not None
+
+
+metrics = Metrics()
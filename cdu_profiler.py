@@ -0,0 +1,309 @@
+"""
+On-demand profiling of a running bridge.
+
+Setting WINWING_CDU_CONTROL_PORT opens a line based control socket on
+localhost that switches the profilers on and off without restarting the flight:
+
+    profile start | profile stop    cProfile on the event loop thread plus a stack
+                                    sampler covering every thread, including the
+                                    SimConnect dispatch thread
+    alloc start | alloc snapshot | alloc stop
+                                    tracemalloc, a snapshot reports the biggest
+                                    allocators since the previous one
+    trace dump                      write the cdu_trace ring buffer
+    status
+
+Results go to timestamped files in PROFILE_DIR, each with a top-N summary and
+the rows for create_mobi_json, parse_fbw_segment and the source handlers. On
+POSIX, SIGUSR2 toggles profiling as well. Until switched on nothing is hooked.
+
+    python cdu_profiler.py profile start --port 8340
+"""
+import argparse
+import asyncio
+import cProfile
+import io
+import linecache
+import logging
+import os
+import pstats
+import signal
+import socket
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+CONTROL_PORT_ENV: str = "WINWING_CDU_CONTROL_PORT"
+PROFILE_DIR: str = os.path.join(os.path.dirname(os.path.abspath(__file__)), "profiles")
+TOP_N: int = 25
+SAMPLE_INTERVAL: float = 0.005
+TRACEMALLOC_FRAMES: int = 25
+
+# the functions a lagging CDU usually comes down to
+FOCUS_FUNCTIONS: Tuple[str, ...] = ("create_mobi_json", "parse_fbw_segment", "parse_fsl_mcdu", "handle_cdu_data",
+                                    "handle_message", "handle_dataref", "handle_fsl_value", "send")
+
+FunctionKey = Tuple[str, int, str]
+
+
+def timestamped_path(bridge: str, suffix: str) -> str:
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    return os.path.join(PROFILE_DIR, f"{bridge}-{time.strftime('%Y%m%d-%H%M%S')}{suffix}")
+
+
+def function_label(key: FunctionKey) -> str:
+    filename, line, name = key
+    return f"{os.path.basename(filename)}:{line}({name})"
+
+
+class StackSampler:
+    """Samples the stacks of all threads, since cProfile only sees the thread it was enabled on."""
+
+    def __init__(self, interval: float = SAMPLE_INTERVAL) -> None:
+        self.interval: float = interval
+        self.own: Counter = Counter()
+        self.cumulative: Counter = Counter()
+        self.samples: int = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="StackSampler", daemon=True)
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self) -> None:
+        own_id = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                self.samples += 1
+                seen = set()
+                top = True
+                while frame is not None:
+                    code = frame.f_code
+                    key = (code.co_filename, code.co_firstlineno, code.co_name)
+                    if top:
+                        self.own[key] += 1
+                        top = False
+                    if key not in seen:
+                        self.cumulative[key] += 1
+                        seen.add(key)
+                    frame = frame.f_back
+
+    def report(self, top_n: int = TOP_N) -> str:
+        lines = [f"{self.samples} samples every {self.interval * 1000:g} ms across all threads", "",
+                 "Own time:"]
+        lines += [f"{count / self.samples:7.1%}  {function_label(key)}" for key, count in self.own.most_common(top_n)]
+        lines += ["", "Including callees:"]
+        lines += [f"{count / self.samples:7.1%}  {function_label(key)}"
+                  for key, count in self.cumulative.most_common(top_n)]
+        lines += ["", "Focus functions (own / including callees):"]
+        for key, count in sorted(self.cumulative.items(), key=lambda item: -item[1]):
+            if key[2] in FOCUS_FUNCTIONS:
+                lines.append(f"{self.own[key] / self.samples:7.1%} {count / self.samples:7.1%}  {function_label(key)}")
+        return "\n".join(lines) + "\n"
+
+
+def focus_code_ranges() -> Dict[str, List[Tuple[int, int]]]:
+    """Line ranges of the focus functions in the loaded modules, to attribute allocations to them."""
+    ranges: Dict[str, List[Tuple[int, int]]] = {}
+    for module in list(sys.modules.values()):
+        filename = getattr(module, "__file__", None) or ""
+        if "winwing" not in os.path.basename(filename) and "cdu" not in os.path.basename(filename):
+            continue
+        for value in list(vars(module).values()):
+            functions = [value] + [v for v in vars(value).values() if callable(v)] if isinstance(value, type) else [value]
+            for function in functions:
+                code = getattr(function, "__code__", None)
+                if code is not None and code.co_name in FOCUS_FUNCTIONS and code.co_filename == filename:
+                    last = max((line for _, _, line in code.co_lines() if line is not None), default=code.co_firstlineno)
+                    ranges.setdefault(filename, []).append((code.co_firstlineno, last))
+    return ranges
+
+
+class Profiler:
+    def __init__(self, bridge: str) -> None:
+        self.bridge: str = bridge
+        self.profile: Optional[cProfile.Profile] = None
+        self.sampler: Optional[StackSampler] = None
+        self.profile_started: float = 0.0
+        self.last_snapshot: Optional[tracemalloc.Snapshot] = None
+
+    # --- cProfile and the stack sampler ---
+
+    def start_profile(self) -> str:
+        if self.profile is not None:
+            return "profiling already running"
+        self.profile = cProfile.Profile()
+        self.sampler = StackSampler()
+        self.profile_started = time.monotonic()
+        self.sampler.start()
+        # must be called on the event loop thread, which the control socket runs on
+        self.profile.enable()
+        logging.info("Profiling started")
+        return "profiling started"
+
+    def stop_profile(self, top_n: int = TOP_N) -> str:
+        if self.profile is None:
+            return "profiling not running"
+        self.profile.disable()
+        self.sampler.stop()
+        elapsed = time.monotonic() - self.profile_started
+        stats_path = timestamped_path(self.bridge, ".prof")
+        self.profile.dump_stats(stats_path)
+
+        summary = io.StringIO()
+        summary.write(f"{self.bridge} profiled for {elapsed:.1f} s\n\n== cProfile, event loop thread ==\n")
+        stats = pstats.Stats(self.profile, stream=summary).strip_dirs()
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(top_n)
+        summary.write("== focus functions ==\n")
+        stats.print_stats("|".join(FOCUS_FUNCTIONS))
+        summary.write("== stack samples, all threads ==\n")
+        summary.write(self.sampler.report(top_n))
+        summary_path = stats_path[:-len(".prof")] + "-profile.txt"
+        with open(summary_path, "w") as file:
+            file.write(summary.getvalue())
+
+        self.profile, self.sampler = None, None
+        logging.info("Profile written to %s and %s", stats_path, summary_path)
+        return f"profile written to {stats_path} and {summary_path}"
+
+    def toggle_profile(self) -> str:
+        return self.stop_profile() if self.profile is not None else self.start_profile()
+
+    # --- tracemalloc ---
+
+    def start_alloc(self) -> str:
+        if tracemalloc.is_tracing():
+            return "allocation tracing already running"
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+        self.last_snapshot = tracemalloc.take_snapshot()
+        logging.info("Allocation tracing started")
+        return "allocation tracing started"
+
+    def snapshot_alloc(self, top_n: int = TOP_N) -> str:
+        if not tracemalloc.is_tracing():
+            return "allocation tracing not running"
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, linecache.__file__)])
+        path = timestamped_path(self.bridge, "-alloc.txt")
+        current, peak = tracemalloc.get_traced_memory()
+        lines = [f"{self.bridge} traced memory {current / 1024:.0f} KiB, peak {peak / 1024:.0f} KiB", "",
+                 "Biggest growth since the previous snapshot:"]
+        lines += [str(stat) for stat in snapshot.compare_to(self.last_snapshot, "lineno")[:top_n]]
+        lines += ["", "Biggest allocators:"]
+        lines += [str(stat) for stat in snapshot.statistics("lineno")[:top_n]]
+        lines += ["", "Allocated below the focus functions:"]
+        ranges = focus_code_ranges()
+        focus = Counter()
+        for trace in snapshot.traces:
+            for frame in trace.traceback:
+                for first, last in ranges.get(frame.filename, ()):
+                    if first <= frame.lineno <= last:
+                        focus[f"{os.path.basename(frame.filename)}:{frame.lineno}"] += trace.size
+        lines += [f"{size / 1024:10.1f} KiB  {where}" for where, size in focus.most_common(top_n)]
+        with open(path, "w") as file:
+            file.write("\n".join(lines) + "\n")
+        snapshot.dump(path[:-len(".txt")] + ".tracemalloc")
+        self.last_snapshot = snapshot
+        logging.info("Allocation snapshot written to %s", path)
+        return f"allocation snapshot written to {path}"
+
+    def stop_alloc(self) -> str:
+        if not tracemalloc.is_tracing():
+            return "allocation tracing not running"
+        result = self.snapshot_alloc()
+        tracemalloc.stop()
+        self.last_snapshot = None
+        return result
+
+    # --- control ---
+
+    def status(self) -> str:
+        from cdu_metrics import metrics
+        return (f"profiling {'on' if self.profile is not None else 'off'}, "
+                f"allocation tracing {'on' if tracemalloc.is_tracing() else 'off'}, "
+                f"trace buffer {'on' if metrics.tracer is not None else 'off'}")
+
+    def command(self, line: str) -> str:
+        from cdu_metrics import metrics
+        commands = {
+            "profile start": self.start_profile,
+            "profile stop": self.stop_profile,
+            "alloc start": self.start_alloc,
+            "alloc snapshot": self.snapshot_alloc,
+            "alloc stop": self.stop_alloc,
+            "trace dump": lambda: (metrics.tracer.dump() or "could not write trace") if metrics.tracer is not None
+            else "tracing is off, set WINWING_CDU_TRACE",
+            "status": self.status,
+        }
+        action = commands.get(" ".join(line.split()).lower())
+        if action is None:
+            return "unknown command, use one of: " + ", ".join(commands)
+        try:
+            return action()
+        except Exception as e:
+            logging.error(f"Profiler command {line!r} failed: {e}")
+            return f"failed: {e}"
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while line := await reader.readline():
+                writer.write((self.command(line.decode(errors="replace")) + "\n").encode())
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    def toggle_on_signal(self, loop: asyncio.AbstractEventLoop) -> None:
+        if not hasattr(signal, "SIGUSR2"):
+            return
+        # the profiler has to be switched on the loop thread
+        signal.signal(signal.SIGUSR2, lambda signum, frame: loop.call_soon_threadsafe(self.toggle_profile))
+
+
+async def start_control_from_env(bridge: str) -> Optional[Profiler]:
+    port = os.environ.get(CONTROL_PORT_ENV)
+    if not port:
+        return None
+    profiler = Profiler(bridge)
+    try:
+        await asyncio.start_server(profiler.handle_connection, "localhost", int(port))
+    except (ValueError, OSError) as e:
+        logging.error(f"Could not open the control socket on port {port}: {e}")
+        return None
+    profiler.toggle_on_signal(asyncio.get_running_loop())
+    logging.info("Control socket listening on localhost:%s", port)
+    return profiler
+
+
+def send_command(command: str, port: int, timeout: float = 60.0) -> str:
+    with socket.create_connection(("localhost", port), timeout=timeout) as connection:
+        connection.sendall((command + "\n").encode())
+        reply = b""
+        while not reply.endswith(b"\n"):
+            chunk = connection.recv(4096)
+            if not chunk:
+                break
+            reply += chunk
+    return reply.decode().strip()
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Control the profilers of a running bridge")
+    parser.add_argument("command", nargs="+", help="e.g. 'profile start', 'alloc snapshot', 'trace dump', 'status'")
+    parser.add_argument("--port", type=int, default=int(os.environ.get(CONTROL_PORT_ENV) or 8340))
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    print(send_command(" ".join(args.command), args.port))
@@ -0,0 +1,193 @@
+"""
+Scale test for many virtual CDUs served from one process and one event loop.
+
+For each display count it starts that many PMDGCDUClient instances, every one
+with its own client data area on a fake SimConnect (see fake_simconnect.py)
+and its own MobiFlight connection to one of a few mobiflight_standin.py
+processes. After a warm-up it measures CPU per display, event loop lag,
+resident memory, send latency (from the dispatch callback to the websocket
+send completing) and frames the dispatch thread had to drop.
+
+    python cdu_scale_test.py --counts 1,4,16,64 --rate 60 --output scale.json
+    python cdu_scale_test.py --capture logs/pmdg737-20250601-101500.wwcap
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional
+
+import pmdg_737_winwing_cdu as pmdg737
+from cdu_bench import Inputs, PmdgInputs, recorded_frames
+from fake_simconnect import FakeSim, create_simconnect, monitor_loop_lag, PATTERNS
+from mobiflight_standin import ENDPOINTS, percentiles
+
+# client data areas of the virtual CDUs, clear of the real PMDG ids
+VIRTUAL_CDU_ID_BASE: int = 0x57530000
+VIRTUAL_CDU_DEFINITION_BASE: int = 0x57538000
+WARMUP: float = 1.0
+
+
+class RecordedInputs(Inputs):
+    """Plays recorded frames whatever the pattern."""
+
+    def __init__(self, frames: List[bytes]) -> None:
+        self.frames = frames
+
+    def page(self, rng):
+        return rng.choice(self.frames)
+
+    def change_cell(self, frame, rng):
+        return rng.choice(self.frames)
+
+    def cases(self, frames, seed=530):
+        return {pattern: self.frames for pattern in PATTERNS}
+
+
+def rss_bytes() -> Optional[int]:
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def start_standins(count: int, first_port: int) -> List[subprocess.Popen]:
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mobiflight_standin.py")
+    return [subprocess.Popen([sys.executable, script, "--port", str(first_port + i), "--report-interval", "3600"],
+                             stderr=subprocess.DEVNULL)
+            for i in range(count)]
+
+
+class SendTimer:
+    """Wraps MobiFlightClient.send to time a frame from the dispatch callback until it is on the socket."""
+
+    def __init__(self) -> None:
+        self.latencies: List[float] = []
+        self.sent: int = 0
+
+    def wrap(self, mobiflight) -> None:
+        send = mobiflight.send
+
+        def timed_send(message, *args):
+            queued = time.perf_counter()
+
+            async def timed():
+                await send(message, *args)
+                self.latencies.append((time.perf_counter() - queued) * 1000)
+                self.sent += 1
+
+            return timed()
+
+        mobiflight.send = timed_send
+
+    def reset(self) -> None:
+        self.latencies = []
+        self.sent = 0
+
+
+async def run_step(displays: int, rate: float, inputs: Inputs, pattern: str, duration: float,
+                   ports: List[int]) -> Dict:
+    sim = FakeSim(rate, pattern, inputs)
+    simconnect = create_simconnect(pmdg737.SimConnectMobiFlight, sim)
+    timer = SendTimer()
+    targets = itertools.cycle([(port, path) for port in ports for path in ENDPOINTS])
+    clients = []
+    for index in range(displays):
+        port, path = next(targets)
+        client = pmdg737.PMDGCDUClient(simconnect, f"ws://localhost:{port}{path}", f"VIRTUAL_CDU_{index}",
+                                       VIRTUAL_CDU_ID_BASE + index, VIRTUAL_CDU_DEFINITION_BASE + index)
+        timer.wrap(client.mobiflight)
+        clients.append(client)
+
+    lag: List[float] = []
+    tasks = [asyncio.create_task(client.run()) for client in clients]
+    await asyncio.gather(*(client.mobiflight.connected.wait() for client in clients))
+    await asyncio.sleep(WARMUP)
+
+    monitor = asyncio.create_task(monitor_loop_lag(lag))
+    timer.reset()
+    sim.dispatch_us, sim.dropped, sim.dispatched = [], 0, 0
+    cpu_started, wall_started = time.process_time(), time.perf_counter()
+    await asyncio.sleep(duration)
+    cpu = time.process_time() - cpu_started
+    elapsed = time.perf_counter() - wall_started
+    rss = rss_bytes()
+    sim.stop()
+
+    monitor.cancel()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(monitor, *tasks, return_exceptions=True)
+    for client in clients:
+        await client.mobiflight.close()
+
+    return {
+        "displays": displays,
+        "connected": sum(not client.failed_to_connect() for client in clients),
+        "frames_sent": timer.sent,
+        "frames_per_s": round(timer.sent / elapsed, 1),
+        "cpu_percent": round(cpu / elapsed * 100, 1),
+        "cpu_ms_per_display_s": round(cpu / elapsed / displays * 1000, 3),
+        "rss_mb": round(rss / 2 ** 20, 1) if rss is not None else None,
+        "dropped": sim.dropped,
+        "dispatch_us": percentiles(sim.dispatch_us),
+        "loop_lag_ms": percentiles(lag),
+        "send_latency_ms": percentiles(timer.latencies),
+    }
+
+
+async def run(counts: List[int], rate: float, inputs: Inputs, pattern: str, duration: float,
+              ports: List[int]) -> List[Dict]:
+    results = []
+    for displays in counts:
+        result = await run_step(displays, rate, inputs, pattern, duration, ports)
+        print(f"{displays:3d} displays: {result['frames_per_s']:7.1f} frames/s, cpu {result['cpu_percent']:5.1f}%, "
+              f"loop lag p99 {result['loop_lag_ms'].get('p99', 0.0):.1f} ms, "
+              f"send p99 {result['send_latency_ms'].get('p99', 0.0):.1f} ms, dropped {result['dropped']}", flush=True)
+        results.append(result)
+    return results
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Measure how the bridge design scales with the number of CDUs")
+    parser.add_argument("--counts", default="1,2,4,8,16,32,64", help="comma separated display counts")
+    parser.add_argument("--rate", type=float, default=60.0, help="frames per second per display")
+    parser.add_argument("--pattern", choices=PATTERNS, default="single-cell")
+    parser.add_argument("--capture", help="PMDG capture to take the frames from instead of synthetic ones")
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds measured per display count")
+    parser.add_argument("--standins", type=int, default=2, help="stand-in processes sharing the receiving load")
+    parser.add_argument("--port", type=int, default=8330, help="port of the first stand-in")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    logging.basicConfig(
+        level=logging.WARNING,
+        format="%(asctime)s - %(levelname)s - %(message)s"
+    )
+    if args.capture:
+        _, frames = recorded_frames(args.capture, 1024)
+        inputs: Inputs = RecordedInputs(frames)
+    else:
+        inputs = PmdgInputs()
+    ports = [args.port + i for i in range(args.standins)]
+    standins = start_standins(args.standins, args.port)
+    time.sleep(1.0)
+    try:
+        results = asyncio.run(run([int(n) for n in args.counts.split(",")], args.rate, inputs, args.pattern,
+                                  args.duration, ports))
+    finally:
+        for standin in standins:
+            standin.terminate()
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump({"rate_hz": args.rate, "pattern": args.pattern, "capture": args.capture, "results": results},
+                      file, indent=2)
@@ -0,0 +1,222 @@
+"""
+Long-session soak test: drives one bridge against a mobiflight_standin.py for
+hours at an accelerated frame rate and watches for leaks and piling up work.
+
+PMDG and CRJ run on the fake SimConnect, FBW, Fenix and FSLabs get synthetic
+source messages through their replay targets. Every --interval seconds it
+records RSS, traced memory and the biggest tracemalloc growth, pending asyncio
+tasks, sends handed to the loop but not finished, and GC statistics, one JSON
+line per sample. After a warm-up it fits the trend of each and fails (exit
+code 1) if memory or pending work keeps growing.
+
+    python cdu_soak.py --bridge pmdg737 --hours 10 --rate 300 --output soak-pmdg737.jsonl
+"""
+import argparse
+import asyncio
+import gc
+import itertools
+import json
+import logging
+import sys
+import time
+import tracemalloc
+from typing import Dict, List, Optional
+
+from cdu_bench import CrjInputs, FbwInputs, FenixInputs, FslInputs, PmdgInputs
+from cdu_capture import Record, create_replay_target
+from cdu_scale_test import rss_bytes, start_standins
+from fake_simconnect import PATTERN_FRAMES, FakeSim, bridge_clients, create_simconnect, simconnect_class_for
+
+SIMCONNECT_BRIDGES = ("pmdg737", "pmdg777", "crj")
+BRIDGES = SIMCONNECT_BRIDGES + ("fbw", "fenix", "fslabs")
+# fraction of the run ignored when judging trends, while caches fill up
+WARMUP_FRACTION: float = 0.25
+# growth below this over the judged part of the run is noise, however steep it looks on a short run
+GROWTH_NOISE_MB: float = 2.0
+TOP_GROWTH: int = 5
+
+
+def synthetic_records(bridge: str):
+    """Endless source messages for the bridges fed through their replay targets."""
+    if bridge == "fbw":
+        pages = FbwInputs().cases(PATTERN_FRAMES)["single-cell"]
+        for left, right in zip(itertools.cycle(pages), itertools.cycle(reversed(pages))):
+            yield Record(0, "simbridge", "update:" + json.dumps({"left": left, "right": right}))
+    elif bridge == "fenix":
+        pages = FenixInputs().cases(PATTERN_FRAMES)["single-cell"]
+        for index, xml in enumerate(itertools.cycle(pages)):
+            yield Record(0, f"aircraft.mcdu{index % 2 + 1}.display", xml)
+    elif bridge == "fslabs":
+        for values in itertools.cycle(FslInputs().cases(PATTERN_FRAMES)["single-cell"]):
+            yield Record(0, "mcdu", values)
+    else:
+        raise ValueError(f"No synthetic source for bridge {bridge}")
+
+
+def slope(xs: List[float], ys: List[float]) -> float:
+    """Least squares slope of ys over xs."""
+    mean_x, mean_y = sum(xs) / len(xs), sum(ys) / len(ys)
+    variance = sum((x - mean_x) ** 2 for x in xs)
+    if not variance:
+        return 0.0
+    return sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / variance
+
+
+def evaluate(samples: List[Dict], max_growth_mb_per_hour: float, max_pending: int) -> List[str]:
+    """Returns why the soak failed, nothing if it passed."""
+    if not samples:
+        return ["no samples"]
+    end = samples[-1]["t_s"]
+    steady = [s for s in samples if s["t_s"] >= end * WARMUP_FRACTION]
+    failures = []
+    if len(steady) >= 3:
+        hours = [s["t_s"] / 3600 for s in steady]
+        for key in ("rss_mb", "traced_mb"):
+            values = [s[key] for s in steady if s[key] is not None]
+            if len(values) == len(hours):
+                growth = slope(hours, values)
+                if growth > max_growth_mb_per_hour and growth * (hours[-1] - hours[0]) > GROWTH_NOISE_MB:
+                    failures.append(f"{key} grows {growth:.1f} MB/h")
+        task_growth = slope(hours, [s["tasks"] for s in steady])
+        if task_growth * (hours[-1] - hours[0]) > max_pending:
+            failures.append(f"pending tasks grow {task_growth:.0f}/h")
+    worst_pending = max(s["pending_sends"] or 0 for s in samples)
+    if worst_pending > max_pending:
+        failures.append(f"up to {worst_pending} sends pending")
+    worst_tasks = max(s["tasks"] for s in samples)
+    if worst_tasks > max_pending + samples[0]["tasks"]:
+        failures.append(f"up to {worst_tasks} asyncio tasks")
+    if samples[-1]["gc_uncollectable"]:
+        failures.append(f"{samples[-1]['gc_uncollectable']} uncollectable objects")
+    return failures
+
+
+class Soak:
+    def __init__(self, bridge: str, rate: float, host: str) -> None:
+        self.bridge: str = bridge
+        self.rate: float = rate
+        self.host: str = host
+        self.sim: Optional[FakeSim] = None
+        self.clients: List = []
+        self.target = None
+        self.tasks: List[asyncio.Task] = []
+        self.frames: int = 0
+        self.started: float = time.monotonic()
+        self.last_snapshot: Optional[tracemalloc.Snapshot] = None
+
+    async def start(self) -> None:
+        if self.bridge in SIMCONNECT_BRIDGES:
+            inputs = CrjInputs() if self.bridge == "crj" else PmdgInputs()
+            self.sim = FakeSim(self.rate, "single-cell", inputs, dword_elements=self.bridge == "crj")
+            simconnect = create_simconnect(simconnect_class_for(self.bridge), self.sim)
+            self.clients = bridge_clients(self.bridge, simconnect, self.host)
+            self.tasks += [asyncio.create_task(client.run()) for client in self.clients]
+        else:
+            self.target = create_replay_target(self.bridge, self.host)
+            await self.target.start()
+            self.tasks.append(asyncio.create_task(self.feed()))
+
+    async def feed(self) -> None:
+        loop = asyncio.get_running_loop()
+        period = 1.0 / self.rate
+        deadline = loop.time()
+        for record in synthetic_records(self.bridge):
+            await self.target.feed(record)
+            self.frames += 1
+            deadline += period
+            await asyncio.sleep(max(0.0, deadline - loop.time()))
+
+    async def stop(self) -> None:
+        if self.sim is not None:
+            self.sim.stop()
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        if self.target is not None:
+            await self.target.stop()
+        for client in self.clients:
+            await client.mobiflight.close()
+
+    def sample(self) -> Dict:
+        rss = rss_bytes()
+        traced, _ = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot()
+        growth = []
+        if self.last_snapshot is not None:
+            growth = [str(stat) for stat in snapshot.compare_to(self.last_snapshot, "lineno")[:TOP_GROWTH]]
+        self.last_snapshot = snapshot
+        gc_stats = gc.get_stats()
+        return {
+            "t_s": round(time.monotonic() - self.started, 1),
+            "frames": self.sim.dispatched if self.sim is not None else self.frames,
+            "rss_mb": round(rss / 2 ** 20, 2) if rss is not None else None,
+            "traced_mb": round(traced / 2 ** 20, 2),
+            "tasks": len(asyncio.all_tasks()),
+            "pending_sends": sum(client.pending_sends() for client in self.clients) if self.clients else None,
+            "gc_counts": gc.get_count(),
+            "gc_collections": [generation["collections"] for generation in gc_stats],
+            "gc_collected": sum(generation["collected"] for generation in gc_stats),
+            "gc_uncollectable": sum(generation["uncollectable"] for generation in gc_stats),
+            "top_growth": growth,
+        }
+
+
+async def soak(bridge: str, rate: float, duration: float, interval: float, host: str,
+               output: Optional[str]) -> List[Dict]:
+    tracemalloc.start()
+    runner = Soak(bridge, rate, host)
+    await runner.start()
+    samples: List[Dict] = []
+    log = open(output, "w") if output else None
+    try:
+        while time.monotonic() - runner.started < duration:
+            await asyncio.sleep(min(interval, duration - (time.monotonic() - runner.started)))
+            sample = runner.sample()
+            samples.append(sample)
+            logging.info("%7.0f s: %d frames, rss %s MB, traced %.1f MB, %d tasks, %s pending sends",
+                         sample["t_s"], sample["frames"], sample["rss_mb"], sample["traced_mb"], sample["tasks"],
+                         sample["pending_sends"])
+            if log is not None:
+                log.write(json.dumps(sample) + "\n")
+                log.flush()
+    finally:
+        await runner.stop()
+        if log is not None:
+            log.close()
+        tracemalloc.stop()
+    return samples
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Soak a bridge for hours and check for leaks and pile-ups")
+    parser.add_argument("--bridge", choices=BRIDGES, default="pmdg737")
+    parser.add_argument("--hours", type=float, default=1.0)
+    parser.add_argument("--rate", type=float, default=300.0, help="source frames per second")
+    parser.add_argument("--interval", type=float, default=60.0, help="seconds between samples")
+    parser.add_argument("--max-growth", type=float, default=5.0, help="allowed memory growth in MB per hour")
+    parser.add_argument("--max-pending", type=int, default=64, help="allowed pending sends and extra tasks")
+    parser.add_argument("--port", type=int, default=8350, help="port of the stand-in started for the soak")
+    parser.add_argument("--output", help="write one JSON line per sample to this file")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s - %(levelname)s - %(message)s"
+    )
+    standins = start_standins(1, args.port)
+    time.sleep(1.0)
+    try:
+        samples = asyncio.run(soak(args.bridge, args.rate, args.hours * 3600, args.interval,
+                                   f"localhost:{args.port}", args.output))
+    finally:
+        for standin in standins:
+            standin.terminate()
+    failures = evaluate(samples, args.max_growth, args.max_pending)
+    for failure in failures:
+        logging.error("Soak failed: %s", failure)
+    if not failures:
+        logging.info("Soak passed: %d samples over %.1f h", len(samples), args.hours)
+    sys.exit(1 if failures else 0)
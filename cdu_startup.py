@@ -0,0 +1,111 @@
+"""
+Startup helpers shared by the PMDG bridges.
+
+StartupTimeline logs when each startup phase finished. The PMDG SDK path cache
+remembers where the <package>/work directories holding the aircraft options
+files are, so a start does not walk the MSFS packages directories again. The
+cache is keyed on the modification times of the packages roots and of every
+aircraft package directory in them: installing or removing a package touches
+its root, and the work directory created the first time an aircraft is flown
+touches its package directory.
+"""
+import json
+import logging
+import os
+import time
+from typing import Any, Awaitable, Dict, List, Tuple
+
+# Cache of discovered PMDG work directories, stored next to this script
+PATH_CACHE_FILE: str = os.path.join(os.path.dirname(os.path.abspath(__file__)), "pmdg_sdk_paths.json")
+
+
+class StartupTimeline:
+    """Logs when each startup phase finished, relative to the start of the process."""
+
+    def __init__(self) -> None:
+        self.started: float = time.perf_counter()
+        self.phases: Dict[str, float] = {}
+
+    def mark(self, phase: str) -> None:
+        if phase not in self.phases:
+            self.phases[phase] = time.perf_counter() - self.started
+            logging.info("Startup: %s after %.1f ms", phase, self.phases[phase] * 1000)
+
+    async def track(self, phase: str, awaitable: Awaitable) -> Any:
+        phase_started = time.perf_counter()
+        try:
+            result = await awaitable
+        except Exception as e:
+            logging.error(f"Startup: {phase} failed: {e}")
+            raise
+        logging.info("Startup: %s took %.1f ms", phase, (time.perf_counter() - phase_started) * 1000)
+        self.mark(phase)
+        return result
+
+
+def package_roots() -> List[str]:
+    """The MSFS packages directories of the MS Store and Steam installations."""
+    ms_store_path = os.path.join(
+        os.environ.get("LOCALAPPDATA", ""),
+        "Packages",
+        "Microsoft.FlightSimulator_8wekyb3d8bbwe",
+        "LocalState",
+        "packages",
+    )
+    steam_path = os.path.join(
+        os.environ.get("APPDATA", ""), "Microsoft Flight Simulator", "Packages"
+    )
+    return [ms_store_path, steam_path]
+
+
+def package_mtimes(roots: List[str], directories: List[str]) -> Dict[str, float]:
+    """Modification times of the existing packages roots and aircraft package directories in them."""
+    mtimes = {}
+    for root in roots:
+        if not os.path.exists(root):
+            continue
+        mtimes[root] = os.path.getmtime(root)
+        for directory in directories:
+            package = os.path.join(root, directory)
+            if os.path.exists(package):
+                mtimes[package] = os.path.getmtime(package)
+    return mtimes
+
+
+def load_path_cache(config_name: str) -> Dict:
+    try:
+        with open(PATH_CACHE_FILE, 'r') as file:
+            return json.load(file).get(config_name, {})
+    except (OSError, ValueError):
+        return {}
+
+
+def save_path_cache(config_name: str, cache: Dict) -> None:
+    try:
+        with open(PATH_CACHE_FILE, 'r') as file:
+            caches = json.load(file)
+    except (OSError, ValueError):
+        caches = {}
+    caches[config_name] = cache
+    try:
+        with open(PATH_CACHE_FILE, 'w') as file:
+            json.dump(caches, file, indent=2)
+    except OSError as e:
+        logging.warning(f"Could not write path cache {PATH_CACHE_FILE}: {e}")
+
+
+def find_work_paths(config_name: str, directories: List[str]) -> Tuple[List[str], Dict]:
+    """The work directories of the aircraft packages and the cache entry of config_name to save afterwards."""
+    roots = package_roots()
+    mtimes = package_mtimes(roots, directories)
+    cache = load_path_cache(config_name)
+    if cache.get("mtimes") == mtimes:
+        return cache.get("work_paths", []), cache
+    logging.info("Scanning for PMDG packages")
+    work_paths = []
+    for directory in directories:
+        for root in roots:
+            base_path = os.path.join(root, directory, "work")
+            if os.path.exists(base_path):
+                work_paths.append(base_path)
+    return work_paths, {"mtimes": mtimes, "work_paths": work_paths, "verified": cache.get("verified", {})}
@@ -0,0 +1,111 @@
+"""
+Chrome Trace Event recording of the per-frame pipeline, for Perfetto or chrome://tracing.
+
+Setting WINWING_CDU_TRACE to a directory keeps the last TRACE_EVENTS stage
+timings reported through cdu_metrics in a ring buffer, with the thread and
+asyncio task they ran on and the number of the frame they belong to. The
+stages of one frame are linked by flow events, so Perfetto draws each frame's
+journey from the source callback to the send, across threads. Sending SIGUSR1 (Ctrl+Break on Windows) writes them
+to <bridge>-<timestamp>.trace.json in that directory, so the seconds around a
+stutter can be captured without logging every frame.
+"""
+import asyncio
+import json
+import logging
+import os
+import signal
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+TRACE_ENV: str = "WINWING_CDU_TRACE"
+TRACE_EVENTS: int = 100000
+
+# SIGBREAK is Ctrl+Break in the console MobiFlight starts the scripts in
+DUMP_SIGNAL = getattr(signal, "SIGUSR1", None) or getattr(signal, "SIGBREAK", None)
+
+
+class Tracer:
+    def __init__(self, directory: str, bridge: str, capacity: int = TRACE_EVENTS) -> None:
+        self.directory: str = directory
+        self.bridge: str = bridge
+        # (stage, start, duration, thread id, task name, frame), appending to a deque is thread-safe
+        self.events: Deque[Tuple[str, float, float, int, Optional[str], int]] = deque(maxlen=capacity)
+        self.thread_names: Dict[int, str] = {}
+        self.pid: int = os.getpid()
+        self.origin: float = time.perf_counter()
+        self.origin_wall: float = time.time()
+
+    def add(self, stage: str, started: float, ended: float, frame: int = 0) -> None:
+        thread = threading.current_thread()
+        thread_id = thread.native_id
+        if thread_id not in self.thread_names:
+            self.thread_names[thread_id] = thread.name
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            # not on the event loop, e.g. the SimConnect dispatch thread
+            task = None
+        self.events.append((stage, started, ended - started, thread_id, task.get_name() if task else None, frame))
+
+    def trace_events(self) -> List[Dict]:
+        events: List[Dict] = [{"name": "process_name", "ph": "M", "pid": self.pid, "args": {"name": self.bridge}}]
+        for thread_id, name in list(self.thread_names.items()):
+            events.append({"name": "thread_name", "ph": "M", "pid": self.pid, "tid": thread_id, "args": {"name": name}})
+        # frame -> (start, thread id) of its stages
+        flows: Dict[int, List[Tuple[float, int]]] = {}
+        for stage, started, duration, thread_id, task, frame in list(self.events):
+            ts = round((started - self.origin) * 1e6, 1)
+            event = {"name": stage, "cat": self.bridge, "ph": "X", "pid": self.pid, "tid": thread_id,
+                     "ts": ts, "dur": round(duration * 1e6, 1)}
+            args = {}
+            if task is not None:
+                args["task"] = task
+            if frame:
+                args["frame"] = frame
+                flows.setdefault(frame, []).append((ts, thread_id))
+            if args:
+                event["args"] = args
+            events.append(event)
+        for frame, points in flows.items():
+            if len(points) < 2:
+                continue
+            points.sort()
+            last = len(points) - 1
+            for index, (ts, thread_id) in enumerate(points):
+                phase = "s" if index == 0 else "f" if index == last else "t"
+                # each flow point binds to the slice enclosing it on its thread
+                events.append({"name": "frame", "cat": self.bridge, "ph": phase, "id": frame,
+                               "pid": self.pid, "tid": thread_id, "ts": ts, "bp": "e"})
+        return events
+
+    def dump(self) -> Optional[str]:
+        """Writes the buffered events, returns the file name."""
+        path = os.path.join(self.directory, f"{self.bridge}-{time.strftime('%Y%m%d-%H%M%S')}.trace.json")
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(path, "w") as file:
+                json.dump({"traceEvents": self.trace_events(), "displayTimeUnit": "ms",
+                           "otherData": {"bridge": self.bridge, "started": self.origin_wall}}, file)
+        except OSError as e:
+            logging.error(f"Could not write trace {path}: {e}")
+            return None
+        logging.info("Wrote %d trace events to %s", len(self.events), path)
+        return path
+
+    def dump_on_signal(self) -> None:
+        if DUMP_SIGNAL is None or threading.current_thread() is not threading.main_thread():
+            return
+        signal.signal(DUMP_SIGNAL, lambda signum, frame: self.dump())
+
+
+def tracer_from_env(bridge: str) -> Optional[Tracer]:
+    directory = os.environ.get(TRACE_ENV)
+    if not directory:
+        return None
+    tracer = Tracer(directory, bridge)
+    tracer.dump_on_signal()
+    logging.info("Tracing the last %d stage timings, send signal %s to write them to %s",
+                 TRACE_EVENTS, DUMP_SIGNAL.name if DUMP_SIGNAL else "-", directory)
+    return tracer
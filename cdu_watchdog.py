@@ -0,0 +1,87 @@
+"""
+Watchdog for source streams that silently stop delivering.
+
+A Fenix subscription, the FBW SimBridge socket or a SimConnect client data
+request can stop sending without an error, leaving a frozen page on the CDU.
+Each source owns a StreamWatchdog that it tells about every update, and the
+MobiFlight clients tell it about CDU key presses that should change the page
+(cdu_keys.expects_update), not releases, BRT/DIM or other messages. The
+watchdog asks the source to resubscribe when
+
+    a key was pressed but no update followed within STALE_AFTER seconds, or
+    the sim is running and nothing arrived for IDLE_REFRESH seconds
+
+and exports the time since the last update as the display_staleness_seconds
+gauge of cdu_metrics.
+"""
+import asyncio
+import logging
+import time
+from typing import Any, Callable, Optional
+
+from cdu_metrics import metrics
+
+# a key press changes the page or the scratchpad well within this
+STALE_AFTER: float = 3.0
+# quiet pages are normal, re-request them now and then anyway while the sim runs
+IDLE_REFRESH: float = 120.0
+CHECK_INTERVAL: float = 1.0
+
+
+class StreamWatchdog:
+    def __init__(self, source: str, resubscribe: Callable[[], Any], sim_running: Optional[Callable[[], bool]] = None,
+                 stale_after: float = STALE_AFTER, idle_refresh: Optional[float] = IDLE_REFRESH) -> None:
+        self.source: str = source
+        # may return an awaitable, which is awaited
+        self.resubscribe: Callable[[], Any] = resubscribe
+        self.sim_running: Optional[Callable[[], bool]] = sim_running
+        self.stale_after: float = stale_after
+        self.idle_refresh: Optional[float] = idle_refresh
+        # plain float stores, so the SimConnect dispatch thread can report updates
+        self.last_update: float = time.monotonic()
+        self.last_input: float = 0.0
+        self.last_resubscribe: float = 0.0
+        self.resubscribes: int = 0
+        metrics.gauge("display_staleness_seconds", source, self.staleness)
+
+    def updated(self) -> None:
+        self.last_update = time.monotonic()
+
+    def input_seen(self) -> None:
+        self.last_input = time.monotonic()
+
+    def staleness(self) -> float:
+        return time.monotonic() - self.last_update
+
+    def stale_reason(self, now: float) -> Optional[str]:
+        if self.last_input > self.last_update and now - self.last_input >= self.stale_after:
+            return f"no update {now - self.last_input:.1f} s after a key press"
+        if (self.idle_refresh is not None and now - self.last_update >= self.idle_refresh
+                and now - self.last_resubscribe >= self.idle_refresh
+                and (self.sim_running is None or self.sim_running())):
+            return f"no update for {now - self.last_update:.0f} s"
+        return None
+
+    async def check(self) -> bool:
+        now = time.monotonic()
+        reason = self.stale_reason(now)
+        if reason is None or now - self.last_resubscribe < self.stale_after:
+            return False
+        self.last_resubscribe = now
+        # one resubscribe per key press, the next press tries again
+        self.last_input = 0.0
+        self.resubscribes += 1
+        metrics.count("resubscribes")
+        logging.warning("%s looks stale (%s), resubscribing", self.source, reason)
+        try:
+            result = self.resubscribe()
+            if asyncio.iscoroutine(result):
+                await result
+        except Exception as e:
+            logging.error(f"Resubscribing {self.source} failed: {e}")
+        return True
+
+    async def run(self, interval: float = CHECK_INTERVAL) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            await self.check()
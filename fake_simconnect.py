@@ -0,0 +1,442 @@
+"""
+Fake SimConnect for load testing the PMDG and CRJ bridges without the simulator.
+
+create_simconnect() builds the bridge's own SimConnectMobiFlight without
+loading SimConnect.dll and gives it a fake dll implementing
+MapClientDataNameToID, AddToClientDataDefinition, RequestClientData and
+RequestSystemState. A background thread plays the simulator: it calls
+my_dispatch_proc with SIMCONNECT_RECV_CLIENT_DATA buffers at a fixed rate for
+every requested client data area, honouring the CHANGED flag.
+
+It also serves simvars to AddToDataDefinition/RequestDataOnSimObject as
+SIMCONNECT_RECV_SIMOBJECT_DATA, with the values of synthetic_simvar and the
+CHANGED flag's epsilons, which is what the GNS530 app runs on with
+WINWING_CDU_FAKE_SIM=1.
+
+Run standalone, it drives a bridge against mobiflight_standin.py and reports
+the time spent in the dispatch thread, event loop lag and dropped frames:
+
+    python fake_simconnect.py --bridge pmdg737 --rate 120 --pattern single-cell --duration 30
+"""
+import argparse
+import asyncio
+import ctypes
+import json
+import logging
+import math
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from array import array
+from ctypes import wintypes
+from typing import Callable, Dict, List, Optional, Tuple
+
+from SimConnect.Enum import (SIMCONNECT_CLIENT_DATA_PERIOD, SIMCONNECT_CLIENT_DATA_REQUEST_FLAG,
+                             SIMCONNECT_DATA_DEFINITION_ID, SIMCONNECT_DATA_REQUEST_FLAG, SIMCONNECT_DATA_REQUEST_ID,
+                             SIMCONNECT_PERIOD, SIMCONNECT_RECV, SIMCONNECT_RECV_CLIENT_DATA, SIMCONNECT_RECV_ID,
+                             SIMCONNECT_RECV_SIMOBJECT_DATA, SIMCONNECT_RECV_SYSTEM_STATE)
+
+from cdu_bench import CrjInputs, Inputs, PmdgInputs
+from cdu_capture import rewrite_host
+from mobiflight_standin import percentiles
+
+PATTERNS = ["static", "single-cell", "full-page"]
+# frames generated per client data area, played in a loop
+PATTERN_FRAMES: int = 1024
+LOOP_LAG_INTERVAL: float = 0.01
+
+# wintypes.DWORD is a C long, 8 bytes on 64-bit Linux instead of 4 on Windows,
+# so the buffer has to be filled the way the bridge reads it back
+DWORD_IS_4_BYTES: bool = ctypes.sizeof(wintypes.DWORD) == 4
+
+
+class DllFunction:
+    """Callable with an argtypes attribute, so the bridges can patch it like a ctypes function."""
+
+    def __init__(self, function: Callable) -> None:
+        self.function = function
+        self.argtypes = None
+
+    def __call__(self, *args):
+        self.function(*args)
+        return 0
+
+
+class ClientDataArea:
+    def __init__(self, name: str) -> None:
+        self.name: str = name
+        self.define_id: Optional[int] = None
+        self.size: int = 0
+        self.request_id: int = 0
+        self.period: int = SIMCONNECT_CLIENT_DATA_PERIOD.SIMCONNECT_CLIENT_DATA_PERIOD_NEVER
+        self.flags: int = 0
+        self.frames: List[bytes] = []
+        self.position: int = 0
+        self.last_sent: Optional[bytes] = None
+        self.recv = SIMCONNECT_RECV_CLIENT_DATA()
+
+
+class SimObjectRequest:
+    def __init__(self, request_id: int, datums: List[Tuple[bytes, bytes, float]]) -> None:
+        self.request_id: int = request_id
+        # (name, units, epsilon) of each datum
+        self.datums: List[Tuple[bytes, bytes, float]] = datums
+        self.period: int = SIMCONNECT_PERIOD.SIMCONNECT_PERIOD_NEVER
+        self.flags: int = 0
+        self.define_id: int = 0
+        self.last_sent: Optional[List[float]] = None
+        self.recv = SIMCONNECT_RECV_SIMOBJECT_DATA()
+
+
+# fixed values of the synthetic simvars that do not move
+SIMVAR_VALUES: Dict[bytes, float] = {
+    b"COM ACTIVE FREQUENCY:1": 118.1, b"COM STANDBY FREQUENCY:1": 121.5,
+    b"NAV ACTIVE FREQUENCY:1": 110.5, b"NAV STANDBY FREQUENCY:1": 113.9,
+    # 1200 in BCD
+    b"TRANSPONDER CODE:1": 0x1200,
+}
+
+
+def synthetic_simvar(name: bytes, seconds: float) -> float:
+    """A slowly moving ground speed (m/s) and track (radians), SIMVAR_VALUES for the rest."""
+    if name == b"GPS GROUND SPEED":
+        return 60.0 + 5.0 * math.sin(seconds / 10.0)
+    if name == b"GPS GROUND MAGNETIC TRACK":
+        return (seconds * 0.01) % (2 * math.pi)
+    return float(SIMVAR_VALUES.get(name, 0.0))
+
+
+class FakeSim:
+    """Plays the simulator side of SimConnect for client data areas."""
+
+    def __init__(self, rate: float = 60.0, pattern: str = "single-cell", inputs: Optional[Inputs] = None,
+                 dword_elements: bool = False, aircraft: str = "") -> None:
+        self.rate: float = rate
+        self.pattern: str = pattern
+        self.inputs: Inputs = inputs or PmdgInputs()
+        # the CRJ bridge reads dwData element by element, PMDG takes its raw bytes
+        self.dword_elements: bool = dword_elements
+        self.aircraft: str = aircraft
+        self.areas: Dict[int, ClientDataArea] = {}
+        self.definitions: Dict[int, int] = {}
+        self.state_requests: List[int] = []
+        self.data_definitions: Dict[int, List[Tuple[bytes, bytes, float]]] = {}
+        self.simobject_requests: Dict[int, SimObjectRequest] = {}
+        self.simvar_values: Callable[[bytes, float], float] = synthetic_simvar
+        self.lock = threading.Lock()
+        self.simconnect = None
+        self.thread: Optional[threading.Thread] = None
+        self.stopped = threading.Event()
+        self.ticks: int = 0
+        self.dispatched: int = 0
+        self.unchanged: int = 0
+        self.dropped: int = 0
+        self.dispatch_us: List[float] = []
+        self.thread_cpu: float = 0.0
+
+    # --- the fake dll ---
+
+    def map_client_data_name(self, handle, name: bytes, client_data_id: int) -> None:
+        with self.lock:
+            self.areas.setdefault(client_data_id, ClientDataArea(name.decode()))
+
+    def add_to_client_data_definition(self, handle, define_id: int, offset: int, size: int, epsilon, datum_id) -> None:
+        with self.lock:
+            self.definitions[define_id] = self.definitions.get(define_id, 0) + size
+
+    def request_client_data(self, handle, client_data_id: int, request_id: int, define_id: int, period: int,
+                            flags: int, origin=0, interval=0, limit=0) -> None:
+        with self.lock:
+            area = self.areas.get(client_data_id)
+            if area is None:
+                raise RuntimeError(f"client data id {client_data_id:#x} was never mapped")
+            area.define_id, area.request_id = define_id, request_id
+            area.period, area.flags = period, flags
+            area.size = self.definitions.get(define_id, 0)
+            if period != SIMCONNECT_CLIENT_DATA_PERIOD.SIMCONNECT_CLIENT_DATA_PERIOD_NEVER and not area.frames:
+                seed = 530 + len([a for a in self.areas.values() if a.frames])
+                area.frames = self.inputs.cases(PATTERN_FRAMES, seed)[self.pattern]
+            area.last_sent = None
+
+    def request_system_state(self, handle, request_id: int, state: bytes) -> None:
+        with self.lock:
+            self.state_requests.append(request_id)
+
+    def add_to_data_definition(self, handle, define_id: int, name: bytes, units: bytes, datatype=0,
+                               epsilon: float = 0.0, datum_id=0) -> None:
+        with self.lock:
+            self.data_definitions.setdefault(int(define_id), []).append((name, units, float(epsilon)))
+
+    def request_data_on_sim_object(self, handle, request_id: int, define_id: int, object_id, period: int,
+                                   flags: int = 0, origin=0, interval=0, limit=0) -> None:
+        with self.lock:
+            request = SimObjectRequest(int(request_id), self.data_definitions.get(int(define_id), []))
+            request.define_id, request.period, request.flags = int(define_id), int(period), int(flags)
+            self.simobject_requests[request.request_id] = request
+
+    def ignore(self, *args) -> None:
+        pass
+
+    # --- the dispatch thread ---
+
+    def start(self, simconnect) -> None:
+        self.simconnect = simconnect
+        self.thread = threading.Thread(target=self.run, name="FakeSimConnect", daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def dispatch(self, recv) -> None:
+        started = time.perf_counter()
+        self.simconnect.my_dispatch_proc(ctypes.cast(ctypes.pointer(recv), ctypes.POINTER(SIMCONNECT_RECV)),
+                                         ctypes.sizeof(recv), None)
+        self.dispatch_us.append((time.perf_counter() - started) * 1e6)
+
+    def fill(self, area: ClientDataArea, frame: bytes) -> None:
+        recv = area.recv
+        recv.dwSize = ctypes.sizeof(recv)
+        recv.dwID = SIMCONNECT_RECV_ID.SIMCONNECT_RECV_ID_CLIENT_DATA
+        recv.dwRequestID = area.request_id
+        recv.dwDefineID = area.define_id
+        payload = frame[:area.size].ljust(area.size, b"\0")
+        if DWORD_IS_4_BYTES or not self.dword_elements:
+            ctypes.memmove(ctypes.addressof(recv.dwData), payload, len(payload))
+        else:
+            for index, value in enumerate(array("I", payload[:len(payload) // 4 * 4])):
+                recv.dwData[index] = value
+
+    def tick(self) -> None:
+        with self.lock:
+            state_requests, self.state_requests = self.state_requests, []
+            areas = [a for a in self.areas.values()
+                     if a.period != SIMCONNECT_CLIENT_DATA_PERIOD.SIMCONNECT_CLIENT_DATA_PERIOD_NEVER and a.frames]
+            simobject_requests = [r for r in self.simobject_requests.values()
+                                  if r.period != SIMCONNECT_PERIOD.SIMCONNECT_PERIOD_NEVER]
+        for request_id in state_requests:
+            state = SIMCONNECT_RECV_SYSTEM_STATE()
+            state.dwSize = ctypes.sizeof(state)
+            state.dwID = SIMCONNECT_RECV_ID.SIMCONNECT_RECV_ID_SYSTEM_STATE
+            state.dwRequestID = request_id
+            state.szString = self.aircraft.encode()
+            self.dispatch(state)
+        for area in areas:
+            frame = area.frames[area.position % len(area.frames)]
+            area.position += 1
+            if area.flags & SIMCONNECT_CLIENT_DATA_REQUEST_FLAG.SIMCONNECT_CLIENT_DATA_REQUEST_FLAG_CHANGED \
+                    and frame == area.last_sent:
+                self.unchanged += 1
+                continue
+            area.last_sent = frame
+            self.fill(area, frame)
+            self.dispatch(area.recv)
+            self.dispatched += 1
+            if area.period == SIMCONNECT_CLIENT_DATA_PERIOD.SIMCONNECT_CLIENT_DATA_PERIOD_ONCE:
+                area.period = SIMCONNECT_CLIENT_DATA_PERIOD.SIMCONNECT_CLIENT_DATA_PERIOD_NEVER
+        for request in simobject_requests:
+            self.send_simobject_data(request)
+
+    def send_simobject_data(self, request: SimObjectRequest) -> None:
+        seconds = self.ticks / self.rate
+        values = [self.simvar_values(name, seconds) for name, _, _ in request.datums]
+        if request.flags & SIMCONNECT_DATA_REQUEST_FLAG.SIMCONNECT_DATA_REQUEST_FLAG_CHANGED \
+                and request.last_sent is not None \
+                and all(abs(value - last) <= epsilon
+                        for value, last, (_, _, epsilon) in zip(values, request.last_sent, request.datums)):
+            self.unchanged += 1
+            return
+        request.last_sent = values
+        recv = request.recv
+        recv.dwSize = ctypes.sizeof(recv)
+        recv.dwID = SIMCONNECT_RECV_ID.SIMCONNECT_RECV_ID_SIMOBJECT_DATA
+        recv.dwRequestID = request.request_id
+        recv.dwDefineID = request.define_id
+        recv.dwDefineCount = len(values)
+        payload = (ctypes.c_double * len(values))(*values)
+        ctypes.memmove(ctypes.addressof(recv.dwData), payload, ctypes.sizeof(payload))
+        self.dispatch(recv)
+        self.dispatched += 1
+        if request.period == SIMCONNECT_PERIOD.SIMCONNECT_PERIOD_ONCE:
+            request.period = SIMCONNECT_PERIOD.SIMCONNECT_PERIOD_NEVER
+
+    def run(self) -> None:
+        period = 1.0 / self.rate
+        deadline = time.perf_counter()
+        while not self.stopped.is_set():
+            self.tick()
+            self.ticks += 1
+            deadline += period
+            late = time.perf_counter() - deadline
+            if late > 0:
+                # the sim doesn't wait for us, frames we were too slow for are lost
+                missed = int(late / period) + 1
+                self.dropped += missed
+                deadline += missed * period
+            else:
+                time.sleep(-late)
+        self.thread_cpu = time.thread_time()
+
+    def report(self) -> Dict:
+        return {
+            "rate_hz": self.rate,
+            "pattern": self.pattern,
+            "ticks": self.ticks,
+            "dispatched": self.dispatched,
+            "unchanged_skipped": self.unchanged,
+            "dropped": self.dropped,
+            "dispatch_us": percentiles(self.dispatch_us),
+            "dispatch_thread_cpu_s": round(self.thread_cpu, 3),
+        }
+
+
+class FakeSimConnectDll:
+    def __init__(self, sim: FakeSim) -> None:
+        self.MapClientDataNameToID = DllFunction(sim.map_client_data_name)
+        self.AddToClientDataDefinition = DllFunction(sim.add_to_client_data_definition)
+        self.RequestClientData = DllFunction(sim.request_client_data)
+        self.RequestSystemState = DllFunction(sim.request_system_state)
+        self.AddToDataDefinition = DllFunction(sim.add_to_data_definition)
+        self.RequestDataOnSimObject = DllFunction(sim.request_data_on_sim_object)
+        # what AircraftRequests calls besides, for setting simvars
+        self.RequestDataOnSimObjectType = DllFunction(sim.ignore)
+        self.SetDataOnSimObject = DllFunction(sim.ignore)
+        self.GetLastSentPacketID = DllFunction(sim.ignore)
+        self.ClearDataDefinition = DllFunction(sim.ignore)
+        # id enums SimConnect.new_def_id() and new_request_id() extend
+        self.DATA_DEFINITION_ID = SIMCONNECT_DATA_DEFINITION_ID
+        self.DATA_REQUEST_ID = SIMCONNECT_DATA_REQUEST_ID
+
+
+def create_simconnect(simconnect_class, sim: FakeSim):
+    """Returns a simconnect_class instance talking to sim instead of SimConnect.dll."""
+    simconnect = simconnect_class.__new__(simconnect_class)
+    # what SimConnect.__init__ and SimConnectMobiFlight.__init__ set up, minus the dll
+    simconnect.client_data_handlers = []
+    simconnect.Requests = {}
+    simconnect.Facilities = []
+    simconnect.dll = FakeSimConnectDll(sim)
+    simconnect.hSimConnect = None
+    simconnect.quit = 0
+    simconnect.ok = True
+    simconnect.running = True
+    simconnect.paused = False
+    if hasattr(simconnect_class, "request_aircraft_loaded"):
+        simconnect.aircraft_loaded = None
+    sim.start(simconnect)
+    return simconnect
+
+
+# --------- LOAD TEST -----------
+
+def bridge_clients(bridge: str, simconnect, host: str) -> List:
+    if bridge in ("pmdg737", "pmdg777"):
+        import pmdg_737_winwing_cdu
+        import pmdg_777_winwing_cdu
+        module = pmdg_737_winwing_cdu if bridge == "pmdg737" else pmdg_777_winwing_cdu
+        cdus = [(module.CAPTAIN_CDU_URL, module.PMDG_CDU_0_NAME, module.PMDG_CDU_0_ID, module.PMDG_CDU_0_DEFINITION),
+                (module.CO_PILOT_CDU_URL, module.PMDG_CDU_1_NAME, module.PMDG_CDU_1_ID, module.PMDG_CDU_1_DEFINITION)]
+        if hasattr(module, "PMDG_CDU_2_NAME"):
+            cdus.append((module.OBSERVER_CDU_URL, module.PMDG_CDU_2_NAME, module.PMDG_CDU_2_ID,
+                         module.PMDG_CDU_2_DEFINITION))
+        client_class = module.PMDGCDUClient
+    elif bridge == "crj":
+        import aerosoft_crj_winwing_cdu as crj
+        cdus = [(crj.CAPTAIN_CDU_URL, crj.CRJ_CDU_0_NAME, crj.CRJ_CDU_0_CLIENT_DATA_ID, crj.CRJ_CDU_0_DEFINITION),
+                (crj.CO_PILOT_CDU_URL, crj.CRJ_CDU_1_NAME, crj.CRJ_CDU_1_CLIENT_DATA_ID, crj.CRJ_CDU_1_DEFINITION)]
+        client_class = crj.CRJCDUClient
+    else:
+        raise ValueError(f"No fake SimConnect support for bridge {bridge}")
+    return [client_class(simconnect, rewrite_host(uri, host), name, cdu_id, definition)
+            for uri, name, cdu_id, definition in cdus]
+
+
+def simconnect_class_for(bridge: str):
+    if bridge == "crj":
+        from aerosoft_crj_winwing_cdu import SimConnectMobiFlight
+    elif bridge == "pmdg777":
+        from pmdg_777_winwing_cdu import SimConnectMobiFlight
+    else:
+        from pmdg_737_winwing_cdu import SimConnectMobiFlight
+    return SimConnectMobiFlight
+
+
+async def monitor_loop_lag(samples: List[float], interval: float = LOOP_LAG_INTERVAL) -> None:
+    """Appends how late, in ms, each sleep of the event loop woke up."""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        samples.append((loop.time() - started - interval) * 1000)
+
+
+def start_standin(port: int, duration: float, report: str) -> subprocess.Popen:
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mobiflight_standin.py")
+    return subprocess.Popen([sys.executable, script, "--port", str(port), "--duration", str(duration),
+                             "--report-interval", "3600", "--report", report],
+                            stderr=subprocess.DEVNULL)
+
+
+async def load_test(bridge: str, rate: float, pattern: str, duration: float, host: str) -> Dict:
+    sim = FakeSim(rate, pattern, CrjInputs() if bridge == "crj" else PmdgInputs(), dword_elements=bridge == "crj")
+    simconnect = create_simconnect(simconnect_class_for(bridge), sim)
+    clients = bridge_clients(bridge, simconnect, host)
+    lag: List[float] = []
+    tasks = [asyncio.create_task(client.run()) for client in clients]
+    monitor = asyncio.create_task(monitor_loop_lag(lag))
+    await asyncio.sleep(duration)
+    sim.stop()
+    # let the last frames go out before closing
+    await asyncio.sleep(0.2)
+    monitor.cancel()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(monitor, *tasks, return_exceptions=True)
+    for client in clients:
+        await client.mobiflight.close()
+    report = {"bridge": bridge, "duration_s": duration, "displays": len(clients), **sim.report(),
+              "loop_lag_ms": percentiles(lag)}
+    return report
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Drive the PMDG or CRJ bridge from a fake SimConnect")
+    parser.add_argument("--bridge", choices=["pmdg737", "pmdg777", "crj"], default="pmdg737")
+    parser.add_argument("--rate", type=float, default=60.0, help="frames per second per CDU, e.g. 60 to 300")
+    parser.add_argument("--pattern", choices=PATTERNS, default="single-cell")
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--host", help="MobiFlight host:port to use instead of starting a stand-in")
+    parser.add_argument("--port", type=int, default=8321, help="port of the stand-in started for the test")
+    parser.add_argument("--output", help="write the report as JSON to this file")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.WARNING,
+        format="%(asctime)s - %(levelname)s - %(message)s"
+    )
+    args = parse_args()
+    standin, standin_report = None, None
+    host = args.host
+    if host is None:
+        host = f"localhost:{args.port}"
+        standin_report = os.path.join(tempfile.mkdtemp(), "standin.json")
+        standin = start_standin(args.port, args.duration + 3, standin_report)
+        time.sleep(1.0)
+    report = asyncio.run(load_test(args.bridge, args.rate, args.pattern, args.duration, host))
+    if standin is not None:
+        standin.wait()
+        with open(standin_report) as file:
+            received = json.load(file)["endpoints"]
+        report["received"] = sum(endpoint["frames"] for endpoint in received.values())
+        report["invalid"] = sum(endpoint["invalid"] for endpoint in received.values())
+        report["undelivered"] = report["dispatched"] - report["received"]
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
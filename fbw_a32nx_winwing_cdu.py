@@ -1,13 +1,22 @@
 import asyncio
 from collections import deque
 from enum import IntEnum, StrEnum
+from functools import partial
 from itertools import chain
 import json
 import logging
 from math import ceil, floor
+import os
 import re
-from typing import Literal, Never, Optional, List, Dict, Union
+import time
+from typing import Awaitable, Callable, Literal, Never, Optional, List, Dict, Union
 import websockets.asyncio.client as ws_client
+from cdu_capture import CaptureWriter, open_capture_from_env
+from cdu_keys import ScratchpadEcho, echo_enabled, expects_update, parse_key_event
+from cdu_logging import setup_logging
+from cdu_metrics import metrics
+from cdu_profiler import start_control_from_env
+from cdu_watchdog import StreamWatchdog
 
 
 class MfCharSize(IntEnum):
@@ -37,6 +46,13 @@ CO_PILOT_CDU_URL: str = "ws://localhost:8320/winwing/cdu-co-pilot"
 # FlyByWire SimBridge MCDU WebSocket URL
 FBW_MCDU_URL: str = "ws://localhost:8380/interfaces/v1/mcdu"
 
+# Set to 1 to send CDU keys straight to SimBridge. Only with MobiFlight's own
+# key events for the A32NX switched off, otherwise every press arrives twice.
+FORWARD_KEYS_ENV: str = "WINWING_CDU_FBW_KEYS"
+
+# key presses waiting for the frame that answers them, per side
+PENDING_KEYS: int = 16
+
 # Display dimensions
 CDU_COLUMNS: int = 24
 CDU_ROWS: int = 14
@@ -65,6 +81,9 @@ class MobiFlightClient:
         self.websocket_uri: str = websocket_uri
         self.retries: int = 0
         self.max_retries: int = max_retries
+        self.watchdog: Optional[StreamWatchdog] = None
+        # called with each key pressed on this CDU and when it arrived
+        self.key_sink: Optional[Callable[[str, float], Awaitable[None]]] = None
 
     async def run(self) -> None:
         while self.retries < self.max_retries:
@@ -76,9 +95,19 @@ class MobiFlightClient:
                     )
                     logging.info("MobiFlight connected at %s", self.websocket_uri)
                     self.connected.set()
-                await self.websocket.recv()
+                message = await self.websocket.recv()
+                received = metrics.now()
+                key = parse_key_event(message)
+                if self.watchdog is not None and expects_update(key):
+                    # a key pressed on the CDU, the page should change soon
+                    self.watchdog.input_seen()
+                if key is not None and self.key_sink is not None:
+                    await self.key_sink(key, received)
+                # only wait after errors, the next key has to go through right away
+                continue
             except Exception as e:
                 self.retries += 1
+                metrics.count("reconnects")
                 logging.debug(f"Retrying MobiFlight websocket, attempt {self.retries}: {e}")
                 self.websocket = None
                 self.connected.clear()
@@ -90,9 +119,15 @@ class MobiFlightClient:
         )
         self.connected.set()
 
-    async def send(self, data: str) -> None:
+    async def send(self, data: str, queued: float = 0.0, frame: int = 0) -> None:
+        metrics.observe("queue", queued, frame)
         if self.websocket and self.connected.is_set():
+            started = metrics.now()
             await self.websocket.send(data)
+            metrics.observe("send", started, frame)
+            metrics.count("frames_out")
+        else:
+            metrics.count("frames_skipped")
 
     async def close(self) -> None:
         if self.websocket:
@@ -158,6 +193,7 @@ def parse_fbw_segment(
 
     format_stack: FormatStack = deque()
     tag = None
+    current_chars = normal_chars  # segments without any tag
 
     last_match_index = 0
     for match in FBW_TAG_REGEX.finditer(segment):
@@ -355,13 +391,28 @@ class FbwMcduClient:
     """Client for the FlyByWire MCDU WebSocket"""
 
     def __init__(
-        self, mobiflight_left: MobiFlightClient, mobiflight_right: MobiFlightClient
+        self,
+        mobiflight_left: MobiFlightClient,
+        mobiflight_right: MobiFlightClient,
+        capture: Optional[CaptureWriter] = None,
     ) -> None:
         self.mobiflight = dict(left=mobiflight_left, right=mobiflight_right)
         self.fbw_websocket = None
         self.last_mcdu_data: dict[Literal["left", "right"], dict] = dict()
         self.retries = 0
         self.max_retries = 10
+        self.capture: Optional[CaptureWriter] = capture
+        # SimBridge has no sim state, a requestUpdate is cheap enough to send on every quiet stretch
+        self.watchdog: StreamWatchdog = StreamWatchdog("simbridge", self.resubscribe)
+        self.update_requested: float = 0.0
+        self.forward_keys: bool = os.environ.get(FORWARD_KEYS_ENV, "") not in ("", "0")
+        self.pending_keys: Dict[str, deque] = {side: deque(maxlen=PENDING_KEYS) for side in self.mobiflight}
+        self.echo: Dict[str, ScratchpadEcho] = {
+            side: ScratchpadEcho(mobiflight.send, side) for side, mobiflight in self.mobiflight.items()
+        } if echo_enabled() else {}
+        for side, mobiflight in self.mobiflight.items():
+            mobiflight.watchdog = self.watchdog
+            mobiflight.key_sink = partial(self.press_key, side)
 
     async def connect_to_mcdu(self):
         """Connect to the FBW MCDU WebSocket"""
@@ -378,6 +429,7 @@ class FbwMcduClient:
                     return True
             except Exception as e:
                 self.retries += 1
+                metrics.count("reconnects")
                 logging.debug(f"Retrying SimBridge, attempt {self.retries}: {e}")
                 self.fbw_websocket = None
                 await asyncio.sleep(5)  # Wait before retry
@@ -386,6 +438,13 @@ class FbwMcduClient:
     async def run(self):
         """Main processing loop"""
         logging.info("Starting FlyByWire SimBridge client")
+        watchdog_task = asyncio.create_task(self.watchdog.run())
+        try:
+            await self.process_messages()
+        finally:
+            watchdog_task.cancel()
+
+    async def process_messages(self):
         while True:
             try:
                 # Wait for messages from the MCDU
@@ -398,39 +457,88 @@ class FbwMcduClient:
                         continue
 
                 msg = await self.fbw_websocket.recv()
-
-                # Process any update messages
-                if msg.startswith("update:"):
-                    data_json = json.loads(msg[msg.index(":") + 1:])
-
-                    for side in ("left", "right"):
-                        mobiflight = self.mobiflight.get(side)
-                        mcdu_data = data_json.get(side)
-                        if mobiflight is not None and mobiflight.is_connected():
-                            # only update if there is new data to display
-                            if (
-                                mcdu_data is not None
-                                and self.last_mcdu_data.get(side) != mcdu_data
-                            ):
-                                self.last_mcdu_data[side] = mcdu_data
-                                await mobiflight.send(create_mobi_json(mcdu_data))
-                            elif mcdu_data is None:
-                                self.last_mcdu_data[side] = None
-                                # clear the display
-                                await mobiflight.send(create_mobi_json(dict()))
-                        else:
-                            # make sure we get a refresh if we later connect
-                            self.last_mcdu_data[side] = None
+                if self.capture is not None:
+                    self.capture.record("simbridge", msg)
+                await self.handle_message(msg)
 
             except Exception as e:
                 logging.error(f"Error processing MCDU data: {e}")
                 self.fbw_websocket = None
                 await asyncio.sleep(5)
 
+    async def handle_message(self, msg: str) -> None:
+        received = metrics.now()
+        frame = metrics.frame()
+        metrics.count("frames_in")
+        # Process any update messages
+        if msg.startswith("update:"):
+            self.watchdog.updated()
+            data_json = json.loads(msg[msg.index(":") + 1:])
+            metrics.observe("decode", received, frame)
+
+            for side in ("left", "right"):
+                mobiflight = self.mobiflight.get(side)
+                mcdu_data = data_json.get(side)
+                if mobiflight is not None and mobiflight.is_connected():
+                    # only update if there is new data to display
+                    if (
+                        mcdu_data is not None
+                        and self.last_mcdu_data.get(side) != mcdu_data
+                    ):
+                        self.last_mcdu_data[side] = mcdu_data
+                        encode_started = metrics.now()
+                        mobi_json = create_mobi_json(mcdu_data)
+                        metrics.observe("encode", encode_started, frame)
+                        await mobiflight.send(self.reconcile_echo(side, mobi_json), frame=frame)
+                        self.answer_keys(side)
+                    elif mcdu_data is None:
+                        self.last_mcdu_data[side] = None
+                        # clear the display
+                        await mobiflight.send(self.reconcile_echo(side, create_mobi_json(dict())))
+                    else:
+                        metrics.count("frames_skipped")
+                else:
+                    # make sure we get a refresh if we later connect
+                    self.last_mcdu_data[side] = None
+        metrics.observe("receive", received, frame)
+
+    async def press_key(self, side: str, key: str, received: float) -> None:
+        if received:
+            self.pending_keys[side].append((key, received))
+        echo = self.echo.get(side)
+        if echo is not None:
+            await echo.key(key, received)
+        if not self.forward_keys or self.fbw_websocket is None:
+            return
+        try:
+            await self.fbw_websocket.send(f"event:{side}:{key}")
+        except Exception as e:
+            logging.error(f"Could not send key {key} to SimBridge: {e}")
+
+    def reconcile_echo(self, side: str, mobi_json: str) -> str:
+        echo = self.echo.get(side)
+        return echo.reconcile(mobi_json) if echo is not None else mobi_json
+
+    def answer_keys(self, side: str) -> None:
+        """Records the key to frame latency of the presses the frame just sent answers."""
+        pending = self.pending_keys[side]
+        while pending:
+            key, received = pending.popleft()
+            metrics.observe(f"key:{key}", received)
+
     async def request_update(self):
         if self.fbw_websocket is not None:
             await self.fbw_websocket.send("requestUpdate")
 
+    async def resubscribe(self) -> None:
+        if self.fbw_websocket is not None and self.update_requested > self.watchdog.last_update:
+            # the previous request went unanswered as well, the loop reconnects once the socket is closed
+            logging.warning("SimBridge did not answer, reconnecting")
+            await self.fbw_websocket.close()
+            return
+        await self.request_update()
+        self.update_requested = time.monotonic()
+
 
 async def request_update_on_connect(connected: asyncio.Event, fbw_client: FbwMcduClient):
     await connected.wait()
@@ -438,11 +546,11 @@ async def request_update_on_connect(connected: asyncio.Event, fbw_client: FbwMcd
 
 
 async def main():
-    logging.basicConfig(
-        level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
-    )
+    setup_logging(logging.INFO)
 
     logging.info("----STARTED FBW A32NX MCDU to WinWing CDU Integration----")
+    await metrics.start_from_env("fbw")
+    await start_control_from_env("fbw")
 
     mobiflight_left = MobiFlightClient(CAPTAIN_CDU_URL)
     mobiflight_right = MobiFlightClient(CO_PILOT_CDU_URL)
@@ -450,7 +558,8 @@ async def main():
     mobiflight_right_task = asyncio.create_task(mobiflight_right.run())
     mobiflight_clients = (mobiflight_left, mobiflight_right)
 
-    fbw_client = FbwMcduClient(*mobiflight_clients)
+    capture = open_capture_from_env("fbw")
+    fbw_client = FbwMcduClient(*mobiflight_clients, capture=capture)
     fbw_task = asyncio.create_task(fbw_client.run())
 
     # make sure we get an initial update when a CDU connects
@@ -459,7 +568,11 @@ async def main():
     ]
 
     # Wait for all to complete (they shouldn't unless there's an error)
-    await asyncio.gather(mobiflight_left_task, mobiflight_right_task, fbw_task, *update_request_tasks)
+    try:
+        await asyncio.gather(mobiflight_left_task, mobiflight_right_task, fbw_task, *update_request_tasks)
+    finally:
+        if capture is not None:
+            capture.close()
 
 
 if __name__ == "__main__":
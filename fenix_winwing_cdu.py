@@ -1,6 +1,6 @@
 import asyncio, os, json
 import xml.etree.ElementTree as ET
-import logging, logging.handlers
+import logging
 import websockets.asyncio.client as ws_client
 import websockets.exceptions
 
@@ -8,6 +8,12 @@ from gql import Client, gql
 from gql.transport.websockets import WebsocketsTransport
 from gql.transport.websockets import log as websockets_logger
 from inspect import getsourcefile
+from cdu_capture import open_capture_from_env
+from cdu_keys import ScratchpadEcho, echo_enabled, expects_update, parse_key_event
+from cdu_logging import setup_logging
+from cdu_metrics import metrics
+from cdu_profiler import start_control_from_env
+from cdu_watchdog import StreamWatchdog
 
 subs = {'#': '\u2610',    # ballot box
         '¤': '\u2191',    # up arrow
@@ -21,20 +27,6 @@ format_chars = ['s', 'l', 'a', 'c', 'y', 'w', 'g', 'm']
 
 BASE_PATH = os.path.dirname(os.path.abspath(getsourcefile(lambda:0)))
 
-def setup_logging(log_level, log_file_full_path):
-    base_path = os.path.dirname(log_file_full_path)
-    if base_path: os.makedirs(base_path, exist_ok=True)
-    log_formatter = logging.Formatter("%(asctime)s [%(threadName)-12.12s] [%(levelname)-5.5s]  %(message)s")
-    root_logger = logging.getLogger()
-    root_logger.setLevel(log_level)
-    file_handler = logging.handlers.RotatingFileHandler(log_file_full_path, maxBytes=500000, backupCount=7)
-    file_handler.setFormatter(log_formatter)
-    root_logger.addHandler(file_handler)
-    console_handler = logging.StreamHandler()
-    console_handler.setFormatter(log_formatter)
-    root_logger.addHandler(console_handler)
-
-
 def create_mobi_json(xml_string):   
     message =  {}
     message["Target"] = "Display"
@@ -60,12 +52,29 @@ def create_mobi_json(xml_string):
                 if char != ' ':
                     entry = [char, formatting, size]
                 message["Data"].append(entry)
-        logging.debug(child.text)   
-    logging.debug(message)
     return json.dumps(message, separators=(',', ':')) 
 
 
-async def run_fenix_graphql_client(mobi_client1, mobi_client2):
+async def handle_dataref(name, value, mobi_client1, mobi_client2):
+    received = metrics.now()
+    frame = metrics.frame()
+    metrics.count("frames_in")
+    if (name == "aircraft.mcdu1.display"):
+        mobi_client = mobi_client1
+    elif (name == "aircraft.mcdu2.display"):
+        mobi_client = mobi_client2
+    else:
+        metrics.observe("receive", received, frame)
+        return
+    encode_started = metrics.now()
+    mobi_json = create_mobi_json(value)
+    metrics.observe("encode", encode_started, frame)
+    # receive ends at the hand-off, the send is its own stage
+    metrics.observe("receive", received, frame)
+    await mobi_client.send_json_data(mobi_json, frame)
+
+
+async def run_fenix_graphql_client(mobi_client1, mobi_client2, capture=None):
     await asyncio.sleep(0.5)
     transport = WebsocketsTransport(url="ws://localhost:8083/graphql/")
     client = Client(transport=transport)
@@ -82,19 +91,39 @@ async def run_fenix_graphql_client(mobi_client1, mobi_client2):
         )
     params = {"names": ["aircraft.mcdu1.display", "aircraft.mcdu2.display"]}   
     session = await client.connect_async(reconnecting=True) 
-    while (True):
-        try:
-            async for result in session.subscribe(subscription, params, op_name):
-                if "dataRefs" in result:
-                    if (result["dataRefs"]["name"] == "aircraft.mcdu1.display"):
-                        mobi_json = create_mobi_json(result["dataRefs"]["value"])
-                        await mobi_client1.send_json_data(mobi_json)
-                    elif (result["dataRefs"]["name"] == "aircraft.mcdu2.display"):
-                        mobi_json = create_mobi_json(result["dataRefs"]["value"])
-                        await mobi_client2.send_json_data(mobi_json)              
-        except Exception as ex: 
-            logging.error(f"run_fenix_graphql_client: {ex}")  
-        await asyncio.sleep(5)
+
+    async def forward_datarefs():
+        async for result in session.subscribe(subscription, params, op_name):
+            if "dataRefs" in result:
+                watchdog.updated()
+                if capture is not None:
+                    capture.record(result["dataRefs"]["name"], result["dataRefs"]["value"])
+                await handle_dataref(result["dataRefs"]["name"], result["dataRefs"]["value"], mobi_client1, mobi_client2)
+
+    # the subscription only sends changes, so a quiet display is not refreshed, only restarted after key presses
+    subscription_task = None
+    watchdog = StreamWatchdog("graphql", lambda: subscription_task.cancel(), idle_refresh=None)
+    mobi_client1.watchdog = watchdog
+    mobi_client2.watchdog = watchdog
+    watchdog_task = asyncio.create_task(watchdog.run())
+    try:
+        while (True):
+            subscription_task = asyncio.create_task(forward_datarefs())
+            try:
+                await asyncio.wait([subscription_task])
+            finally:
+                subscription_task.cancel()
+            if subscription_task.cancelled():
+                # restarted by the watchdog
+                continue
+            if subscription_task.exception() is not None:
+                metrics.count("reconnects")
+                logging.error(f"run_fenix_graphql_client: {subscription_task.exception()}")  
+            await asyncio.sleep(5)
+    finally:
+        watchdog_task.cancel()
+        # release the subscription when cancelled, e.g. by the daemon switching aircraft
+        await client.close_async()
 
 
 class Mobiflight_Client:
@@ -103,6 +132,8 @@ class Mobiflight_Client:
         self.uri = uri
         self.id = id
         self.websocket_connection = None
+        self.watchdog = None
+        self.echo = ScratchpadEcho(self.send_display, id) if echo_enabled() else None
 
     async def run_mobiflight_websocket_client(self):  
         while (True):
@@ -111,7 +142,16 @@ class Mobiflight_Client:
                     self.websocket_connection = await ws_client.connect(self.uri)  
                     logging.info(f"Established connection to MobiFlight websocket interface for {self.id}.")   
                 # Wait for disconnection or data
-                await self.websocket_connection.recv()    
+                message = await self.websocket_connection.recv()    
+                received = metrics.now()
+                key = parse_key_event(message)
+                if self.watchdog is not None and expects_update(key):
+                    # a key pressed on the CDU, the page should change soon
+                    self.watchdog.input_seen()
+                if self.echo is not None and key is not None:
+                    await self.echo.key(key, received)
+                # only wait after errors, the next key has to go through right away
+                continue
             except websockets.exceptions.InvalidStatus as invalid:      
                 self.websocket_connection = None
                 if invalid.response.status_code == 501:
@@ -121,27 +161,47 @@ class Mobiflight_Client:
                 else:
                     logging.error(f"Error on trying to connect to MobiFlight websocket interface for {self.id}. Will retry: {invalid}")    
             except Exception as ex:            
+                metrics.count("reconnects")
                 logging.error(f"Error on trying to connect to MobiFlight websocket interface for {self.id}. Will retry: {ex}")                  
                 self.websocket_connection = None                                        
             await asyncio.sleep(5)
 
-    async def send_json_data(self, mobi_json):
+    async def send_json_data(self, mobi_json, frame=0):
+        if self.echo is not None:
+            mobi_json = self.echo.reconcile(mobi_json)
+        await self.send_display(mobi_json, frame)
+
+    async def send_display(self, mobi_json, frame=0):
         if self.websocket_connection is not None:
+            started = metrics.now()
             await self.websocket_connection.send(mobi_json)  
+            metrics.observe("send", started, frame)
+            metrics.count("frames_out")
+        else:
+            metrics.count("frames_skipped")
 
     
 
 async def main():   
     websockets_logger.setLevel(logging.WARNING)   
-    setup_logging(logging.INFO, os.path.join(BASE_PATH, 'logs/fenixMcduLogging.log'))    
+    setup_logging(logging.INFO, os.path.join(BASE_PATH, 'logs/fenixMcduLogging.log'),
+                  fmt="%(asctime)s [%(threadName)-12.12s] [%(levelname)-5.5s]  %(message)s")
     logging.info("----STARTED fenix_winwing_cdu.py----")   
+    await metrics.start_from_env("fenix")
+    await start_control_from_env("fenix")
     client1 = Mobiflight_Client("ws://localhost:8320/winwing/cdu-captain", "CDU-CAPTAIN")
     client2 = Mobiflight_Client("ws://localhost:8320/winwing/cdu-co-pilot", "CDU-CO-PILOT")  
     mobi_task = asyncio.create_task(client1.run_mobiflight_websocket_client())
     mobi_task2 = asyncio.create_task(client2.run_mobiflight_websocket_client())
-    fenix_task = asyncio.create_task(run_fenix_graphql_client(client1, client2))
-    await asyncio.gather(fenix_task, mobi_task, mobi_task2)
+    capture = open_capture_from_env("fenix")
+    fenix_task = asyncio.create_task(run_fenix_graphql_client(client1, client2, capture))
+    try:
+        await asyncio.gather(fenix_task, mobi_task, mobi_task2)
+    finally:
+        if capture is not None:
+            capture.close()
     
 
 # --------- MAIN -----------
-asyncio.run(main())
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -2,11 +2,14 @@ import asyncio
 import os
 import json
 import logging
-import logging.handlers
 import websockets.asyncio.client as ws_client
 import urllib.request
 import time
 import http.client
+from cdu_capture import open_capture_from_env
+from cdu_logging import setup_logging
+from cdu_metrics import metrics
+from cdu_profiler import start_control_from_env
 
 # FSL Color Mapping
 FSL_COLOR_MAP = {
@@ -41,9 +44,23 @@ FSL_LOG_FILE = "fsl_input_log.txt"  # Path to log file
 FSL_API_URL = "http://localhost:8080/MCDU/Display/3CA1"
 MOBIFLIGHT_WS_URI = "ws://localhost:8320/winwing/cdu-captain"
 mobi_websocket_connection = None
-data_queue = asyncio.Queue()  # Thread-safe async queue for MCDU updates
-
-async def fetch_fsl_mcdu():
+data_queue = asyncio.Queue()  # Thread-safe async queue for MCDU updates, (queued time, trace frame, JSON)
+
+async def handle_fsl_value(value_list, last_fetched_data, frame=0):
+    """Queue the converted MCDU data if it changed, returns the data to compare the next fetch against."""
+    encode_started = metrics.now()
+    parsed_data = parse_fsl_mcdu(value_list)
+    metrics.observe("encode", encode_started, frame)
+
+    if parsed_data != last_fetched_data:
+        await data_queue.put((metrics.now(), frame, parsed_data))  # Send to WebSocket
+    else:
+        metrics.count("frames_skipped")
+    #else:
+        #logging.info("No MCDU data change, skipping update.")
+    return parsed_data
+
+async def fetch_fsl_mcdu(capture=None):
     """Fetch MCDU data using a persistent HTTP connection, avoiding redundant updates."""
     last_fetched_data = None
 
@@ -51,23 +68,24 @@ async def fetch_fsl_mcdu():
 
     while True:
         try:
+            received = metrics.now()
             conn.request("GET", "/MCDU/Display/3CA1")
             response = conn.getresponse()
 
             if response.status == 200:
                 new_data = json.load(response)        
+                frame = metrics.frame()
+                metrics.observe("receive", received, frame)
+                metrics.count("frames_in")
                     
                 if "Value" in new_data:
-                    parsed_data = parse_fsl_mcdu(new_data["Value"])
-
-                    if parsed_data != last_fetched_data:
-                        last_fetched_data = parsed_data
-                        await data_queue.put(parsed_data)  # Send to WebSocket
-                    #else:
-                        #logging.info("No MCDU data change, skipping update.")
+                    if capture is not None:
+                        capture.record("mcdu", new_data["Value"])
+                    last_fetched_data = await handle_fsl_value(new_data["Value"], last_fetched_data, frame)
 
         except (http.client.HTTPException, TimeoutError) as ex:
             logging.error(f"fetch_fsl_mcdu: Timeout or HTTP error: {ex}")
+            metrics.count("reconnects")
             await asyncio.sleep(2)  # Increase delay after failure
             conn = http.client.HTTPConnection("localhost", 8080, timeout=1)  # Reset connection
 
@@ -80,10 +98,14 @@ async def fetch_fsl_mcdu():
 async def run_fsl_http_client():
     """Measure the time it takes to send updates to MobiFlight."""
     while True:
-        mobi_json = await data_queue.get()
+        queued, frame, mobi_json = await data_queue.get()
+        metrics.observe("queue", queued, frame)
 
         if mobi_json and mobi_websocket_connection:
+            started = metrics.now()
             await mobi_websocket_connection.send(mobi_json)
+            metrics.observe("send", started, frame)
+            metrics.count("frames_out")
 
 
 
@@ -103,6 +125,7 @@ async def run_mobiflight_websocket_client():
 
         except Exception as ex:
             logging.error(f"WebSocket Error: {ex}")
+            metrics.count("reconnects")
             mobi_websocket_connection = None
             await asyncio.sleep(2)
 
@@ -139,32 +162,24 @@ def parse_fsl_mcdu(value_list):
 
 async def main():
     """Main function to start both tasks."""
-    setup_logging(logging.WARNING, os.path.join(os.getcwd(), "logs/fslMcduLogging.log"))
+    setup_logging(logging.INFO, os.path.join(os.getcwd(), "logs/fslMcduLogging.log"),
+                  fmt="%(asctime)s [%(levelname)-5.5s]  %(message)s")
     logging.warning("---- STARTED FSLWinwingCduCaptain.py ----")
+    await metrics.start_from_env("fslabs")
+    await start_control_from_env("fslabs")
 
     # Start both tasks
-    fetch_task = asyncio.create_task(fetch_fsl_mcdu())
+    capture = open_capture_from_env("fslabs")
+    fetch_task = asyncio.create_task(fetch_fsl_mcdu(capture))
     process_task = asyncio.create_task(run_fsl_http_client())
     ws_task = asyncio.create_task(run_mobiflight_websocket_client())
 
-    await asyncio.gather(fetch_task, process_task, ws_task)
-
-def setup_logging(log_level, log_file_full_path):
-    """Setup logging to both file and console."""
-    os.makedirs(os.path.dirname(log_file_full_path), exist_ok=True)
-
-    log_formatter = logging.Formatter("%(asctime)s [%(levelname)-5.5s]  %(message)s")
-    root_logger = logging.getLogger()
-    root_logger.setLevel(logging.INFO)  # <--- Change from WARNING to INFO
-
-    file_handler = logging.handlers.RotatingFileHandler(log_file_full_path, maxBytes=500000, backupCount=7)
-    file_handler.setFormatter(log_formatter)
-    root_logger.addHandler(file_handler)
-
-    console_handler = logging.StreamHandler()
-    console_handler.setFormatter(log_formatter)
-    root_logger.addHandler(console_handler)
-
+    try:
+        await asyncio.gather(fetch_task, process_task, ws_task)
+    finally:
+        if capture is not None:
+            capture.close()
 
 # Run the async event loop
-asyncio.run(main())
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,619 @@
+"""
+Flight plan files for the GNS530 CDU app.
+
+FplDirectory keeps a listing of the flight plan folder with the size, mtime,
+format and departure/arrival of every plan. A background task stats the folder
+every POLL_INTERVAL and rescans it when its mtime changed, plus every
+RESCAN_INTERVAL, since Windows does not touch the folder mtime when a file in
+it is overwritten. Rendering only reads FplDirectory.files.
+
+HTML exports are read by a streaming html.parser extractor that stops after
+the flight plan table instead of building a BeautifulSoup tree of the whole
+page; `python gns530_fpl.py <files>` benchmarks it against BeautifulSoup.
+Little Navmap's own .lnmpln files are read with ElementTree.iterparse and give
+points with their type, region, position and altitude as well. PLAN_LOADERS
+holds the loader of each format in FORMATS. Spreadsheet plans (.xlsx) are
+streamed out of the zip with iterparse, without a spreadsheet library.
+
+Parsed plans are kept in a PlanCache, saved to PLAN_CACHE_FILE next to this
+script and valid while a file keeps its size and mtime. New and changed files
+are parsed in a process pool in the background, so selecting a plan is a
+dictionary lookup. Files whose name and head do not give the departure and
+arrival, such as spreadsheets, take them from the parsed plan.
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import itertools
+import json
+import logging
+import os
+import re
+import math
+import time
+import xml.etree.ElementTree as ET
+import zipfile
+from html.parser import HTMLParser
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+POLL_INTERVAL: float = 1.0
+RESCAN_INTERVAL: float = 10.0
+# how much of a file is searched for the departure and arrival
+HEAD_BYTES: int = 16384
+
+PLAN_CACHE_FILE: str = os.path.join(os.path.dirname(os.path.abspath(__file__)), "gns530_fpl_cache.json")
+# bumped whenever parsing changes, so plans from older parsers are not served from the cache
+PLAN_CACHE_VERSION: int = 3
+PARSE_WORKERS: int = 2
+# order of the point fields in the cache file, the ones after "wind" only some formats have
+POINT_FIELDS: Tuple[str, ...] = ("ident", "course", "legtime", "wind", "type", "region", "lat", "lon", "alt")
+
+# file extension -> format
+FORMATS: Dict[str, str] = {".html": "html", ".lnmpln": "lnmpln", ".xlsx": "xlsx"}
+
+ROUTE_REGEX = re.compile(r"\((\w{4})\).*?to.*?\((\w{4})\)", re.IGNORECASE | re.DOTALL)
+HTML_HEADING_REGEX = re.compile(r"<h1>(.*?)</h1>", re.IGNORECASE | re.DOTALL)
+H1_ROUTE_REGEX = re.compile(r".*\((\w{4})\)\s*to\s*.*\((\w{4})\)")
+TITLE_ROUTE_REGEX = re.compile(r".*\((\w{4})\).*to.*\((\w{4})\)")
+
+HTML_CHUNK: int = 16384
+# plan field -> texts in the header of its table column: Little Navmap's, then a Russian navigation log's
+PLAN_COLUMNS: Tuple[Tuple[str, Tuple[str, ...]], ...] = (
+    ("ident", ("Ident", "ППМ")),
+    ("course", ("Course", "Магнитный курс")),
+    ("legtime", ("Leg Time", "Между точками")),
+    ("wind", ("Head- or Tailwind", "Поправка к скорости")),
+)
+
+XLSX_NS: str = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+XLSX_REL_NS: str = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+XLSX_CELL_REGEX = re.compile(r"([A-Z]+)")
+
+
+class FplFileInfo(NamedTuple):
+    name: str
+    path: str
+    size: int
+    mtime: float
+    format: str
+    dep: Optional[str]
+    arr: Optional[str]
+
+
+def route_from_text(text: str) -> Tuple[Optional[str], Optional[str]]:
+    m = ROUTE_REGEX.search(text)
+    return (m.group(1).upper(), m.group(2).upper()) if m else (None, None)
+
+
+def read_route(path: str, name: str, fmt: str) -> Tuple[Optional[str], Optional[str]]:
+    """Departure and arrival from the Little Navmap style file name, else from the head of the file."""
+    dep, arr = route_from_text(name)
+    if dep or fmt != "html":
+        return dep, arr
+    try:
+        with open(path, "r", encoding="utf-8", errors="replace") as f:
+            head = f.read(HEAD_BYTES)
+    except OSError:
+        return None, None
+    m = HTML_HEADING_REGEX.search(head)
+    return route_from_text(m.group(1)) if m else (None, None)
+
+
+class PlanCache:
+    """Parsed plans by path, with the size and mtime of the file they were parsed from."""
+
+    def __init__(self, path: str = PLAN_CACHE_FILE) -> None:
+        self.path: str = path
+        # path -> (size, mtime, plan or None if the file could not be parsed)
+        self.plans: Dict[str, Tuple[int, float, Optional[Dict]]] = {}
+        self.dirty: bool = False
+
+    def get(self, info: FplFileInfo) -> Tuple[bool, Optional[Dict]]:
+        """Returns whether the plan is cached and the plan."""
+        entry = self.plans.get(info.path)
+        if entry is None or entry[0] != info.size or entry[1] != info.mtime:
+            return False, None
+        return True, entry[2]
+
+    def put(self, info: FplFileInfo, plan: Optional[Dict]) -> None:
+        self.plans[info.path] = (info.size, info.mtime, plan)
+        self.dirty = True
+
+    def prune(self, files: List[FplFileInfo]) -> None:
+        paths = {info.path for info in files}
+        for path in [path for path in self.plans if path not in paths]:
+            del self.plans[path]
+            self.dirty = True
+
+    def load(self) -> None:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                cached = json.load(f)
+            if cached.get("version") != PLAN_CACHE_VERSION:
+                return
+            for path, (size, mtime, plan) in cached["plans"].items():
+                if plan is not None:
+                    plan["points"] = [{field: value for field, value in zip(POINT_FIELDS, point) if value is not None}
+                                      for point in plan["points"]]
+                self.plans[path] = (size, mtime, plan)
+        except (OSError, ValueError, TypeError) as e:
+            if not isinstance(e, FileNotFoundError):
+                logging.warning(f"Не удалось прочитать кэш планов {self.path}: {e}")
+
+    def save(self) -> None:
+        if not self.dirty:
+            return
+        plans = {}
+        for path, (size, mtime, plan) in self.plans.items():
+            if plan is not None:
+                plan = {**plan, "points": [[point.get(field) for field in POINT_FIELDS] for point in plan["points"]]}
+            plans[path] = [size, mtime, plan]
+        try:
+            with open(self.path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump({"version": PLAN_CACHE_VERSION, "plans": plans}, f, ensure_ascii=False, separators=(",", ":"))
+            os.replace(self.path + ".tmp", self.path)
+            self.dirty = False
+        except OSError as e:
+            logging.warning(f"Не удалось записать кэш планов {self.path}: {e}")
+
+
+class FplDirectory:
+    def __init__(self, directory: str, plans: Optional[PlanCache] = None) -> None:
+        self.directory: str = directory
+        # replaced as a whole by scan(), so the render loop can read it from any thread
+        self.files: List[FplFileInfo] = []
+        self.by_name: Dict[str, FplFileInfo] = {}
+        self.dir_mtime: Optional[float] = None
+        self.plans: Optional[PlanCache] = plans
+        self.executor: Optional[concurrent.futures.Executor] = None
+        # called on the event loop when watch() sees the listing change
+        self.on_change: Optional[Callable[[], None]] = None
+
+    def scan(self) -> bool:
+        """Reads the folder, returns whether the listing changed. Blocking."""
+        found: Dict[str, FplFileInfo] = {}
+        try:
+            self.dir_mtime = os.stat(self.directory).st_mtime
+            with os.scandir(self.directory) as entries:
+                for entry in entries:
+                    fmt = FORMATS.get(os.path.splitext(entry.name)[1].lower())
+                    if fmt is None or not entry.is_file():
+                        continue
+                    st = entry.stat()
+                    info = self.by_name.get(entry.name)
+                    if info is None or info.size != st.st_size or info.mtime != st.st_mtime:
+                        dep, arr = read_route(entry.path, entry.name, fmt)
+                        info = FplFileInfo(entry.name, entry.path, st.st_size, st.st_mtime, fmt, dep, arr)
+                    found[entry.name] = info
+        except OSError as e:
+            self.dir_mtime = None
+            logging.error(f"Ошибка чтения директории файлов: {e}")
+        files = sorted(found.values(), key=lambda info: info.name)
+        changed = files != self.files
+        self.by_name, self.files = found, files
+        if changed:
+            logging.info(f"Список планов обновлён: {len(files)} файлов")
+        return self.fill_routes() or changed
+
+    def fill_routes(self) -> bool:
+        """Takes the departure and arrival read_route could not find from the parsed plans, returns whether any was."""
+        if self.plans is None:
+            return False
+        filled: Dict[str, FplFileInfo] = {}
+        for info in self.files:
+            if info.dep is None:
+                plan = self.plans.get(info)[1]
+                if plan is not None and plan.get("dep") and plan.get("arr"):
+                    filled[info.name] = info._replace(dep=plan["dep"], arr=plan["arr"])
+        if not filled:
+            return False
+        by_name = {**self.by_name, **filled}
+        self.by_name, self.files = by_name, sorted(by_name.values(), key=lambda info: info.name)
+        return True
+
+    def dir_changed(self) -> bool:
+        try:
+            return os.stat(self.directory).st_mtime != self.dir_mtime
+        except OSError:
+            return self.dir_mtime is not None
+
+    async def watch(self, poll_interval: float = POLL_INTERVAL, rescan_interval: float = RESCAN_INTERVAL) -> None:
+        loop = asyncio.get_running_loop()
+        last_scan = loop.time()
+        await self.preparse()
+        while True:
+            await asyncio.sleep(poll_interval)
+            if loop.time() - last_scan >= rescan_interval or await asyncio.to_thread(self.dir_changed):
+                if await asyncio.to_thread(self.scan):
+                    if self.on_change is not None:
+                        self.on_change()
+                    await self.preparse()
+                last_scan = loop.time()
+
+    def parse_executor(self) -> Optional[concurrent.futures.Executor]:
+        """A process pool, as BeautifulSoup holds the GIL; None (the default thread pool) where there is none."""
+        if self.executor is None:
+            try:
+                self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=PARSE_WORKERS)
+            except (OSError, NotImplementedError) as e:
+                logging.warning(f"Пул процессов недоступен, планы разбираются в потоках: {e}")
+        return self.executor
+
+    async def preparse(self) -> None:
+        """Parses the plans not in the cache yet in the background and saves the cache."""
+        if self.plans is None:
+            return
+        files = self.files
+        missing = [info for info in files if not self.plans.get(info)[0]]
+        if missing:
+            loop = asyncio.get_running_loop()
+            executor = self.parse_executor()
+            results = await asyncio.gather(
+                *(loop.run_in_executor(executor, parse_fpl_file, info.path) for info in missing),
+                return_exceptions=True)
+            for info, plan in zip(missing, results):
+                if isinstance(plan, BaseException):
+                    # a broken pool or worker says nothing about the file, parse it again when selected
+                    logging.error(f"Ошибка фонового разбора {info.path}: {plan!r}")
+                    continue
+                self.plans.put(info, plan)
+            logging.info(f"Разобрано планов в фоне: {len(missing)}")
+            if self.fill_routes() and self.on_change is not None:
+                self.on_change()
+        self.plans.prune(files)
+        await asyncio.to_thread(self.plans.save)
+
+    def load_plan(self, info: FplFileInfo) -> Optional[Dict]:
+        """The parsed plan, from the cache unless the file is too new to have been parsed in the background."""
+        if self.plans is not None:
+            cached, plan = self.plans.get(info)
+            if cached:
+                return plan
+        plan = parse_fpl_file(info.path)
+        if self.plans is not None:
+            self.plans.put(info, plan)
+        return plan
+
+
+def safe_str(s):
+    return s if isinstance(s, str) else str(s or "")
+
+
+def plan_columns(headers: List[str]) -> Dict[str, int]:
+    """Column of the plan fields found. The first header containing a name wins, "RelatedIdent" comes after "Ident"."""
+    columns: Dict[str, int] = {}
+    for i, header in enumerate(headers):
+        for field, names in PLAN_COLUMNS:
+            if field not in columns and any(name in header for name in names):
+                columns[field] = i
+    return columns
+
+
+def plan_from_table(dep: Optional[str], arr: Optional[str], headers: List[str], rows: List[List[str]]) -> Dict:
+    """The plan from the cell texts of a flight plan table, rows not counting the header row."""
+    columns = plan_columns(headers)
+    if len(columns) < len(PLAN_COLUMNS):
+        raise ValueError("Table columns not found")
+    idx_ident, idx_course, idx_legtime, idx_wind = (columns[field] for field, _ in PLAN_COLUMNS)
+    points = []
+    for tds in rows:
+        if len(tds) <= max(idx_ident, idx_course, idx_legtime, idx_wind):
+            continue
+        ident = safe_str(tds[idx_ident])
+        course = safe_str(tds[idx_course]).replace(',', '.')
+        legtime = safe_str(tds[idx_legtime])
+        wind = safe_str(tds[idx_wind])
+        if ident:
+            if not course or not course.replace('.', '', 1).isdigit():
+                course = "---"
+            if not legtime:
+                legtime = "--:--"
+            points.append({
+                "ident": ident[:8],
+                "course": course,
+                "legtime": legtime,
+                "wind": wind
+            })
+    if not points or not dep or not arr:
+        raise ValueError("Not enough data in file")
+    return {"dep": dep, "arr": arr, "points": points}
+
+
+class PlanTableParser(HTMLParser):
+    """
+    Collects the <title>, the first <h1> and the cell texts of the first <table>
+    from parser events, done once that table is closed. Cell texts are joined
+    from stripped pieces like BeautifulSoup's get_text(strip=True).
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.title: str = ""
+        self.h1: str = ""
+        self.headers: List[str] = []
+        self.rows: List[List[str]] = []
+        self.done: bool = False
+        # "title" or "h1" while inside one, their text is kept
+        self.text_tag: Optional[str] = None
+        self.h1_seen: bool = False
+        self.table_depth: int = 0
+        self.cell: Optional[List[str]] = None
+        self.cell_tag: str = ""
+
+    def handle_starttag(self, tag: str, attrs) -> None:
+        if self.table_depth:
+            if tag == "table":
+                self.table_depth += 1
+            elif self.table_depth == 1:
+                if tag == "tr":
+                    self.end_cell()
+                    self.rows.append([])
+                elif tag in ("td", "th"):
+                    self.end_cell()
+                    self.cell, self.cell_tag = [], tag
+        elif tag == "table" and not self.done:
+            self.table_depth = 1
+        elif tag == "title" or (tag == "h1" and not self.h1_seen):
+            self.text_tag = tag
+
+    def handle_endtag(self, tag: str) -> None:
+        if self.table_depth:
+            if tag == "table":
+                self.table_depth -= 1
+                if not self.table_depth:
+                    self.end_cell()
+                    self.done = True
+            elif tag in ("td", "th", "tr") and self.table_depth == 1:
+                self.end_cell()
+        elif tag == self.text_tag:
+            if tag == "h1":
+                self.h1_seen = True
+            self.text_tag = None
+
+    def handle_data(self, data: str) -> None:
+        if self.cell is not None:
+            self.cell.append(data.strip())
+        elif self.text_tag == "title":
+            self.title += data
+        elif self.text_tag == "h1":
+            self.h1 += data
+
+    def end_cell(self) -> None:
+        if self.cell is None:
+            return
+        text = "".join(self.cell)
+        if self.cell_tag == "th":
+            self.headers.append(text)
+        elif self.rows:
+            self.rows[-1].append(text)
+        self.cell = None
+
+
+def route_from_headings(h1: str, title: str) -> Tuple[Optional[str], Optional[str]]:
+    m = H1_ROUTE_REGEX.match(h1) or TITLE_ROUTE_REGEX.match(title)
+    return (m.group(1), m.group(2)) if m else (None, None)
+
+
+def parse_html_plan(filepath: str) -> Dict:
+    """Reads a Little Navmap HTML export up to the end of its flight plan table."""
+    parser = PlanTableParser()
+    with open(filepath, "r", encoding="utf-8") as f:
+        while not parser.done:
+            chunk = f.read(HTML_CHUNK)
+            if not chunk:
+                break
+            parser.feed(chunk)
+    if not parser.done:
+        if not parser.table_depth:
+            raise ValueError("No table in file")
+        parser.end_cell()
+    dep, arr = route_from_headings(parser.h1, parser.title)
+    return plan_from_table(dep, arr, parser.headers, parser.rows[1:])
+
+
+def initial_course(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """Great circle course from the first position to the second in degrees true."""
+    lat1, lat2, dlon = math.radians(lat1), math.radians(lat2), math.radians(lon2 - lon1)
+    x = math.sin(dlon) * math.cos(lat2)
+    y = math.cos(lat1) * math.sin(lat2) - math.sin(lat1) * math.cos(lat2) * math.cos(dlon)
+    return math.degrees(math.atan2(x, y)) % 360
+
+
+def parse_lnmpln_plan(filepath: str) -> Dict:
+    """
+    Reads a Little Navmap .lnmpln file. The file has no leg times or winds, and
+    courses are worked out from the positions, so they are true, not magnetic.
+    """
+    points = []
+    procedures: Dict[str, Dict[str, str]] = {}
+    cruise_alt = None
+    prev = None
+    for _, elem in ET.iterparse(filepath, events=("end",)):
+        tag = elem.tag
+        if tag == "Waypoint":
+            ident = elem.findtext("Ident")
+            if ident:
+                point = {"ident": ident[:8], "course": "---", "legtime": "--:--", "wind": "",
+                         "type": elem.findtext("Type", ""), "region": elem.findtext("Region", "")}
+                pos = elem.find("Pos")
+                if pos is not None and pos.get("Lat") and pos.get("Lon"):
+                    point["lat"], point["lon"] = float(pos.get("Lat")), float(pos.get("Lon"))
+                    if pos.get("Alt"):
+                        point["alt"] = round(float(pos.get("Alt")))
+                    if prev is not None:
+                        point["course"] = str(round(initial_course(prev[0], prev[1], point["lat"], point["lon"])) % 360)
+                    prev = (point["lat"], point["lon"])
+                points.append(point)
+            elem.clear()
+        elif tag in ("SID", "STAR", "Approach"):
+            procedures[tag] = {child.tag: child.text or "" for child in elem}
+        elif tag == "CruisingAlt" and elem.text:
+            cruise_alt = int(float(elem.text))
+    if len(points) < 2:
+        raise ValueError("Not enough data in file")
+    return {"dep": points[0]["ident"], "arr": points[-1]["ident"], "points": points,
+            "procedures": procedures, "cruise_alt": cruise_alt}
+
+
+def xlsx_column(ref: str) -> int:
+    """Zero based column of a cell reference such as "AB12"."""
+    column = 0
+    for letter in XLSX_CELL_REGEX.match(ref).group(1):
+        column = column * 26 + ord(letter) - ord("A") + 1
+    return column - 1
+
+
+def xlsx_shared_strings(book: zipfile.ZipFile) -> List[str]:
+    strings: List[str] = []
+    try:
+        source = book.open("xl/sharedStrings.xml")
+    except KeyError:
+        return strings
+    with source:
+        for _, elem in ET.iterparse(source):
+            if elem.tag == XLSX_NS + "si":
+                strings.append("".join(t.text or "" for t in elem.iter(XLSX_NS + "t")))
+                elem.clear()
+    return strings
+
+
+def xlsx_first_sheet(book: zipfile.ZipFile) -> str:
+    """Name of the first worksheet of the workbook in the zip."""
+    sheet = ET.fromstring(book.read("xl/workbook.xml")).find(f"{XLSX_NS}sheets/{XLSX_NS}sheet")
+    rel_id = sheet.get(XLSX_REL_NS + "id") if sheet is not None else None
+    for rel in ET.fromstring(book.read("xl/_rels/workbook.xml.rels")):
+        if rel.get("Id") == rel_id:
+            target = rel.get("Target", "")
+            return target.lstrip("/") if target.startswith("/") else "xl/" + target
+    return "xl/worksheets/sheet1.xml"
+
+
+def xlsx_cell_text(cell: ET.Element, strings: List[str]) -> str:
+    kind = cell.get("t")
+    if kind == "inlineStr":
+        return "".join(t.text or "" for t in cell.iter(XLSX_NS + "t")).strip()
+    value = cell.findtext(XLSX_NS + "v")
+    if value is None:
+        return ""
+    if kind == "s":
+        return strings[int(value)].strip()
+    return value.strip()
+
+
+def parse_xlsx_plan(filepath: str) -> Dict:
+    """
+    Reads the waypoint table from the first sheet of an .xlsx plan. The header row is the
+    first row naming the ident and course columns, the rows below it without an ident
+    continue its headers, and the table ends at the first row without an ident after it.
+    Numeric leg times are minutes; formulas the sheet was saved without results for stay empty.
+    """
+    with zipfile.ZipFile(filepath) as book:
+        strings = xlsx_shared_strings(book)
+        headers: Optional[List[str]] = None
+        ident_column = 0
+        rows: List[List[str]] = []
+        with book.open(xlsx_first_sheet(book)) as sheet:
+            for _, elem in ET.iterparse(sheet):
+                if elem.tag != XLSX_NS + "row":
+                    continue
+                cells: Dict[int, str] = {}
+                for index, cell in enumerate(elem.iter(XLSX_NS + "c")):
+                    ref = cell.get("r")
+                    text = xlsx_cell_text(cell, strings)
+                    if text:
+                        cells[xlsx_column(ref) if ref else index] = text
+                elem.clear()
+                row = [cells.get(column, "") for column in range(max(cells, default=-1) + 1)]
+                if headers is None:
+                    columns = plan_columns(row)
+                    if "ident" in columns and "course" in columns:
+                        headers, ident_column = row, columns["ident"]
+                elif len(row) > ident_column and row[ident_column]:
+                    # "UNOY - Novinki": the ident, then the name
+                    row[ident_column] = row[ident_column].split(" - ")[0]
+                    rows.append(row + [""] * (len(headers) - len(row)))
+                elif rows:
+                    break
+                else:
+                    headers = [" ".join(filter(None, texts)) for texts in itertools.zip_longest(headers, row)]
+    if headers is None:
+        raise ValueError("Table columns not found")
+    legtime_column = plan_columns(headers).get("legtime")
+    if legtime_column is not None:
+        for row in rows:
+            if len(row) > legtime_column and row[legtime_column].replace(".", "", 1).isdigit():
+                minutes = round(float(row[legtime_column]))
+                row[legtime_column] = f"{minutes // 60}:{minutes % 60:02d}"
+    dep = rows[0][ident_column] if rows else None
+    arr = rows[-1][ident_column] if rows else None
+    return plan_from_table(dep, arr, headers, rows)
+
+
+# format -> loader
+PLAN_LOADERS: Dict[str, Callable[[str], Dict]] = {
+    "html": parse_html_plan,
+    "lnmpln": parse_lnmpln_plan,
+    "xlsx": parse_xlsx_plan,
+}
+
+
+def parse_plan(filepath: str) -> Dict:
+    fmt = FORMATS.get(os.path.splitext(filepath)[1].lower())
+    if fmt is None:
+        raise ValueError("Unknown plan format")
+    return PLAN_LOADERS[fmt](filepath)
+
+
+def parse_fpl_file(filepath):
+    try:
+        return parse_plan(filepath)
+    except Exception as e:
+        logging.error(f"Ошибка разбора плана {filepath}: {e}")
+        return None
+
+
+def parse_fpl_file_soup(filepath: str) -> Dict:
+    """The BeautifulSoup tree parser parse_html_plan replaced, kept to check and benchmark it against."""
+    from bs4 import BeautifulSoup
+
+    with open(filepath, "r", encoding="utf-8") as f:
+        soup = BeautifulSoup(f, "html.parser")
+    h1, title = soup.find("h1"), soup.find("title")
+    dep, arr = route_from_headings(h1.text if h1 else "", title.text if title else "")
+    table = soup.find("table")
+    if not table:
+        raise ValueError("No table in file")
+    headers = [th.get_text(strip=True) for th in table.find_all("th")]
+    rows = [[td.get_text(strip=True) for td in tr.find_all("td")] for tr in table.find_all("tr")[1:]]
+    return plan_from_table(dep, arr, headers, rows)
+
+
+def bench(files: List[str], repeat: int) -> None:
+    for path in files:
+        results = {}
+        parsers = (("soup", parse_fpl_file_soup), ("stream", parse_html_plan))
+        if not path.lower().endswith(".html"):
+            parsers = (("plan", parse_plan),)
+        for name, parse in parsers:
+            times = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                results[name] = parse(path)
+                times.append(time.perf_counter() - started)
+            times.sort()
+            print(f"{os.path.basename(path)}: {name:6} median {times[len(times) // 2] * 1000:7.2f} ms, "
+                  f"best {times[0] * 1000:7.2f} ms, {len(results[name]['points'])} points")
+        if len(results) > 1 and results["soup"] != results["stream"]:
+            print(f"{os.path.basename(path)}: the parsers disagree")
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark the flight plan loaders, HTML against BeautifulSoup")
+    parser.add_argument("files", nargs="+", help="flight plan files")
+    parser.add_argument("--repeat", type=int, default=20)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    bench(args.files, args.repeat)
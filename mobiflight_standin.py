@@ -0,0 +1,265 @@
+"""
+Local stand-in for the MobiFlight WinWing CDU websocket interface.
+
+Accepts the bridges on /winwing/cdu-captain, /winwing/cdu-co-pilot and
+/winwing/cdu-observer, answers 501 for endpoints marked inactive (as MobiFlight
+does for a CDU that isn't attached), validates and timestamps every display
+frame and optionally mirrors one screen in the terminal.
+
+Paired with 'cdu_capture.py replay --feed-log', it computes the source to
+display latency of each frame:
+
+    python mobiflight_standin.py --port 8321 --feed-log feeds.jsonl --report standin.json
+    python cdu_capture.py replay capture.wwcap --host localhost:8321 --feed-log feeds.jsonl
+"""
+import argparse
+import asyncio
+import bisect
+import hashlib
+import http
+import json
+import logging
+import sys
+import time
+from typing import Dict, List, Optional, Tuple
+
+from websockets.asyncio.server import serve
+from websockets.exceptions import ConnectionClosed
+
+ENDPOINTS: Dict[str, str] = {
+    "/winwing/cdu-captain": "captain",
+    "/winwing/cdu-co-pilot": "co-pilot",
+    "/winwing/cdu-observer": "observer",
+}
+
+CDU_COLUMNS: int = 24
+CDU_ROWS: int = 14
+CDU_CELLS: int = CDU_COLUMNS * CDU_ROWS
+
+COLOURS = set("aocgekmrwy")
+
+# ANSI foreground colours for the terminal mirror
+ANSI_COLOURS: Dict[str, str] = {
+    "a": "33", "o": "34", "c": "36", "g": "32", "e": "90",
+    "k": "33", "m": "35", "r": "31", "w": "37", "y": "93",
+}
+MIRROR_INTERVAL: float = 0.05
+
+
+def frame_digest(message: str) -> str:
+    return hashlib.sha1(message.encode()).hexdigest()
+
+
+def validate_frame(frame) -> Optional[str]:
+    """Returns why a decoded frame doesn't match the MobiFlight display schema, or None."""
+    if not isinstance(frame, dict) or frame.get("Target") != "Display":
+        return "Target is not Display"
+    data = frame.get("Data")
+    if not isinstance(data, list) or len(data) != CDU_CELLS:
+        return f"Data has {len(data) if isinstance(data, list) else 'no'} cells instead of {CDU_CELLS}"
+    for index, cell in enumerate(data):
+        if cell == []:
+            continue
+        if not isinstance(cell, list) or len(cell) != 3:
+            return f"cell {index} is not [char, colour, size]: {cell!r}"
+        char, colour, size = cell
+        if not isinstance(char, str) or len(char) != 1:
+            return f"cell {index} has character {char!r}"
+        if colour not in COLOURS:
+            return f"cell {index} has colour {colour!r}"
+        if size not in (0, 1):
+            return f"cell {index} has size {size!r}"
+    return None
+
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {}
+    values = sorted(values)
+
+    def at(fraction: float) -> float:
+        return round(values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))], 3)
+
+    return {"count": len(values), "p50": at(0.5), "p90": at(0.9), "p99": at(0.99), "max": round(values[-1], 3)}
+
+
+def pair_latencies(feeds: List[Dict], arrivals: List[Tuple[str, str, int]]) -> List[float]:
+    """Matches each arrival with the latest feed of the same frame before it, returns latencies in ms."""
+    feed_times: Dict[Tuple[str, str], List[int]] = {}
+    for feed in feeds:
+        feed_times.setdefault((feed["endpoint"], feed["sha1"]), []).append(feed["t_ns"])
+    for times in feed_times.values():
+        times.sort()
+    latencies = []
+    for endpoint, digest, arrived_ns in arrivals:
+        times = feed_times.get((endpoint, digest))
+        if not times:
+            continue
+        position = bisect.bisect_right(times, arrived_ns) - 1
+        if position >= 0:
+            latencies.append((arrived_ns - times[position]) / 1e6)
+    return latencies
+
+
+def load_feed_log(path: str) -> List[Dict]:
+    with open(path) as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+class EndpointStats:
+    def __init__(self) -> None:
+        self.frames: int = 0
+        self.invalid: int = 0
+        self.connections: int = 0
+        self.bytes: int = 0
+        self.first_ns: Optional[int] = None
+        self.last_ns: Optional[int] = None
+        self.last_error: Optional[str] = None
+
+    def as_dict(self) -> Dict:
+        elapsed = (self.last_ns - self.first_ns) / 1e9 if self.first_ns and self.last_ns else 0.0
+        return {
+            "frames": self.frames,
+            "invalid": self.invalid,
+            "connections": self.connections,
+            "bytes": self.bytes,
+            "fps": round(self.frames / elapsed, 1) if elapsed else 0.0,
+            "last_error": self.last_error,
+        }
+
+
+class MobiFlightStandIn:
+    def __init__(self, inactive: Optional[List[str]] = None, mirror: Optional[str] = None,
+                 keep_arrivals: bool = True) -> None:
+        self.inactive = set(inactive or [])
+        self.mirror: Optional[str] = mirror
+        self.keep_arrivals: bool = keep_arrivals
+        self.stats: Dict[str, EndpointStats] = {name: EndpointStats() for name in ENDPOINTS.values()}
+        self.arrivals: List[Tuple[str, str, int]] = []
+        self.connections: Dict[str, set] = {name: set() for name in ENDPOINTS.values()}
+        self.last_mirror: float = 0.0
+
+    def process_request(self, connection, request):
+        name = ENDPOINTS.get(request.path)
+        if name is None:
+            return connection.respond(http.HTTPStatus.NOT_FOUND, "unknown endpoint\n")
+        if name in self.inactive:
+            return connection.respond(http.HTTPStatus.NOT_IMPLEMENTED, "not active\n")
+        return None
+
+    async def handler(self, connection) -> None:
+        path = connection.request.path
+        name = ENDPOINTS[path]
+        stats = self.stats[name]
+        stats.connections += 1
+        self.connections[name].add(connection)
+        logging.info("%s connected from %s", name, connection.remote_address)
+        try:
+            async for message in connection:
+                self.on_message(path, name, message)
+        except ConnectionClosed:
+            pass
+        finally:
+            self.connections[name].discard(connection)
+            logging.info("%s disconnected", name)
+
+    def on_message(self, path: str, name: str, message) -> None:
+        arrived_ns = time.time_ns()
+        stats = self.stats[name]
+        if isinstance(message, bytes):
+            message = message.decode()
+        stats.frames += 1
+        stats.bytes += len(message)
+        stats.first_ns = stats.first_ns or arrived_ns
+        stats.last_ns = arrived_ns
+        try:
+            frame = json.loads(message)
+            error = validate_frame(frame)
+        except ValueError as e:
+            frame, error = None, f"invalid JSON: {e}"
+        if error is not None:
+            stats.invalid += 1
+            if error != stats.last_error:
+                logging.warning("Invalid frame on %s: %s", name, error)
+            stats.last_error = error
+        if self.keep_arrivals:
+            self.arrivals.append((path, frame_digest(message), arrived_ns))
+        if error is None and name == self.mirror and time.monotonic() - self.last_mirror > MIRROR_INTERVAL:
+            self.last_mirror = time.monotonic()
+            self.draw(frame["Data"])
+
+    def draw(self, cells: List) -> None:
+        lines = ["\x1b[H\x1b[2J"]
+        for row in range(CDU_ROWS):
+            line = ""
+            for cell in cells[row * CDU_COLUMNS:(row + 1) * CDU_COLUMNS]:
+                if cell:
+                    char, colour, size = cell
+                    style = ANSI_COLOURS.get(colour, "37") + (";2" if size else ";1")
+                    line += f"\x1b[{style}m{char}\x1b[0m"
+                else:
+                    line += " "
+            lines.append(line)
+        sys.stdout.write("\n".join(lines) + "\n")
+        sys.stdout.flush()
+
+    def summary(self, feed_log: Optional[str] = None) -> Dict:
+        result = {"endpoints": {name: stats.as_dict() for name, stats in self.stats.items()}}
+        if feed_log:
+            result["latency_ms"] = percentiles(pair_latencies(load_feed_log(feed_log), self.arrivals))
+        return result
+
+    async def report_periodically(self, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            for name, stats in self.stats.items():
+                if stats.frames:
+                    logging.info("%s: %s", name, stats.as_dict())
+
+
+async def run_standin(host: str, port: int, standin: MobiFlightStandIn, duration: Optional[float],
+                      report_interval: float) -> None:
+    async with serve(standin.handler, host, port, process_request=standin.process_request,
+                     ping_interval=None, max_size=None):
+        logging.info("MobiFlight stand-in listening on ws://%s:%d", host, port)
+        reporter = asyncio.create_task(standin.report_periodically(report_interval))
+        try:
+            if duration is None:
+                await asyncio.Future()
+            else:
+                await asyncio.sleep(duration)
+        finally:
+            reporter.cancel()
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Local stand-in for the MobiFlight WinWing CDU websockets")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8320)
+    parser.add_argument("--inactive", action="append", choices=list(ENDPOINTS.values()), default=[],
+                        help="answer 501 for this CDU, like MobiFlight does when it isn't attached")
+    parser.add_argument("--mirror", choices=list(ENDPOINTS.values()), help="draw this CDU in the terminal")
+    parser.add_argument("--duration", type=float, help="stop after this many seconds")
+    parser.add_argument("--report-interval", type=float, default=10.0)
+    parser.add_argument("--feed-log", help="feed log written by cdu_capture.py replay, to compute latencies")
+    parser.add_argument("--report", help="write the summary as JSON to this file")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s - %(levelname)s - %(message)s",
+        stream=sys.stderr,
+    )
+    standin = MobiFlightStandIn(args.inactive, args.mirror)
+    try:
+        asyncio.run(run_standin(args.host, args.port, standin, args.duration, args.report_interval))
+    except KeyboardInterrupt:
+        pass
+    summary = standin.summary(args.feed_log)
+    logging.info("Summary: %s", json.dumps(summary))
+    if args.report:
+        with open(args.report, "w") as file:
+            json.dump(summary, file, indent=2)
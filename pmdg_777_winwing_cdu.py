@@ -1,14 +1,21 @@
-import copy
 from ctypes import wintypes
 import ctypes
 import json
 import logging
 import asyncio
+import concurrent.futures
 import os
 import websockets.asyncio.client as ws_client
-from typing import Optional, List, Dict, Union, Any
+from typing import Optional, List, Dict, Union, Any, Awaitable
 from SimConnect import SimConnect, Enum
 from SimConnect.Enum import SIMCONNECT_CLIENT_DATA_ID, SIMCONNECT_RECV_ID, SIMCONNECT_RECV_CLIENT_DATA
+from cdu_capture import CaptureWriter, open_capture_from_env
+from cdu_keys import expects_update, parse_key_event
+from cdu_logging import setup_logging
+from cdu_metrics import metrics
+from cdu_profiler import start_control_from_env
+from cdu_startup import StartupTimeline, find_work_paths, save_path_cache
+from cdu_watchdog import StreamWatchdog
 
 
 class SimConnectMobiFlight(SimConnect):
@@ -86,6 +93,7 @@ class MobiFlightClient:
         self.websocket_uri: str = websocket_uri
         self.retries: int = 0
         self.max_retries: int = max_retries
+        self.watchdog: Optional[StreamWatchdog] = None
 
     async def run(self) -> None:
         while self.retries < self.max_retries:
@@ -95,9 +103,13 @@ class MobiFlightClient:
                     self.websocket = await ws_client.connect(self.websocket_uri, ping_interval=None)
                     logging.info("MobiFlight connected at %s", self.websocket_uri)
                     self.connected.set()
-                await self.websocket.recv()
+                message = await self.websocket.recv()
+                if self.watchdog is not None and expects_update(parse_key_event(message)):
+                    # a key pressed on the CDU, the page should change soon
+                    self.watchdog.input_seen()
             except Exception as e: 
                 self.retries += 1
+                metrics.count("reconnects")
                 logging.info(f"WebSocket error: {e} with retries {self.retries}")
                 self.websocket = None
                 self.connected.clear()
@@ -105,9 +117,15 @@ class MobiFlightClient:
         logging.info("Max retries reached. Giving up connecting to MobiFlight at %s. If you only have one CDU attached, you can ignore this message.", self.websocket_uri)
         self.connected.set()
 
-    async def send(self, data: str) -> None:
+    async def send(self, data: str, queued: float = 0.0, frame: int = 0) -> None:
+        metrics.observe("queue", queued, frame)
         if self.websocket and self.connected.is_set():
+            started = metrics.now()
             await self.websocket.send(data)
+            metrics.observe("send", started, frame)
+            metrics.count("frames_out")
+        else:
+            metrics.count("frames_skipped")
 
     async def close(self) -> None:
         if self.websocket:
@@ -173,20 +191,29 @@ def create_mobi_json(data: bytes) -> str:
     return json.dumps(message)
 
 class PMDGCDUClient:
-    def __init__(self, sc_mobiflight: SimConnectMobiFlight, websocket_uri: str, cdu_name: str, cdu_id: int, cdu_definition: int) -> None:
-        self.sc_mobiflight: SimConnectMobiFlight = sc_mobiflight
+    def __init__(self, sc_mobiflight: Optional[SimConnectMobiFlight], websocket_uri: str, cdu_name: str, cdu_id: int, cdu_definition: int, timeline: Optional[StartupTimeline] = None, capture: Optional[CaptureWriter] = None) -> None:
+        self.sc_mobiflight: Optional[SimConnectMobiFlight] = sc_mobiflight
         self.mobiflight: MobiFlightClient = MobiFlightClient(websocket_uri)
         self.event_loop: Optional[asyncio.AbstractEventLoop] = None
         self.cdu_definition: int = cdu_definition
         self.cdu_name: str = cdu_name
         self.cdu_id: int = cdu_id
+        self.client_data_mapped: bool = False
+        self.timeline: Optional[StartupTimeline] = timeline
+        self.capture: Optional[CaptureWriter] = capture
+        # sends handed to the event loop and sends finished, each only written by one thread
+        self.sends_queued: int = 0
+        self.sends_done: int = 0
+        self.watchdog: StreamWatchdog = StreamWatchdog(cdu_name, self.resubscribe, self.sim_running)
+        self.mobiflight.watchdog = self.watchdog
 
     def failed_to_connect(self) -> bool:
         return self.mobiflight.retries >= self.mobiflight.max_retries
 
-    def setup_simconnect(self) -> bool:
-        try:
-            # Map and define the CDU data area
+    def map_client_data(self) -> None:
+        # Map and define the CDU data area only once per SimConnect session,
+        # a second AddToClientDataDefinition would grow the definition
+        if not self.client_data_mapped:
             self.sc_mobiflight.dll.MapClientDataNameToID(
                 self.sc_mobiflight.hSimConnect, 
                 self.cdu_name.encode(), 
@@ -201,17 +228,14 @@ class PMDGCDUClient:
                 0,
                 0
             )
+            self.client_data_mapped = True
+
+    def setup_simconnect(self) -> bool:
+        try:
+            self.map_client_data()
 
             # Request data updates
-            self.sc_mobiflight.dll.RequestClientData(
-                self.sc_mobiflight.hSimConnect,
-                self.cdu_id,
-                self.cdu_id,
-                self.cdu_definition,
-                Enum.SIMCONNECT_CLIENT_DATA_PERIOD.SIMCONNECT_CLIENT_DATA_PERIOD_VISUAL_FRAME,
-                Enum.SIMCONNECT_CLIENT_DATA_REQUEST_FLAG.SIMCONNECT_CLIENT_DATA_REQUEST_FLAG_CHANGED,
-                0, 0, 0
-            )
+            self.request_client_data(Enum.SIMCONNECT_CLIENT_DATA_PERIOD.SIMCONNECT_CLIENT_DATA_PERIOD_VISUAL_FRAME)
 
             # Set up the handler
             self.sc_mobiflight.register_client_data_handler(self.handle_cdu_data)
@@ -221,29 +245,87 @@ class PMDGCDUClient:
             logging.error(f"SimConnect setup failed for {self.cdu_name}: {e}")
             return False
 
+    def teardown_simconnect(self) -> None:
+        """Stop the CDU data stream while keeping the SimConnect session open."""
+        try:
+            self.sc_mobiflight.unregister_client_data_handler(self.handle_cdu_data)
+            self.request_client_data(Enum.SIMCONNECT_CLIENT_DATA_PERIOD.SIMCONNECT_CLIENT_DATA_PERIOD_NEVER)
+            logging.info("SimConnect stopped for %s", self.cdu_name)
+        except Exception as e:
+            logging.error(f"SimConnect teardown failed for {self.cdu_name}: {e}")
+
+    def request_client_data(self, period: int) -> None:
+        self.sc_mobiflight.dll.RequestClientData(
+            self.sc_mobiflight.hSimConnect,
+            self.cdu_id,
+            self.cdu_id,
+            self.cdu_definition,
+            period,
+            Enum.SIMCONNECT_CLIENT_DATA_REQUEST_FLAG.SIMCONNECT_CLIENT_DATA_REQUEST_FLAG_CHANGED,
+            0, 0, 0
+        )
+
+    def resubscribe(self) -> None:
+        self.request_client_data(Enum.SIMCONNECT_CLIENT_DATA_PERIOD.SIMCONNECT_CLIENT_DATA_PERIOD_VISUAL_FRAME)
+
+    def sim_running(self) -> bool:
+        return self.sc_mobiflight is not None and self.sc_mobiflight.running and not self.sc_mobiflight.paused
+
     def handle_cdu_data(self, client_data: Any) -> None:
         try:
             if client_data.dwDefineID == self.cdu_definition and hasattr(client_data, 'dwData'):
+                received: float = metrics.now()
+                frame: int = metrics.frame()
+                metrics.count("frames_in")
+                self.watchdog.updated()
                 data: bytes = bytes(client_data.dwData)
+                metrics.observe("decode", received, frame)
                 if len(data) >= CDU_COLUMNS * CDU_ROWS * 3:
-                    asyncio.run_coroutine_threadsafe(self.mobiflight.send(create_mobi_json(data)), self.event_loop)
+                    if self.capture is not None:
+                        self.capture.record(self.cdu_name, data[:CDU_COLUMNS * CDU_ROWS * 3])
+                    encode_started: float = metrics.now()
+                    mobi_json: str = create_mobi_json(data)
+                    metrics.observe("encode", encode_started, frame)
+                    future = asyncio.run_coroutine_threadsafe(self.mobiflight.send(mobi_json, metrics.now(), frame), self.event_loop)
+                    self.sends_queued += 1
+                    future.add_done_callback(self.send_done)
+                    if self.timeline is not None:
+                        self.timeline.mark(f"first frame {self.cdu_name}")
+                metrics.observe("receive", received, frame)
         except Exception as e:
             logging.error(f"Error handling CDU data: {e}")
 
-    async def run(self) -> None:
+    def send_done(self, future: concurrent.futures.Future) -> None:
+        self.sends_done += 1
+        if not future.cancelled() and future.exception() is not None:
+            logging.error(f"Sending to MobiFlight failed for {self.cdu_name}: {future.exception()}")
+
+    def pending_sends(self) -> int:
+        return self.sends_queued - self.sends_done
+
+    async def run(self, simconnect_ready: Optional[Awaitable[SimConnectMobiFlight]] = None) -> None:
         self.event_loop = asyncio.get_running_loop()
         logging.info("Starting CDU client")
         
         try:
-            # Start MobiFlight connection
+            # Start MobiFlight connection and map the client data area while it connects
             mobiflight_task: asyncio.Task = asyncio.create_task(self.mobiflight.run())
+            if simconnect_ready is not None:
+                self.sc_mobiflight = await simconnect_ready
+                self.map_client_data()
             await self.mobiflight.connected.wait()
             if self.failed_to_connect():
                 logging.info("Failed to connect to MobiFlight for %s", self.cdu_name)
                 return
+            if self.timeline is not None:
+                self.timeline.mark(f"MobiFlight {self.cdu_name}")
             # Initialize SimConnect
             if self.setup_simconnect():
-                await asyncio.gather(mobiflight_task)
+                watchdog_task: asyncio.Task = asyncio.create_task(self.watchdog.run())
+                try:
+                    await asyncio.gather(mobiflight_task)
+                finally:
+                    watchdog_task.cancel()
             else:
                 logging.error("Failed to start - SimConnect initialization failed")
         except KeyboardInterrupt:
@@ -259,36 +341,16 @@ class PMDGConfiguration:
         "pmdg-aircraft-77w",
         "pmdg-aircraft-77f"
     ]
+    sdk_keys = ['EnableDataBroadcast', 'EnableCDUBroadcast.0', 'EnableCDUBroadcast.1', 'EnableCDUBroadcast.2']
 
     def verify_sdk_config(self):
         """Verify and potentially update the SDK configuration in the options file."""
-        # Determine the correct path based on MS Store or Steam installation
-        base_path = None
-        ms_store_path = os.path.join(
-            os.environ.get("LOCALAPPDATA", ""),
-            "Packages",
-            "Microsoft.FlightSimulator_8wekyb3d8bbwe",
-            "LocalState",
-            "packages",
-        )
-
-        steam_path = os.path.join(
-            os.environ.get("APPDATA", ""), "Microsoft Flight Simulator", "Packages"
-        )
-
-        paths = [ms_store_path, steam_path]
-
-        for directory in self.directories:
-            for path in paths:
-                if os.path.exists(path):
-                    base_path = os.path.join(path, directory, "work")
-                    if os.path.exists(base_path):
-                        self.process_config(base_path)
-
-
-    def process_config(self, base_path: str):
-        logging.info(f"Processing config for {base_path}")
+        work_paths, cache = find_work_paths(self.config_name, self.directories)
+        for base_path in work_paths:
+            self.process_config(base_path, cache["verified"])
+        save_path_cache(self.config_name, cache)
 
+    def process_config(self, base_path: str, verified: Optional[Dict[str, float]] = None):
         options_path = os.path.join(base_path,  self.config_name)
 
         # Check if options file exists
@@ -296,25 +358,30 @@ class PMDGConfiguration:
             logging.warning(f"Options file not found: {options_path}")
             return
 
-        # Check if SDK configuration is present
-        config = self.parse_ini_file(options_path)
+        # Skip the parse if the file is unchanged since it was last verified
+        mtime = os.path.getmtime(options_path)
+        if verified is not None and verified.get(options_path) == mtime:
+            logging.info(f"SDK configuration already verified for {base_path}")
+            return
 
-        original_config = copy.deepcopy(config)
+        logging.info(f"Processing config for {base_path}")
 
+        # Check if SDK configuration is present
+        config = self.parse_ini_file(options_path)
 
-        if 'SDK' not in config:
-            config['SDK'] = {}
-        sdk = config["SDK"]
-        sdk['EnableDataBroadcast'] = 1
-        sdk['EnableCDUBroadcast.0'] = 1
-        sdk['EnableCDUBroadcast.1'] = 1
-        sdk['EnableCDUBroadcast.2'] = 1
+        sdk = config.setdefault('SDK', {})
+        missing = [key for key in self.sdk_keys if sdk.get(key) != 1]
+        for key in missing:
+            sdk[key] = 1
 
-        if original_config != config:
+        if missing:
             logging.info("Updating SDK configuration")
             self.write_ini_file(config, options_path)
+            mtime = os.path.getmtime(options_path)
         else:
             logging.info("No changes to SDK configuration needed")
+        if verified is not None:
+            verified[options_path] = mtime
 
     def parse_ini_file(self, file_path):
         config = {}
@@ -367,27 +434,41 @@ class PMDGConfiguration:
                 file.write("\n")  # Add blank line between sections
 
 if __name__ == "__main__":
-    logging.basicConfig(
-        level=logging.INFO,
-        format='%(asctime)s - %(levelname)s - %(message)s'
-    )
+    setup_logging(logging.INFO, fmt='%(asctime)s - %(threadName)s - %(levelname)s - %(message)s')
 
-    ini_configurator = PMDGConfiguration()
-    ini_configurator.verify_sdk_config()
-    
-    sc_mobiflight: SimConnectMobiFlight = SimConnectMobiFlight()
-    captain_client: PMDGCDUClient = PMDGCDUClient(sc_mobiflight, CAPTAIN_CDU_URL, PMDG_CDU_0_NAME, PMDG_CDU_0_ID, PMDG_CDU_0_DEFINITION)
-    co_pilot_client: PMDGCDUClient = PMDGCDUClient(sc_mobiflight, CO_PILOT_CDU_URL, PMDG_CDU_1_NAME, PMDG_CDU_1_ID, PMDG_CDU_1_DEFINITION)
-    observer_client: PMDGCDUClient = PMDGCDUClient(sc_mobiflight, OBSERVER_CDU_URL, PMDG_CDU_2_NAME, PMDG_CDU_2_ID, PMDG_CDU_2_DEFINITION)
+    timeline: StartupTimeline = StartupTimeline()
+    sc_mobiflight: Optional[SimConnectMobiFlight] = None
+
+    async def open_simconnect() -> SimConnectMobiFlight:
+        global sc_mobiflight
+        # the constructor blocks until the sim answers, so open it in a worker thread
+        sc_mobiflight = await timeline.track("SimConnect", asyncio.to_thread(SimConnectMobiFlight))
+        return sc_mobiflight
 
     async def run_clients():
-        await asyncio.gather(
-            captain_client.run(), 
-            co_pilot_client.run(),
-            observer_client.run(),
-            return_exceptions=True
-        )
-    # this will not work
+        await metrics.start_from_env("pmdg777")
+        await start_control_from_env("pmdg777")
+        capture: Optional[CaptureWriter] = open_capture_from_env("pmdg777")
+        # INI verification, SimConnect and the MobiFlight connections all start at once
+        ini_configurator = PMDGConfiguration()
+        ini_task = asyncio.create_task(timeline.track("SDK config", asyncio.to_thread(ini_configurator.verify_sdk_config)))
+        simconnect_ready = asyncio.ensure_future(open_simconnect())
+
+        captain_client: PMDGCDUClient = PMDGCDUClient(None, CAPTAIN_CDU_URL, PMDG_CDU_0_NAME, PMDG_CDU_0_ID, PMDG_CDU_0_DEFINITION, timeline, capture)
+        co_pilot_client: PMDGCDUClient = PMDGCDUClient(None, CO_PILOT_CDU_URL, PMDG_CDU_1_NAME, PMDG_CDU_1_ID, PMDG_CDU_1_DEFINITION, timeline, capture)
+        observer_client: PMDGCDUClient = PMDGCDUClient(None, OBSERVER_CDU_URL, PMDG_CDU_2_NAME, PMDG_CDU_2_ID, PMDG_CDU_2_DEFINITION, timeline, capture)
+        try:
+            await asyncio.gather(
+                ini_task,
+                captain_client.run(simconnect_ready), 
+                co_pilot_client.run(simconnect_ready),
+                observer_client.run(simconnect_ready),
+                return_exceptions=True
+            )
+        finally:
+            if capture is not None:
+                capture.close()
+
     try:
         asyncio.run(run_clients())
     except KeyboardInterrupt:
@@ -395,4 +476,5 @@ if __name__ == "__main__":
     except Exception as e:
         logging.error(f"Error: {e}")
     finally:
-        sc_mobiflight.exit()
+        if sc_mobiflight is not None:
+            sc_mobiflight.exit()
@@ -0,0 +1,441 @@
+"""
+Shared SimConnect broker for local tools.
+
+The broker owns the one SimConnect session and serves simvars and client data
+areas to any number of local clients over a line based JSON socket on
+localhost. Every simvar (name and units) and every client data area gets one
+upstream subscription however many clients want it, requested with the
+CHANGED flag, and each update is fanned out to the subscribers. A simvar is
+requested with the smallest epsilon any subscriber asked for and every client
+only gets the changes bigger than its own epsilon. Upstream requests stop when
+the last subscriber leaves and are replayed after SimConnect reconnects.
+
+Client to broker, one JSON object per line:
+
+    {"op": "subscribe", "simvars": [{"key": "GS", "name": "GPS GROUND SPEED",
+                                     "units": "Meters per second", "epsilon": 0.1}],
+                        "client_data": [{"name": "PMDG_NG3_CDU_0", "size": 2048}]}
+    {"op": "set", "name": "TRANSPONDER CODE:1", "units": "BCO16", "value": 4608}
+    {"op": "status"}
+
+Broker to client:
+
+    {"op": "simvars", "values": {"GS": 61.2}}
+    {"op": "client_data", "name": "PMDG_NG3_CDU_0", "data": "<base64>"}
+    {"op": "status", ...}
+
+BrokerClient is the client side. --fake-sim runs the broker on fake_simconnect
+for testing without the simulator:
+
+    python simvar_broker.py --port 8360 --fake-sim
+"""
+import argparse
+import asyncio
+import base64
+import ctypes
+import json
+import logging
+from ctypes import wintypes
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from SimConnect import SimConnect
+from SimConnect.Constants import SIMCONNECT_OBJECT_ID_USER, SIMCONNECT_UNUSED
+from SimConnect.Enum import (SIMCONNECT_CLIENT_DATA_ID, SIMCONNECT_CLIENT_DATA_PERIOD,
+                             SIMCONNECT_CLIENT_DATA_REQUEST_FLAG, SIMCONNECT_DATA_REQUEST_FLAG, SIMCONNECT_DATATYPE,
+                             SIMCONNECT_PERIOD, SIMCONNECT_RECV_ID, SIMCONNECT_RECV_SIMOBJECT_DATA)
+
+from cdu_logging import setup_logging
+
+BROKER_ENV: str = "WINWING_CDU_BROKER"
+BROKER_PORT: int = 8360
+SIMCONNECT_RETRY_INTERVAL: float = 5.0
+# updates queued for a client that does not read are dropped beyond this
+CLIENT_BUFFER_LIMIT: int = 1 << 20
+# client data area and definition ids handed out by the broker
+CLIENT_DATA_ID_BASE: int = 0x57570100
+DATA_OFFSET: int = SIMCONNECT_RECV_SIMOBJECT_DATA.dwData.offset
+
+SimvarKey = Tuple[str, str]
+
+
+def broker_address(value: str) -> Tuple[str, int]:
+    """host:port or a port from WINWING_CDU_BROKER."""
+    host, _, port = value.rpartition(":")
+    return host or "localhost", int(port)
+
+
+class BrokerSimConnect(SimConnect):
+    """SimConnect handing SIMOBJECT_DATA and CLIENT_DATA to data_handler on the dispatch thread."""
+
+    def __init__(self, auto_connect=True, library_path=None):
+        self.data_handler: Optional[Callable] = None
+        if library_path:
+            super().__init__(auto_connect, library_path)
+        else:
+            super().__init__(auto_connect)
+        # Fix missing types
+        self.dll.MapClientDataNameToID.argtypes = [wintypes.HANDLE, ctypes.c_char_p, SIMCONNECT_CLIENT_DATA_ID]
+
+    def my_dispatch_proc(self, pData, cbData, pContext):
+        dwID = pData.contents.dwID
+        if dwID in (SIMCONNECT_RECV_ID.SIMCONNECT_RECV_ID_SIMOBJECT_DATA,
+                    SIMCONNECT_RECV_ID.SIMCONNECT_RECV_ID_CLIENT_DATA) and self.data_handler is not None:
+            self.data_handler(ctypes.cast(pData, ctypes.POINTER(SIMCONNECT_RECV_SIMOBJECT_DATA)).contents)
+        else:
+            super().my_dispatch_proc(pData, cbData, pContext)
+
+
+class Upstream:
+    """One SimConnect subscription and the clients that want it."""
+
+    def __init__(self, request_id: int) -> None:
+        self.request_id: int = request_id
+        self.subscribers: Set["BrokerConnection"] = set()
+        self.last = None
+
+
+class SimvarUpstream(Upstream):
+    def __init__(self, request_id: int, define_id: int, name: str, units: str) -> None:
+        super().__init__(request_id)
+        self.define_id: int = define_id
+        self.name: str = name
+        self.units: str = units
+        self.epsilon: Optional[float] = None
+
+
+class ClientDataUpstream(Upstream):
+    def __init__(self, request_id: int, area_id: int, name: str, size: int) -> None:
+        super().__init__(request_id)
+        self.area_id: int = area_id
+        self.name: str = name
+        self.size: int = size
+
+
+class BrokerConnection:
+    def __init__(self, writer: asyncio.StreamWriter) -> None:
+        self.writer: asyncio.StreamWriter = writer
+        # simvar -> (client key, epsilon, last value sent)
+        self.simvars: Dict[SimvarKey, List] = {}
+        self.client_data: Set[str] = set()
+        self.dropped: int = 0
+
+    def send(self, message: Dict) -> None:
+        if self.writer.is_closing():
+            return
+        if self.writer.transport.get_write_buffer_size() > CLIENT_BUFFER_LIMIT:
+            self.dropped += 1
+            return
+        self.writer.write(json.dumps(message, separators=(",", ":")).encode() + b"\n")
+
+    def simvar_changed(self, key: SimvarKey, value: float) -> Optional[Tuple[str, float]]:
+        """The client key and value if the change is one this client asked for."""
+        entry = self.simvars[key]
+        if entry[2] is not None and abs(value - entry[2]) <= entry[1]:
+            return None
+        entry[2] = value
+        return entry[0], value
+
+
+class SimvarBroker:
+    def __init__(self, simconnect_factory: Callable[[], BrokerSimConnect] = BrokerSimConnect) -> None:
+        self.simconnect_factory: Callable[[], BrokerSimConnect] = simconnect_factory
+        self.sm: Optional[BrokerSimConnect] = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.simvars: Dict[SimvarKey, SimvarUpstream] = {}
+        self.client_data: Dict[str, ClientDataUpstream] = {}
+        # request id -> upstream, read on the dispatch thread
+        self.requests: Dict[int, Upstream] = {}
+        # simvar -> data definition used to set it
+        self.write_definitions: Dict[SimvarKey, int] = {}
+        self.connections: Set[BrokerConnection] = set()
+        self.next_area_id: int = CLIENT_DATA_ID_BASE
+        self.upstream_requests: int = 0
+        self.updates: int = 0
+
+    # --- SimConnect side ---
+
+    async def connect(self) -> bool:
+        if self.sm is not None and not self.sm.quit:
+            return True
+        try:
+            # connect() busy-waits for the open event, keep it off the event loop
+            sm = await asyncio.to_thread(self.simconnect_factory)
+        except Exception as e:
+            logging.debug(f"SimConnect not available: {e}")
+            return False
+        sm.data_handler = self.handle_data
+        self.sm = sm
+        logging.info("SimConnect connected, replaying %d simvars and %d client data areas",
+                     len(self.simvars), len(self.client_data))
+        # ids are per session, everything is defined again
+        self.requests = {}
+        self.write_definitions = {}
+        for upstream in list(self.simvars.values()):
+            self.define_simvar(upstream)
+        for upstream in list(self.client_data.values()):
+            self.define_client_data(upstream)
+        return True
+
+    def define_simvar(self, upstream: SimvarUpstream) -> None:
+        if self.sm is None:
+            return
+        upstream.request_id = self.sm.new_request_id().value
+        upstream.define_id = self.sm.new_def_id().value
+        self.sm.dll.AddToDataDefinition(self.sm.hSimConnect, upstream.define_id, upstream.name.encode(),
+                                        upstream.units.encode(), SIMCONNECT_DATATYPE.SIMCONNECT_DATATYPE_FLOAT64,
+                                        upstream.epsilon or 0.0, SIMCONNECT_UNUSED)
+        self.requests[upstream.request_id] = upstream
+        self.request_simvar(upstream)
+
+    def request_simvar(self, upstream: SimvarUpstream) -> None:
+        if self.sm is None:
+            return
+        period = (SIMCONNECT_PERIOD.SIMCONNECT_PERIOD_VISUAL_FRAME if upstream.subscribers
+                  else SIMCONNECT_PERIOD.SIMCONNECT_PERIOD_NEVER)
+        self.sm.dll.RequestDataOnSimObject(self.sm.hSimConnect, upstream.request_id, upstream.define_id,
+                                           SIMCONNECT_OBJECT_ID_USER, period,
+                                           SIMCONNECT_DATA_REQUEST_FLAG.SIMCONNECT_DATA_REQUEST_FLAG_CHANGED, 0, 0, 0)
+        self.upstream_requests += 1
+
+    def define_client_data(self, upstream: ClientDataUpstream) -> None:
+        if self.sm is None:
+            return
+        upstream.request_id = self.sm.new_request_id().value
+        self.sm.dll.MapClientDataNameToID(self.sm.hSimConnect, upstream.name.encode(), upstream.area_id)
+        self.sm.dll.AddToClientDataDefinition(self.sm.hSimConnect, upstream.area_id, 0, upstream.size, 0, 0)
+        self.requests[upstream.request_id] = upstream
+        self.request_client_data(upstream)
+
+    def request_client_data(self, upstream: ClientDataUpstream) -> None:
+        if self.sm is None:
+            return
+        period = (SIMCONNECT_CLIENT_DATA_PERIOD.SIMCONNECT_CLIENT_DATA_PERIOD_VISUAL_FRAME if upstream.subscribers
+                  else SIMCONNECT_CLIENT_DATA_PERIOD.SIMCONNECT_CLIENT_DATA_PERIOD_NEVER)
+        self.sm.dll.RequestClientData(self.sm.hSimConnect, upstream.area_id, upstream.request_id, upstream.area_id,
+                                      period,
+                                      SIMCONNECT_CLIENT_DATA_REQUEST_FLAG.SIMCONNECT_CLIENT_DATA_REQUEST_FLAG_CHANGED,
+                                      0, 0, 0)
+        self.upstream_requests += 1
+
+    def handle_data(self, data) -> None:
+        # SimConnect dispatch thread: copy the payload out and hand it to the event loop
+        upstream = self.requests.get(data.dwRequestID)
+        if upstream is None or self.loop is None:
+            return
+        address = ctypes.addressof(data) + DATA_OFFSET
+        if isinstance(upstream, SimvarUpstream):
+            payload = ctypes.c_double.from_address(address).value
+        else:
+            payload = ctypes.string_at(address, upstream.size)
+        self.loop.call_soon_threadsafe(self.publish, upstream, payload)
+
+    def publish(self, upstream: Upstream, payload) -> None:
+        upstream.last = payload
+        self.updates += 1
+        if isinstance(upstream, SimvarUpstream):
+            key = (upstream.name, upstream.units)
+            for connection in upstream.subscribers:
+                changed = connection.simvar_changed(key, payload)
+                if changed is not None:
+                    connection.send({"op": "simvars", "values": {changed[0]: changed[1]}})
+        else:
+            message = {"op": "client_data", "name": upstream.name, "data": base64.b64encode(payload).decode()}
+            for connection in upstream.subscribers:
+                connection.send(message)
+
+    # --- client side ---
+
+    def subscribe_simvar(self, connection: BrokerConnection, spec: Dict) -> None:
+        key = (spec["name"], spec.get("units", ""))
+        epsilon = float(spec.get("epsilon", 0.0))
+        connection.simvars[key] = [spec.get("key", spec["name"]), epsilon, None]
+        upstream = self.simvars.get(key)
+        if upstream is None:
+            upstream = self.simvars[key] = SimvarUpstream(0, 0, *key)
+        was_idle = not upstream.subscribers
+        upstream.subscribers.add(connection)
+        if upstream.epsilon is None or epsilon < upstream.epsilon:
+            # the definition carries the epsilon, replace it with a tighter one
+            if self.requests.pop(upstream.request_id, None) is not None and self.sm is not None:
+                self.sm.dll.RequestDataOnSimObject(self.sm.hSimConnect, upstream.request_id, upstream.define_id,
+                                                   SIMCONNECT_OBJECT_ID_USER,
+                                                   SIMCONNECT_PERIOD.SIMCONNECT_PERIOD_NEVER, 0, 0, 0, 0)
+                self.sm.dll.ClearDataDefinition(self.sm.hSimConnect, upstream.define_id)
+            upstream.epsilon = epsilon
+            self.define_simvar(upstream)
+        elif was_idle:
+            self.request_simvar(upstream)
+        if upstream.last is not None:
+            changed = connection.simvar_changed(key, upstream.last)
+            connection.send({"op": "simvars", "values": {changed[0]: changed[1]}})
+
+    def subscribe_client_data(self, connection: BrokerConnection, spec: Dict) -> None:
+        name = spec["name"]
+        connection.client_data.add(name)
+        upstream = self.client_data.get(name)
+        if upstream is None:
+            upstream = self.client_data[name] = ClientDataUpstream(0, self.next_area_id, name, int(spec["size"]))
+            self.next_area_id += 1
+            upstream.subscribers.add(connection)
+            self.define_client_data(upstream)
+            return
+        was_idle = not upstream.subscribers
+        upstream.subscribers.add(connection)
+        if was_idle:
+            self.request_client_data(upstream)
+        if upstream.last is not None:
+            connection.send({"op": "client_data", "name": name, "data": base64.b64encode(upstream.last).decode()})
+
+    def set_simvar(self, spec: Dict) -> None:
+        if self.sm is None:
+            return
+        key = (spec["name"], spec.get("units", ""))
+        define_id = self.write_definitions.get(key)
+        if define_id is None:
+            define_id = self.write_definitions[key] = self.sm.new_def_id().value
+            self.sm.dll.AddToDataDefinition(self.sm.hSimConnect, define_id, key[0].encode(), key[1].encode(),
+                                            SIMCONNECT_DATATYPE.SIMCONNECT_DATATYPE_FLOAT64, 0.0, SIMCONNECT_UNUSED)
+        value = ctypes.c_double(float(spec["value"]))
+        self.sm.dll.SetDataOnSimObject(self.sm.hSimConnect, define_id, SIMCONNECT_OBJECT_ID_USER, 0, 0,
+                                       ctypes.sizeof(value), ctypes.cast(ctypes.pointer(value), ctypes.c_void_p))
+
+    def unsubscribe(self, connection: BrokerConnection) -> None:
+        for key in connection.simvars:
+            upstream = self.simvars[key]
+            upstream.subscribers.discard(connection)
+            if not upstream.subscribers:
+                self.request_simvar(upstream)
+        for name in connection.client_data:
+            upstream = self.client_data[name]
+            upstream.subscribers.discard(connection)
+            if not upstream.subscribers:
+                self.request_client_data(upstream)
+
+    def status(self) -> Dict:
+        return {
+            "op": "status",
+            "connected": self.sm is not None and not self.sm.quit,
+            "clients": len(self.connections),
+            "simvars": sum(1 for upstream in self.simvars.values() if upstream.subscribers),
+            "client_data": sum(1 for upstream in self.client_data.values() if upstream.subscribers),
+            "upstream_requests": self.upstream_requests,
+            "updates": self.updates,
+            "dropped": sum(connection.dropped for connection in self.connections),
+        }
+
+    def command(self, connection: BrokerConnection, message: Dict) -> None:
+        op = message.get("op")
+        if op == "subscribe":
+            for spec in message.get("simvars", []):
+                self.subscribe_simvar(connection, spec)
+            for spec in message.get("client_data", []):
+                self.subscribe_client_data(connection, spec)
+        elif op == "set":
+            self.set_simvar(message)
+        elif op == "status":
+            connection.send(self.status())
+        else:
+            raise ValueError(f"unknown op {op!r}")
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        connection = BrokerConnection(writer)
+        self.connections.add(connection)
+        try:
+            while line := await reader.readline():
+                try:
+                    self.command(connection, json.loads(line))
+                except (ValueError, KeyError, TypeError) as e:
+                    connection.send({"op": "error", "error": str(e)})
+        except ConnectionError:
+            pass
+        finally:
+            self.connections.discard(connection)
+            self.unsubscribe(connection)
+            writer.close()
+
+    async def serve(self, host: str = "localhost", port: int = BROKER_PORT) -> None:
+        self.loop = asyncio.get_running_loop()
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        logging.info("SimVar broker listening on %s:%d", host, port)
+        async with server:
+            while True:
+                await self.connect()
+                await asyncio.sleep(SIMCONNECT_RETRY_INTERVAL)
+
+
+class BrokerClient:
+    """Client side of the broker, calls on_simvars(values) and on_client_data(name, data) for updates."""
+
+    def __init__(self, host: str = "localhost", port: int = BROKER_PORT) -> None:
+        self.host: str = host
+        self.port: int = port
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.on_simvars: Optional[Callable[[Dict[str, float]], None]] = None
+        self.on_client_data: Optional[Callable[[str, bytes], None]] = None
+        self.on_status: Optional[Callable[[Dict], None]] = None
+
+    async def connect(self) -> None:
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+
+    def send(self, message: Dict) -> None:
+        self.writer.write(json.dumps(message).encode() + b"\n")
+
+    async def request(self, message: Dict) -> None:
+        self.send(message)
+        await self.writer.drain()
+
+    async def subscribe(self, simvars: Optional[List[Dict]] = None, client_data: Optional[List[Dict]] = None) -> None:
+        await self.request({"op": "subscribe", "simvars": simvars or [], "client_data": client_data or []})
+
+    async def set_simvar(self, name: str, units: str, value: float) -> None:
+        await self.request({"op": "set", "name": name, "units": units, "value": value})
+
+    async def run(self) -> None:
+        while line := await self.reader.readline():
+            message = json.loads(line)
+            op = message.get("op")
+            if op == "simvars" and self.on_simvars is not None:
+                self.on_simvars(message["values"])
+            elif op == "client_data" and self.on_client_data is not None:
+                self.on_client_data(message["name"], base64.b64decode(message["data"]))
+            elif op == "status" and self.on_status is not None:
+                self.on_status(message)
+            elif op == "error":
+                logging.error(f"SimVar broker: {message.get('error')}")
+        raise ConnectionError("SimVar broker closed the connection")
+
+    async def close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+
+
+def fake_simconnect_factory(rate: float) -> Callable[[], BrokerSimConnect]:
+    from fake_simconnect import FakeSim, create_simconnect
+
+    def factory() -> BrokerSimConnect:
+        simconnect = create_simconnect(BrokerSimConnect, FakeSim(rate))
+        simconnect.data_handler = None
+        return simconnect
+    return factory
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Share one SimConnect session between local tools")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=BROKER_PORT)
+    parser.add_argument("--fake-sim", action="store_true", help="serve fake_simconnect's simulated data")
+    parser.add_argument("--fake-rate", type=float, default=30.0, help="frames per second of the fake sim")
+    parser.add_argument("--log-level", default="INFO")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    setup_logging(args.log_level)
+    logging.info("----STARTED SimVar broker----")
+    factory = fake_simconnect_factory(args.fake_rate) if args.fake_sim else BrokerSimConnect
+    try:
+        asyncio.run(SimvarBroker(factory).serve(args.host, args.port))
+    except KeyboardInterrupt:
+        logging.info("Process terminated by user")
@@ -1,23 +1,43 @@
 #!/usr/bin/env python3
 import asyncio
+import ctypes
 import json
 import logging
 import math
+import os
 import pygame
+import re
 import textwrap
+import threading
+import time
 import websockets
+from collections import deque
 import numpy as np
-import os
-import re
-from bs4 import BeautifulSoup
+from cdu_logging import setup_logging
+from cdu_metrics import metrics
+from cdu_profiler import start_control_from_env
+from gns530_fpl import FplDirectory, PlanCache
+from simvar_broker import BROKER_ENV, BrokerClient, broker_address
 
 # --- SimConnect ---
 from SimConnect import SimConnect, AircraftRequests
+from SimConnect.Constants import SIMCONNECT_OBJECT_ID_USER, SIMCONNECT_UNUSED
+from SimConnect.Enum import (SIMCONNECT_DATA_REQUEST_FLAG, SIMCONNECT_DATATYPE, SIMCONNECT_PERIOD, SIMCONNECT_RECV_ID,
+                             SIMCONNECT_RECV_SIMOBJECT_DATA)
 
 LOG_FILE = "gns530_winwing_cdu.log"
 WS_URI = "ws://localhost:8320/winwing/cdu-captain"
 UPDATE_INTERVAL = 0.1
+# run on fake_simconnect's simulated simvars instead of the sim, for testing without MSFS
+FAKE_SIM_ENV = "WINWING_CDU_FAKE_SIM"
+FAKE_SIM_RATE = 30.0
+# seconds between attempts to reach the simvar broker named by WINWING_CDU_BROKER
+BROKER_RETRY_INTERVAL = 5.0
 JOYSTICK_INDEX = 0
+# how long the joystick thread blocks on pygame events before checking whether to stop, ms
+JOYSTICK_WAIT_MS = 500
+# presses waiting for the frame that answers them
+PENDING_PRESSES = 16
 
 BUTTONS_LSK = [0, 1, 2, 3, 4, 5]
 BUTTONS_RSK = [6, 7, 8, 9, 10, 11]
@@ -42,44 +62,85 @@ SIMVARS = [
     "GPS_GROUND_SPEED", "GPS_GROUND_MAGNETIC_TRACK"
 ]
 
-def setup_logging():
-    logging.basicConfig(
-        level=logging.INFO,
-        format="%(asctime)s [%(levelname)s] %(message)s",
-        filename=LOG_FILE, filemode="w"
-    )
-    console = logging.StreamHandler()
-    console.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(message)s"))
-    logging.getLogger().addHandler(console)
-
-def parse_colored_text(text, default_color="w"):
-    COLOR_MARKER_SEPARATOR = "`"
-    TARGET_LINE_LENGTH = DISPLAY_LINE_LENGTH
-    raw_text = ""
+# simvar -> (SimConnect datum, units, change the sim does not report)
+SIMVAR_DEFINITIONS = {
+    "COM_ACTIVE_FREQUENCY:1": (b"COM ACTIVE FREQUENCY:1", b"MHz", 0.0005),
+    "COM_STANDBY_FREQUENCY:1": (b"COM STANDBY FREQUENCY:1", b"MHz", 0.0005),
+    "NAV_ACTIVE_FREQUENCY:1": (b"NAV ACTIVE FREQUENCY:1", b"MHz", 0.0005),
+    "NAV_STANDBY_FREQUENCY:1": (b"NAV STANDBY FREQUENCY:1", b"MHz", 0.0005),
+    "TRANSPONDER CODE:1": (b"TRANSPONDER CODE:1", b"BCO16", 0.0),
+    "GPS_GROUND_SPEED": (b"GPS GROUND SPEED", b"Meters per second", 0.1),
+    "GPS_GROUND_MAGNETIC_TRACK": (b"GPS GROUND MAGNETIC TRACK", b"Radians", 0.005),
+}
+
+# Simvar values are reduced to what the pages display (MHz to 3 decimals,
+# transponder code as decimal, GS in whole knots, TRK in whole degrees), so
+# only a visible change triggers a render
+SIMVAR_QUANTIZE = {
+    "COM_ACTIVE_FREQUENCY:1": lambda v: round(float(v), 3),
+    "COM_STANDBY_FREQUENCY:1": lambda v: round(float(v), 3),
+    "NAV_ACTIVE_FREQUENCY:1": lambda v: round(float(v), 3),
+    "NAV_STANDBY_FREQUENCY:1": lambda v: round(float(v), 3),
+    "TRANSPONDER CODE:1": lambda v: bcd16_to_int(int(v)),
+    "GPS_GROUND_SPEED": lambda v: int(float(v) * 1.94384),
+    "GPS_GROUND_MAGNETIC_TRACK": lambda v: int(np.degrees(float(v))),
+}
+
+COLOR_MARKER = "`"
+# "{name:width}" in a template line, "<", ">" or "^" before the width aligns the text
+SLOT_REGEX = re.compile(r"\{(\w+):([<>^]?)(\d+)\}")
+SLOT_ALIGN = {"<": str.ljust, ">": str.rjust, "^": str.center}
+
+def compile_line(text, default_color="w"):
+    """
+    Turns one template line into DISPLAY_LINE_LENGTH cells and its slots as
+    (name, first cell, width, align). "X`" switches to colour X, slots take the
+    colour they are in.
+    """
+    cells = []
+    slots = []
+    color = default_color
     i = 0
     while i < len(text):
-        if i + 1 < len(text) and text[i + 1] == COLOR_MARKER_SEPARATOR:
+        if i + 1 < len(text) and text[i + 1] == COLOR_MARKER:
+            color = text[i].lower()
             i += 2
             continue
-        raw_text += text[i]
-        i += 1
-    if len(raw_text) < TARGET_LINE_LENGTH:
-        text += ' ' * (TARGET_LINE_LENGTH - len(raw_text))
-    colored = []
-    current_color = default_color
-    i = 0
-    while i < len(text):
-        if i + 1 < len(text) and text[i + 1] == COLOR_MARKER_SEPARATOR:
-            current_color = text[i].lower()
-            i += 2
+        if text[i] == "{" and (match := SLOT_REGEX.match(text, i)):
+            width = int(match.group(3))
+            slots.append((match.group(1), len(cells), width, SLOT_ALIGN[match.group(2) or "<"]))
+            cells.extend([" ", color, 0] for _ in range(width))
+            i = match.end()
             continue
-        ch = text[i]
-        colored.append([ch, current_color, 0])
+        cells.append([text[i], color, 0])
         i += 1
-    return colored
+    if len(cells) > DISPLAY_LINE_LENGTH:
+        if slots and slots[-1][1] + slots[-1][2] > DISPLAY_LINE_LENGTH:
+            raise ValueError(f"Slot {slots[-1][0]} runs past the end of line {text!r}")
+        del cells[DISPLAY_LINE_LENGTH:]
+    cells.extend([" ", color, 0] for _ in range(DISPLAY_LINE_LENGTH - len(cells)))
+    return cells, slots
 
-def safe_str(s):
-    return s if isinstance(s, str) else str(s or "")
+class PageTemplate:
+    """
+    A page layout in the colour marker syntax, compiled once into the cells of
+    the whole display. Dynamic text goes into named slots, "{gs:>3}" being
+    three cells for the slot gs with the text right-aligned.
+    """
+    def __init__(self, lines):
+        self.cells = []
+        # name -> (first cell on the display, width, align)
+        self.slots = {}
+        lines = list(lines) + [""] * (DISPLAY_LINES - len(lines))
+        for row, text in enumerate(lines[:DISPLAY_LINES]):
+            cells, slots = compile_line(text)
+            for name, start, width, align in slots:
+                self.slots[name] = (row * DISPLAY_LINE_LENGTH + start, width, align)
+            self.cells.extend(cells)
+    def text(self, name, value):
+        """The slot's text for a value, exactly as many characters as the slot has cells."""
+        _, width, align = self.slots[name]
+        return align(str(value)[:width], width)
 
 def bcd16_to_int(bcd):
     result = 0
@@ -108,25 +169,99 @@ def safe_freq(val):
     except Exception:
         return "---.---"
 
+def quantize_simvars(data):
+    quantized = {}
+    for v, value in data.items():
+        try:
+            quantized[v] = SIMVAR_QUANTIZE[v](value) if value is not None else None
+        except Exception:
+            quantized[v] = None
+    return quantized
+
+# --- Display frame ---
+class DisplayFrame:
+    """
+    The cells last sent to the CDU. A render of the same template writes only
+    the slots whose text changed, another template replaces the whole frame.
+    """
+    def __init__(self):
+        self.template = None
+        self.cells = []
+        self.texts = {}
+    def update(self, template, values):
+        """Takes a page template and its slot values, returns whether any cell changed."""
+        if template is not self.template:
+            cells = [list(cell) for cell in template.cells]
+            texts = {}
+            for name, (start, _, _) in template.slots.items():
+                texts[name] = text = template.text(name, values.get(name, ""))
+                for offset, ch in enumerate(text, start):
+                    cells[offset][0] = ch
+            changed = cells != self.cells
+            self.template, self.cells, self.texts = template, cells, texts
+            return changed
+        changed = False
+        for name, value in values.items():
+            text = template.text(name, value)
+            if text == self.texts[name]:
+                continue
+            self.texts[name] = text
+            changed = True
+            for offset, ch in enumerate(text, template.slots[name][0]):
+                self.cells[offset][0] = ch
+        return changed
+    def message(self):
+        return json.dumps({"Target": "Display", "Data": self.cells})
+
 # --- SimConnect Bridge ---
+class SimConnectGNS530(SimConnect):
+    """SimConnect handing SIMOBJECT_DATA (RequestDataOnSimObject) to simobject_data_handler."""
+    def __init__(self, auto_connect=True):
+        self.simobject_data_handler = None
+        super().__init__(auto_connect)
+    def my_dispatch_proc(self, pData, cbData, pContext):
+        if pData.contents.dwID == SIMCONNECT_RECV_ID.SIMCONNECT_RECV_ID_SIMOBJECT_DATA and self.simobject_data_handler:
+            self.simobject_data_handler(ctypes.cast(pData, ctypes.POINTER(SIMCONNECT_RECV_SIMOBJECT_DATA)).contents)
+        else:
+            super().my_dispatch_proc(pData, cbData, pContext)
+
 class GNS530Bridge:
-    def __init__(self):
-        self.sm = SimConnect()
+    """
+    All SIMVARS in one data definition, requested every visual frame with the
+    CHANGED flag. The SimConnect dispatch thread swaps in a new snapshot dict
+    for every update and sets `updated`; read_all() just returns the snapshot.
+    """
+    def __init__(self, sm=None):
+        self.sm = sm if sm is not None else SimConnectGNS530()
+        # for set_simvar
         self.aq = AircraftRequests(self.sm, _time=2000)
+        self.snapshot = {v: None for v in SIMVARS}
+        self.loop = None
+        self.updated = asyncio.Event()
+        self.define_id = self.sm.new_def_id()
+        self.request_id = self.sm.new_request_id()
+        self.sm.simobject_data_handler = self.handle_data
+    def subscribe(self):
+        self.loop = asyncio.get_running_loop()
         for v in SIMVARS:
-            try:
-                self.aq.find(v)
-            except Exception:
-                pass
+            datum, units, epsilon = SIMVAR_DEFINITIONS[v]
+            self.sm.dll.AddToDataDefinition(self.sm.hSimConnect, self.define_id.value, datum, units,
+                                            SIMCONNECT_DATATYPE.SIMCONNECT_DATATYPE_FLOAT64, epsilon,
+                                            SIMCONNECT_UNUSED)
+        self.sm.dll.RequestDataOnSimObject(self.sm.hSimConnect, self.request_id.value, self.define_id.value,
+                                           SIMCONNECT_OBJECT_ID_USER, SIMCONNECT_PERIOD.SIMCONNECT_PERIOD_VISUAL_FRAME,
+                                           SIMCONNECT_DATA_REQUEST_FLAG.SIMCONNECT_DATA_REQUEST_FLAG_CHANGED, 0, 0, 0)
+    def handle_data(self, data):
+        # SimConnect dispatch thread
+        if data.dwRequestID != self.request_id.value:
+            return
+        values = (ctypes.c_double * len(SIMVARS)).from_address(
+            ctypes.addressof(data) + SIMCONNECT_RECV_SIMOBJECT_DATA.dwData.offset)
+        self.snapshot = dict(zip(SIMVARS, values))
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.updated.set)
     def read_all(self):
-        data = {}
-        for v in SIMVARS:
-            try:
-                data[v] = self.aq.get(v)
-            except Exception as e:
-                logging.error(f"Ошибка чтения симвара {v}: {e}")
-                data[v] = None
-        return data
+        return self.snapshot
     def set_simvar(self, var, value):
         try:
             self.aq.set(var, value)
@@ -135,6 +270,50 @@ class GNS530Bridge:
             logging.error(f"Ошибка установки симвара {var}: {e}")
             return False
 
+class BrokerBridge:
+    """
+    GNS530Bridge on a shared simvar_broker.py instead of an own SimConnect
+    session, used when WINWING_CDU_BROKER names the broker as [host:]port.
+    """
+    def __init__(self, address):
+        self.client = BrokerClient(*broker_address(address))
+        self.client.on_simvars = self.handle_simvars
+        self.snapshot = {v: None for v in SIMVARS}
+        self.updated = asyncio.Event()
+        self.task = None
+    def subscribe(self):
+        self.task = asyncio.create_task(self.run())
+    async def run(self):
+        simvars = [{"key": v, "name": datum.decode(), "units": units.decode(), "epsilon": epsilon}
+                   for v, (datum, units, epsilon) in SIMVAR_DEFINITIONS.items()]
+        while True:
+            try:
+                await self.client.connect()
+                await self.client.subscribe(simvars)
+                await self.client.run()
+            except (OSError, ConnectionError) as e:
+                logging.warning(f"Нет связи с брокером симваров: {e}")
+            await self.client.close()
+            await asyncio.sleep(BROKER_RETRY_INTERVAL)
+    def handle_simvars(self, values):
+        self.snapshot = {**self.snapshot, **values}
+        self.updated.set()
+    def read_all(self):
+        return self.snapshot
+    def set_simvar(self, var, value):
+        datum, units, _ = SIMVAR_DEFINITIONS[var]
+        writer = self.client.writer
+        if writer is None or writer.is_closing():
+            # a closed writer drops the write without raising
+            logging.error(f"Ошибка установки симвара {var}: нет связи с брокером")
+            return False
+        try:
+            self.client.send({"op": "set", "name": datum.decode(), "units": units.decode(), "value": value})
+            return True
+        except Exception as e:
+            logging.error(f"Ошибка установки симвара {var}: {e}")
+            return False
+
 # --- Error State Management ---
 class ErrorManager:
     def __init__(self):
@@ -151,71 +330,6 @@ class ErrorManager:
     def is_active(self):
         return self.active
 
-# --- Flightplan file parser ---
-def list_fpl_files():
-    try:
-        files = [f for f in os.listdir(FILES_DIR) if f.lower().endswith('.html')]
-        files.sort()
-        return files
-    except Exception as e:
-        logging.error(f"Ошибка чтения директории файлов: {e}")
-        return []
-
-def parse_fpl_file(filepath):
-    try:
-        with open(filepath, "r", encoding="utf-8") as f:
-            soup = BeautifulSoup(f, "html.parser")
-        dep, arr = None, None
-        h1 = soup.find("h1")
-        if h1:
-            m = re.match(r".*\((\w{4})\)\s*to\s*.*\((\w{4})\)", h1.text)
-            if m:
-                dep, arr = m.group(1), m.group(2)
-        if not (dep and arr):
-            title = soup.find("title")
-            if title:
-                m = re.match(r".*\((\w{4})\).*to.*\((\w{4})\)", title.text)
-                if m:
-                    dep, arr = m.group(1), m.group(2)
-        table = soup.find("table")
-        if not table:
-            raise ValueError("No table in file")
-        headers = [th.get_text(strip=True) for th in table.find_all("th")]
-        idx_ident = idx_course = idx_legtime = idx_wind = None
-        for i, h in enumerate(headers):
-            if "Ident" in h: idx_ident = i
-            if "Course" in h: idx_course = i
-            if "Leg Time" in h: idx_legtime = i
-            if "Head- or Tailwind" in h: idx_wind = i
-        if None in (idx_ident, idx_course, idx_legtime, idx_wind):
-            raise ValueError("Table columns not found")
-        points = []
-        for tr in table.find_all("tr")[1:]:
-            tds = tr.find_all("td")
-            if len(tds) <= max(idx_ident, idx_course, idx_legtime, idx_wind):
-                continue
-            ident = safe_str(tds[idx_ident].get_text(strip=True))
-            course = safe_str(tds[idx_course].get_text(strip=True)).replace(',', '.')
-            legtime = safe_str(tds[idx_legtime].get_text(strip=True))
-            wind = safe_str(tds[idx_wind].get_text(strip=True))
-            if ident:
-                if not course or not course.replace('.', '', 1).isdigit():
-                    course = "---"
-                if not legtime:
-                    legtime = "--:--"
-                points.append({
-                    "ident": ident[:8],
-                    "course": course,
-                    "legtime": legtime,
-                    "wind": wind
-                })
-        if not points or not dep or not arr:
-            raise ValueError("Not enough data in file")
-        return {"dep": dep, "arr": arr, "points": points}
-    except Exception as e:
-        logging.error(f"Ошибка разбора плана {filepath}: {e}")
-        return None
-
 # --- App State ---
 class AppState:
     def __init__(self):
@@ -225,12 +339,27 @@ class AppState:
         self.last_data = {}
         self.fpl_file = None
         self.fpl = None
-        self.fpl_file_list = []
+        self.fpl_files = FplDirectory(FILES_DIR, PlanCache())
         self.fpl_file_scroll = 0
         self.fpl_file_selected = 0
         self.fpl_scroll = 0
         self.error = ErrorManager()
+        # set whenever something shown on the CDU may have changed
+        self.changed = asyncio.Event()
+        self.changed.set()
+        # (button, perf_counter at capture) of presses no frame has answered yet
+        self.pending_presses = deque(maxlen=PENDING_PRESSES)
+        # trace frame of the simvar update the next render shows, 0 when none
+        self.pending_frame = 0
+        self.fpl_files.on_change = self.invalidate
 
+    def invalidate(self):
+        self.changed.set()
+    def answer_presses(self):
+        """Records the press to frame latency of the presses the frame just sent answers."""
+        while self.pending_presses:
+            button, pressed = self.pending_presses.popleft()
+            metrics.observe(f"key:{button}", pressed)
     def clear_scratchpad(self):
         self.scratchpad = ""
     def backspace_scratchpad(self):
@@ -253,40 +382,41 @@ class AppState:
         self.fpl_file_scroll = 0
 
 # --- Main page ---
+MAIN_TEMPLATE = PageTemplate([
+    "C`" + "GNS530 CDU".center(DISPLAY_LINE_LENGTH),
+    "",
+    "C`COM1 G`{com1a:7} C`/ A`{com1s:7}",
+    "",
+    "C`NAV1 G`{nav1a:7} C`/ A`{nav1s:7}",
+    "",
+    "C`XPDR G`{xpdr:4}",
+    "",
+    "C`GS G`{gs:>3}KT C`TRK G`{trk:>3}",
+    "", "", "",
+    " " * (DISPLAY_LINE_LENGTH - 12) + "C`{del_fpln:10}",
+    "A`[ W`{scratchpad:20} A`]",
+])
+
 class MainPage:
     def __init__(self, state: AppState):
         self.state = state
     def render(self, data):
-        lines = [" " * DISPLAY_LINE_LENGTH for _ in range(DISPLAY_LINES)]
-        lines[0] = "C`GNS530 CDU".center(DISPLAY_LINE_LENGTH)
+        """The page template and its slot values."""
         com1a = safe_freq(data.get('COM_ACTIVE_FREQUENCY:1'))
         com1s = safe_freq(data.get('COM_STANDBY_FREQUENCY:1'))
         nav1a = safe_freq(data.get('NAV_ACTIVE_FREQUENCY:1'))
         nav1s = safe_freq(data.get('NAV_STANDBY_FREQUENCY:1'))
-        try:
-            xpdr_raw = data.get('TRANSPONDER CODE:1', 0)
-            xpdr = bcd16_to_int(int(xpdr_raw))
-            xpdr = "{:04d}".format(xpdr)
-        except Exception:
-            xpdr = "0000"
-        try:
-            gs = str(int(float(data.get("GPS_GROUND_SPEED", 0))*1.94384)).rjust(3)
-        except Exception:
-            gs = "---"
-        try:
-            trk = str(int(np.degrees(float(data.get("GPS_GROUND_MAGNETIC_TRACK") or 0)))).rjust(3)
-        except Exception:
-            trk = "---"
-        lines[2] = f"C`COM1 G`{com1a} C`/ A`{com1s}"
-        lines[4] = f"C`NAV1 G`{nav1a} C`/ A`{nav1s}"
-        lines[6] = f"C`XPDR G`{xpdr}"
-        lines[8] = f"C`GS G`{gs}KT C`TRK G`{trk}"
-        if self.state.fpl:
-            lines[12] = " " * (DISPLAY_LINE_LENGTH-12) + "C`< DEL FPLN"
-        pad = self.state.scratchpad
-        pad_disp = f"A`[ W`{pad.ljust(DISPLAY_LINE_LENGTH-4)[:DISPLAY_LINE_LENGTH-4]} A`]".ljust(DISPLAY_LINE_LENGTH)
-        lines[-1] = pad_disp
-        return lines
+        xpdr = data.get('TRANSPONDER CODE:1')
+        xpdr = "{:04d}".format(xpdr) if xpdr is not None else "0000"
+        gs = data.get("GPS_GROUND_SPEED")
+        gs = gs if gs is not None else "---"
+        trk = data.get("GPS_GROUND_MAGNETIC_TRACK") or 0
+        return MAIN_TEMPLATE, {
+            "com1a": com1a, "com1s": com1s, "nav1a": nav1a, "nav1s": nav1s,
+            "xpdr": xpdr, "gs": gs, "trk": trk,
+            "del_fpln": "< DEL FPLN" if self.state.fpl else "",
+            "scratchpad": self.state.scratchpad,
+        }
     def handle_button(self, button):
         state = self.state
         if button == BUTTON_CLR:
@@ -326,47 +456,59 @@ class MainPage:
             state.clear_scratchpad()
 
 # --- FPLN page ---
+# six plan points or plan files, two lines each from line 2
+FPLN_ROWS = 6
+
+FPLN_PLAN_TEMPLATE = PageTemplate(
+    ["C`{title:^24}", ""]
+    + [line for i in range(FPLN_ROWS)
+       for line in (f"W`{{ident{i}:8}} G`{{course{i}:>3}} W`{{legtime{i}:>5}} W`{{wind{i}:>4}}", "")]
+)
+FPLN_FILES_TEMPLATE = PageTemplate(
+    ["C`" + "FLIGHTPLANS".center(DISPLAY_LINE_LENGTH), ""]
+    + [line for i in range(FPLN_ROWS) for line in (f"W`{{marker{i}:1}} {{name{i}:20}}", f"C`  {{info{i}:22}}")]
+)
+FPLN_NO_FILES_TEMPLATE = PageTemplate(
+    ["C`" + "FLIGHTPLANS".center(DISPLAY_LINE_LENGTH)] + [""] * 5
+    + ["R`" + "NO FLIGHTPLANS FOUND".center(DISPLAY_LINE_LENGTH)]
+)
+
 class FPLNPage:
     def __init__(self, state: AppState):
         self.state = state
     def render(self, data):
-        lines = [" " * DISPLAY_LINE_LENGTH for _ in range(DISPLAY_LINES)]
+        """The page template and its slot values."""
+        values = {}
         if self.state.fpl:
             dep = self.state.fpl.get("dep", "---")
             arr = self.state.fpl.get("arr", "---")
-            lines[0] = f"C`FLIGHTPLAN {dep} \u2192 {arr}".center(DISPLAY_LINE_LENGTH)
+            values["title"] = f"FLIGHTPLAN {dep} \u2192 {arr}"
             pts = self.state.fpl.get("points", [])
             start = self.state.fpl_scroll
-            for i in range(6):
+            for i in range(FPLN_ROWS):
                 idx = start + i
-                lidx = 2 + i*2
-                if idx < len(pts):
-                    pt = pts[idx]
-                    ident = pt["ident"][:8].ljust(8)
-                    course = pt["course"].rjust(3)
-                    legtime = pt["legtime"].rjust(5)
-                    wind = pt["wind"].rjust(4)
-                    lines[lidx] = f"W`{ident} G`{course} W`{legtime} W`{wind}".ljust(DISPLAY_LINE_LENGTH)
-                else:
-                    lines[lidx] = ""
-        else:
-            lines[0] = "C`FLIGHTPLANS".center(DISPLAY_LINE_LENGTH)
-            files = self.state.fpl_file_list = list_fpl_files()
-            if not files:
-                lines[6] = "R`NO FLIGHTPLANS FOUND".center(DISPLAY_LINE_LENGTH)
+                pt = pts[idx] if idx < len(pts) else {}
+                values[f"ident{i}"] = pt.get("ident", "")
+                values[f"course{i}"] = pt.get("course", "")
+                values[f"legtime{i}"] = pt.get("legtime", "")
+                values[f"wind{i}"] = pt.get("wind", "")
+            return FPLN_PLAN_TEMPLATE, values
+        files = self.state.fpl_files.files
+        if not files:
+            return FPLN_NO_FILES_TEMPLATE, values
+        start = self.state.fpl_file_scroll
+        sel = self.state.fpl_file_selected
+        for i in range(FPLN_ROWS):
+            idx = start + i
+            if idx < len(files):
+                info = files[idx]
+                route = f"{info.dep}-{info.arr} " if info.dep and info.arr else ""
+                values[f"marker{i}"] = ">" if idx == sel else " "
+                values[f"name{i}"] = info.name
+                values[f"info{i}"] = f"{route}{info.format.upper()} {math.ceil(info.size / 1024)}K"
             else:
-                start = self.state.fpl_file_scroll
-                sel = self.state.fpl_file_selected
-                for i in range(6):
-                    idx = start + i
-                    lidx = 2 + i*2
-                    if idx < len(files):
-                        name = files[idx][:20]
-                        marker = ">" if idx == sel else " "
-                        lines[lidx] = f"W`{marker} {name}".ljust(DISPLAY_LINE_LENGTH)
-                    else:
-                        lines[lidx] = ""
-        return lines
+                values[f"marker{i}"] = values[f"name{i}"] = values[f"info{i}"] = ""
+        return FPLN_FILES_TEMPLATE, values
     def handle_button(self, button):
         state = self.state
         if state.fpl:
@@ -376,21 +518,20 @@ class FPLNPage:
             elif button == BUTTON_DOWN:
                 state.fpl_scroll = min(max(0, len(pts) - 6), state.fpl_scroll + 1)
         else:
-            files = state.fpl_file_list = list_fpl_files()
+            files = state.fpl_files.files
             start = state.fpl_file_scroll
             sel = state.fpl_file_selected
             maxsel = len(files)-1
             for i, lsk in enumerate(BUTTONS_LSK):
                 idx = start + i
                 if button == lsk and idx < len(files):
-                    filepath = os.path.join(FILES_DIR, files[idx])
-                    fpl = parse_fpl_file(filepath)
+                    fpl = state.fpl_files.load_plan(files[idx])
                     if not fpl:
                         state.set_error("NOT ALLOWED")
                         state.unload_fpl()
                     else:
                         state.fpl = fpl
-                        state.fpl_file = files[idx]
+                        state.fpl_file = files[idx].name
                         state.fpl_scroll = 0
                     return
             if button == BUTTON_UP and sel > 0:
@@ -405,16 +546,17 @@ class FPLNPage:
         pass
 
 # --- Error page ---
+ERROR_TEMPLATE = PageTemplate(
+    ["R`{message:^24}"] + [""] * (DISPLAY_LINES - 2) + ["[PRESS CLR]".center(DISPLAY_LINE_LENGTH)]
+)
+
 class ErrorPage:
     def __init__(self, state: AppState):
         self.state = state
 
     def render(self, data):
-        msg = self.state.error.message or "ERROR"
-        lines = [f"R`{msg}".center(DISPLAY_LINE_LENGTH)]
-        lines += [" " * DISPLAY_LINE_LENGTH for _ in range(DISPLAY_LINES-1)]
-        lines[-1] = "[PRESS CLR]".center(DISPLAY_LINE_LENGTH)
-        return lines
+        """The page template and its slot values."""
+        return ERROR_TEMPLATE, {"message": self.state.error.message or "ERROR"}
 
     def handle_button(self, button):
         if button == BUTTON_CLR:
@@ -425,66 +567,150 @@ class ErrorPage:
             self.state.clear_error()
 
 # --- Joystick/page logic ---
+class JoystickReader(threading.Thread):
+    """
+    Blocks on pygame events in its own thread, so a press is seen as soon as
+    SDL has it rather than at the next poll of the event loop. Each button
+    press is timestamped here and handed to the loop as (button, perf_counter),
+    None tells the loop the thread has ended.
+    """
+    def __init__(self, loop, queue):
+        super().__init__(name="GNS530Joystick", daemon=True)
+        self.loop = loop
+        self.queue = queue
+        self.stopped = threading.Event()
+    def run(self):
+        try:
+            self.read_events()
+        finally:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, None)
+    def read_events(self):
+        pygame.init()
+        pygame.joystick.init()
+        try:
+            joystick = pygame.joystick.Joystick(JOYSTICK_INDEX)
+            joystick.init()
+            logging.info(f"Джойстик {joystick.get_name()} подключен")
+        except Exception as e:
+            logging.error(f"Ошибка инициализации джойстика: {e}")
+            return
+        # only wake up for presses
+        pygame.event.set_blocked(None)
+        pygame.event.set_allowed([pygame.JOYBUTTONDOWN])
+        while not self.stopped.is_set():
+            event = pygame.event.wait(JOYSTICK_WAIT_MS)
+            if event.type == pygame.JOYBUTTONDOWN:
+                self.loop.call_soon_threadsafe(self.queue.put_nowait, (event.button, time.perf_counter()))
+    def stop(self):
+        self.stopped.set()
+
+def handle_press(state: AppState, pages, button):
+    # Error page always has priority
+    if state.error.is_active():
+        ep = ErrorPage(state)
+        if (button in BUTTONS_DIGITS or button == BUTTON_DOT
+                or button in BUTTONS_LETTERS or button == BUTTON_BKSP
+                or button == BUTTON_CLR):
+            ep.handle_key(button)
+        else:
+            ep.handle_button(button)
+        return
+    # Else, normal navigation
+    if button == BUTTON_LEFT and state.page_idx > 0:
+        state.page_idx -= 1
+        return
+    if button == BUTTON_RIGHT and state.page_idx < len(pages)-1:
+        state.page_idx += 1
+        return
+    active_page = pages[state.page_idx]
+    if (button in BUTTONS_DIGITS or button == BUTTON_DOT
+            or button in BUTTONS_LETTERS or button == BUTTON_BKSP
+            or button == BUTTON_CLR):
+        active_page.handle_key(button)
+    else:
+        active_page.handle_button(button)
+
 async def joystick_listener(state: AppState, pages):
-    pygame.init()
-    pygame.joystick.init()
+    queue = asyncio.Queue()
+    reader = JoystickReader(asyncio.get_running_loop(), queue)
+    reader.start()
     try:
-        joystick = pygame.joystick.Joystick(JOYSTICK_INDEX)
-        joystick.init()
-        logging.info(f"Джойстик {joystick.get_name()} подключен")
-    except Exception as e:
-        logging.error(f"Ошибка инициализации джойстика: {e}")
-        return
+        while (item := await queue.get()) is not None:
+            button, pressed = item
+            metrics.observe("queue", pressed)
+            handle_press(state, pages, button)
+            state.pending_presses.append((button, pressed))
+            # the main loop renders as soon as this yields, with the press handled
+            state.invalidate()
+    finally:
+        reader.stop()
+
+async def simvar_listener(state: AppState):
+    bridge = state.bridge
+    bridge.subscribe()
     while True:
-        pygame.event.pump()
-        for event in pygame.event.get():
-            if event.type == pygame.JOYBUTTONDOWN:
-                # Error page always has priority
-                if state.error.is_active():
-                    ep = ErrorPage(state)
-                    if (event.button in BUTTONS_DIGITS or event.button == BUTTON_DOT
-                            or event.button in BUTTONS_LETTERS or event.button == BUTTON_BKSP
-                            or event.button == BUTTON_CLR):
-                        ep.handle_key(event.button)
-                    else:
-                        ep.handle_button(event.button)
-                    continue
-                # Else, normal navigation
-                if event.button == BUTTON_LEFT and state.page_idx > 0:
-                    state.page_idx -= 1
-                    continue
-                if event.button == BUTTON_RIGHT and state.page_idx < len(pages)-1:
-                    state.page_idx += 1
-                    continue
-                active_page = pages[state.page_idx]
-                if (event.button in BUTTONS_DIGITS or event.button == BUTTON_DOT
-                        or event.button in BUTTONS_LETTERS or event.button == BUTTON_BKSP
-                        or event.button == BUTTON_CLR):
-                    active_page.handle_key(event.button)
-                else:
-                    active_page.handle_button(event.button)
-        await asyncio.sleep(0.02)
+        await bridge.updated.wait()
+        bridge.updated.clear()
+        received = metrics.now()
+        frame = metrics.frame()
+        data = quantize_simvars(bridge.read_all())
+        metrics.observe("receive", received, frame)
+        metrics.count("frames_in")
+        if data != state.last_data:
+            state.last_data = data
+            state.pending_frame = frame
+            state.invalidate()
+        # at most one render per UPDATE_INTERVAL however often the sim reports
+        await asyncio.sleep(UPDATE_INTERVAL)
 
 async def main_loop():
-    setup_logging()
+    setup_logging(logging.INFO, LOG_FILE, fmt="%(asctime)s [%(levelname)s] %(message)s", max_bytes=0, file_mode="w")
     logging.info("Старт WinWing CDU! (flightplans, scroll, html, цвет, simconnect)")
     state = AppState()
-    state.bridge = GNS530Bridge()
+    if os.environ.get(BROKER_ENV):
+        logging.info(f"Симвары через брокер {os.environ[BROKER_ENV]}")
+        state.bridge = BrokerBridge(os.environ[BROKER_ENV])
+    elif os.environ.get(FAKE_SIM_ENV, "") not in ("", "0"):
+        from fake_simconnect import FakeSim, create_simconnect
+        logging.info("Симулятор заменён fake_simconnect")
+        state.bridge = GNS530Bridge(create_simconnect(SimConnectGNS530, FakeSim(FAKE_SIM_RATE)))
+    else:
+        state.bridge = GNS530Bridge()
     pages = [MainPage(state), FPLNPage(state)]
-    asyncio.create_task(joystick_listener(state, pages))
+    await metrics.start_from_env("gns530")
+    await start_control_from_env("gns530")
+    await asyncio.to_thread(state.fpl_files.plans.load)
+    await asyncio.to_thread(state.fpl_files.scan)
+    # the loop only keeps weak references to tasks
+    tasks = [
+        asyncio.create_task(state.fpl_files.watch()),
+        asyncio.create_task(joystick_listener(state, pages)),
+        asyncio.create_task(simvar_listener(state)),
+    ]
+    frame = DisplayFrame()
     async with websockets.connect(WS_URI) as ws:
         while True:
-            data = state.bridge.read_all()
+            # simvar changes, buttons, plan loads and the plan listing all set this
+            await state.changed.wait()
+            state.changed.clear()
             if state.error.is_active():
                 page = ErrorPage(state)
             else:
                 page = pages[state.page_idx]
-            disp = []
-            for text in page.render(data):
-                disp.extend(parse_colored_text(text))
-            message = {"Target": "Display", "Data": disp}
-            await ws.send(json.dumps(message))
-            await asyncio.sleep(UPDATE_INTERVAL)
+            encode_started = metrics.now()
+            trace_frame, state.pending_frame = state.pending_frame or metrics.frame(), 0
+            if not frame.update(*page.render(state.last_data)):
+                metrics.count("frames_skipped")
+                # the CDU already shows what the presses led to
+                state.answer_presses()
+                continue
+            mobi_json = frame.message()
+            metrics.observe("encode", encode_started, trace_frame)
+            send_started = metrics.now()
+            await ws.send(mobi_json)
+            metrics.observe("send", send_started, trace_frame)
+            metrics.count("frames_out")
+            state.answer_presses()
 
 if __name__ == "__main__":
     asyncio.run(main_loop())
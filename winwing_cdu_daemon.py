@@ -0,0 +1,325 @@
+import argparse
+import asyncio
+import json
+import logging
+import sys
+from abc import ABC, abstractmethod
+from typing import Dict, List, Optional, Tuple
+
+import aerosoft_crj_winwing_cdu as crj
+import fbw_a32nx_winwing_cdu as fbw
+import fenix_winwing_cdu as fenix
+import fslabs_winwing_cdu as fslabs
+import pmdg_737_winwing_cdu as pmdg737
+import pmdg_777_winwing_cdu as pmdg777
+from cdu_keys import ScratchpadEcho, echo_enabled
+from cdu_logging import setup_logging
+from cdu_metrics import metrics
+from cdu_profiler import start_control_from_env
+from fbw_a32nx_winwing_cdu import MobiFlightClient
+
+# URLs for WinWing CDU WebSockets, kept open for the whole daemon lifetime
+DISPLAY_URLS: Dict[str, str] = {
+    "captain": "ws://localhost:8320/winwing/cdu-captain",
+    "co-pilot": "ws://localhost:8320/winwing/cdu-co-pilot",
+    "observer": "ws://localhost:8320/winwing/cdu-observer",
+}
+
+CDU_CELLS: int = 24 * 14
+BLANK_DISPLAY: str = json.dumps({"Target": "Display", "Data": [[] for _ in range(CDU_CELLS)]})
+
+AIRCRAFT_LOADED_REQUEST_ID: int = 0x57570001
+DETECT_INTERVAL: float = 2.0
+SIMCONNECT_RETRY_INTERVAL: float = 5.0
+
+# Lower case fragments of the "AircraftLoaded" path, first match wins
+AIRCRAFT_PATTERNS: List[Tuple[str, Tuple[str, ...]]] = [
+    ("pmdg737", ("pmdg-aircraft-73", "pmdg 737")),
+    ("pmdg777", ("pmdg-aircraft-77", "pmdg 777")),
+    ("crj", ("aerosoft-crj", "aerosoft_crj", "crj")),
+    ("fenix", ("fnx", "fenix")),
+    ("fbw", ("flybywire", "a32nx")),
+    ("fslabs", ("fslabs", "fsl_a32")),
+]
+
+
+def detect_aircraft(aircraft_path: str) -> Optional[str]:
+    path = aircraft_path.lower().replace("\\", "/")
+    for aircraft, fragments in AIRCRAFT_PATTERNS:
+        if any(fragment in path for fragment in fragments):
+            return aircraft
+    return None
+
+
+class DaemonSimConnect(pmdg737.SimConnectMobiFlight):
+    """SimConnect session shared by all source adapters, also reporting the loaded aircraft."""
+
+    def __init__(self, auto_connect=True, library_path=None):
+        self.aircraft_loaded: Optional[str] = None
+        super().__init__(auto_connect, library_path)
+
+    def handle_state_event(self, pData):
+        if pData.dwRequestID == AIRCRAFT_LOADED_REQUEST_ID:
+            self.aircraft_loaded = pData.szString.decode(errors="replace")
+        else:
+            super().handle_state_event(pData)
+
+    def request_aircraft_loaded(self) -> None:
+        self.dll.RequestSystemState(self.hSimConnect, AIRCRAFT_LOADED_REQUEST_ID, b"AircraftLoaded")
+
+
+class SourceAdapter(ABC):
+    """Feeds one aircraft's CDU data into the shared MobiFlight displays."""
+
+    name: str = ""
+    needs_simconnect: bool = False
+
+    def __init__(self, displays: Dict[str, MobiFlightClient]) -> None:
+        self.displays = displays
+        self.tasks: List[asyncio.Task] = []
+
+    @abstractmethod
+    async def start(self, sc_mobiflight: Optional[DaemonSimConnect]) -> bool:
+        pass
+
+    async def stop(self) -> None:
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        for display in self.displays.values():
+            display.key_sink = None
+
+
+class ClientDataAdapter(SourceAdapter):
+    """PMDG and CRJ, which broadcast their CDUs as SimConnect client data."""
+
+    needs_simconnect = True
+
+    def __init__(self, displays, name, client_class, cdus) -> None:
+        super().__init__(displays)
+        self.name = name
+        self.client_class = client_class
+        self.cdus = cdus
+        self.clients = []
+        self.sc_mobiflight = None
+
+    async def start(self, sc_mobiflight):
+        if self.sc_mobiflight is not sc_mobiflight:
+            # new SimConnect session, the client data areas have to be mapped again
+            self.sc_mobiflight = sc_mobiflight
+            self.clients = []
+            for display, cdu_name, cdu_id, cdu_definition in self.cdus:
+                mobiflight = self.displays[display]
+                client = self.client_class(sc_mobiflight, mobiflight.websocket_uri, cdu_name, cdu_id, cdu_definition)
+                client.mobiflight = mobiflight
+                self.clients.append(client)
+        loop = asyncio.get_running_loop()
+        started = False
+        for client in self.clients:
+            client.event_loop = loop
+            # the shared display reports key presses to whichever source feeds it now
+            client.mobiflight.watchdog = client.watchdog
+            if client.setup_simconnect():
+                self.tasks.append(asyncio.create_task(client.watchdog.run()))
+                started = True
+        return started
+
+    async def stop(self):
+        for client in self.clients:
+            client.teardown_simconnect()
+        await super().stop()
+
+
+class PMDGAdapter(ClientDataAdapter):
+
+    def __init__(self, displays, name, module, cdus) -> None:
+        super().__init__(displays, name, module.PMDGCDUClient, cdus)
+        self.configuration = module.PMDGConfiguration()
+
+    async def start(self, sc_mobiflight):
+        # only takes effect on the next aircraft load, but keeps the SDK broadcast enabled
+        self.tasks.append(asyncio.create_task(asyncio.to_thread(self.configuration.verify_sdk_config)))
+        return await super().start(sc_mobiflight)
+
+
+class FbwAdapter(SourceAdapter):
+    name = "fbw"
+
+    def __init__(self, displays) -> None:
+        super().__init__(displays)
+        self.client: Optional[fbw.FbwMcduClient] = None
+
+    async def start(self, sc_mobiflight):
+        self.client = fbw.FbwMcduClient(self.displays["captain"], self.displays["co-pilot"])
+        self.tasks.append(asyncio.create_task(self.client.run()))
+        return True
+
+    async def stop(self):
+        await super().stop()
+        if self.client is not None and self.client.fbw_websocket is not None:
+            await self.client.fbw_websocket.close()
+        self.client = None
+
+
+class FenixDisplay:
+    """Adapts a shared display to the interface of fenix_winwing_cdu.Mobiflight_Client."""
+
+    def __init__(self, mobiflight: MobiFlightClient) -> None:
+        self.mobiflight = mobiflight
+        self.echo: Optional[ScratchpadEcho] = ScratchpadEcho(mobiflight.send, mobiflight.websocket_uri) \
+            if echo_enabled() else None
+        if self.echo is not None:
+            mobiflight.key_sink = self.echo.key
+
+    @property
+    def watchdog(self):
+        return self.mobiflight.watchdog
+
+    @watchdog.setter
+    def watchdog(self, watchdog) -> None:
+        self.mobiflight.watchdog = watchdog
+
+    async def send_json_data(self, mobi_json: str, frame: int = 0) -> None:
+        if self.echo is not None:
+            mobi_json = self.echo.reconcile(mobi_json)
+        await self.mobiflight.send(mobi_json, frame=frame)
+
+
+class FenixAdapter(SourceAdapter):
+    name = "fenix"
+
+    async def start(self, sc_mobiflight):
+        self.tasks.append(asyncio.create_task(fenix.run_fenix_graphql_client(
+            FenixDisplay(self.displays["captain"]), FenixDisplay(self.displays["co-pilot"]))))
+        return True
+
+
+class FslabsAdapter(SourceAdapter):
+    name = "fslabs"
+
+    async def start(self, sc_mobiflight):
+        # drop frames left over from an earlier session
+        while not fslabs.data_queue.empty():
+            fslabs.data_queue.get_nowait()
+        self.tasks.append(asyncio.create_task(fslabs.fetch_fsl_mcdu()))
+        self.tasks.append(asyncio.create_task(self.forward()))
+        return True
+
+    async def forward(self) -> None:
+        while True:
+            queued, frame, mobi_json = await fslabs.data_queue.get()
+            if mobi_json:
+                await self.displays["captain"].send(mobi_json, queued, frame)
+
+
+class CduDaemon:
+    def __init__(self, forced_aircraft: Optional[str] = None) -> None:
+        self.displays: Dict[str, MobiFlightClient] = {
+            name: MobiFlightClient(url, max_retries=sys.maxsize) for name, url in DISPLAY_URLS.items()
+        }
+        self.adapters: Dict[str, SourceAdapter] = {
+            "pmdg737": PMDGAdapter(self.displays, "pmdg737", pmdg737, [
+                ("captain", pmdg737.PMDG_CDU_0_NAME, pmdg737.PMDG_CDU_0_ID, pmdg737.PMDG_CDU_0_DEFINITION),
+                ("co-pilot", pmdg737.PMDG_CDU_1_NAME, pmdg737.PMDG_CDU_1_ID, pmdg737.PMDG_CDU_1_DEFINITION),
+            ]),
+            "pmdg777": PMDGAdapter(self.displays, "pmdg777", pmdg777, [
+                ("captain", pmdg777.PMDG_CDU_0_NAME, pmdg777.PMDG_CDU_0_ID, pmdg777.PMDG_CDU_0_DEFINITION),
+                ("co-pilot", pmdg777.PMDG_CDU_1_NAME, pmdg777.PMDG_CDU_1_ID, pmdg777.PMDG_CDU_1_DEFINITION),
+                ("observer", pmdg777.PMDG_CDU_2_NAME, pmdg777.PMDG_CDU_2_ID, pmdg777.PMDG_CDU_2_DEFINITION),
+            ]),
+            "crj": ClientDataAdapter(self.displays, "crj", crj.CRJCDUClient, [
+                ("captain", crj.CRJ_CDU_0_NAME, crj.CRJ_CDU_0_CLIENT_DATA_ID, crj.CRJ_CDU_0_DEFINITION),
+                ("co-pilot", crj.CRJ_CDU_1_NAME, crj.CRJ_CDU_1_CLIENT_DATA_ID, crj.CRJ_CDU_1_DEFINITION),
+            ]),
+            "fbw": FbwAdapter(self.displays),
+            "fenix": FenixAdapter(self.displays),
+            "fslabs": FslabsAdapter(self.displays),
+        }
+        self.forced_aircraft: Optional[str] = forced_aircraft
+        self.sc_mobiflight: Optional[DaemonSimConnect] = None
+        self.active: Optional[SourceAdapter] = None
+
+    async def connect_simconnect(self) -> Optional[DaemonSimConnect]:
+        if self.sc_mobiflight is not None and not self.sc_mobiflight.quit:
+            return self.sc_mobiflight
+        if self.sc_mobiflight is not None:
+            logging.info("SimConnect session ended")
+            await self.swap(None)
+            self.sc_mobiflight = None
+        try:
+            # connect() busy-waits for the open event, keep it off the event loop
+            self.sc_mobiflight = await asyncio.to_thread(DaemonSimConnect)
+            logging.info("SimConnect connected")
+        except Exception as e:
+            logging.debug(f"SimConnect not available: {e}")
+        return self.sc_mobiflight
+
+    async def swap(self, aircraft: Optional[str]) -> None:
+        adapter = self.adapters.get(aircraft) if aircraft else None
+        if adapter is self.active:
+            return
+        if adapter is not None and adapter.needs_simconnect and self.sc_mobiflight is None:
+            return
+        started = asyncio.get_running_loop().time()
+        if self.active is not None:
+            await self.active.stop()
+            for display in self.displays.values():
+                await display.send(BLANK_DISPLAY)
+        self.active = None
+        if adapter is not None:
+            if await adapter.start(self.sc_mobiflight):
+                self.active = adapter
+            else:
+                await adapter.stop()
+                logging.error("Failed to start source adapter for %s", aircraft)
+        elapsed_ms = (asyncio.get_running_loop().time() - started) * 1000
+        logging.info("Active aircraft: %s (swapped in %.1f ms)", self.active.name if self.active else "none", elapsed_ms)
+
+    async def detect(self) -> None:
+        aircraft_path = None
+        while True:
+            sc_mobiflight = await self.connect_simconnect()
+            if self.forced_aircraft is not None:
+                await self.swap(self.forced_aircraft)
+            elif sc_mobiflight is None:
+                await asyncio.sleep(SIMCONNECT_RETRY_INTERVAL)
+                continue
+            else:
+                sc_mobiflight.request_aircraft_loaded()
+                if sc_mobiflight.aircraft_loaded != aircraft_path:
+                    aircraft_path = sc_mobiflight.aircraft_loaded
+                    logging.info("Aircraft loaded: %s", aircraft_path)
+                    await self.swap(detect_aircraft(aircraft_path or ""))
+            await asyncio.sleep(DETECT_INTERVAL)
+
+    async def run(self) -> None:
+        await metrics.start_from_env("daemon")
+        await start_control_from_env("daemon")
+        display_tasks = [asyncio.create_task(display.run()) for display in self.displays.values()]
+        try:
+            await asyncio.gather(self.detect(), *display_tasks)
+        finally:
+            await self.swap(None)
+            for display in self.displays.values():
+                await display.close()
+            if self.sc_mobiflight is not None:
+                self.sc_mobiflight.exit()
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Single WinWing CDU bridge for all supported aircraft")
+    parser.add_argument("--aircraft", choices=[aircraft for aircraft, _ in AIRCRAFT_PATTERNS],
+                        help="skip detection and always use this aircraft")
+    parser.add_argument("--log-level", default="INFO")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    setup_logging(args.log_level)
+    logging.info("----STARTED WinWing CDU daemon----")
+    try:
+        asyncio.run(CduDaemon(args.aircraft).run())
+    except KeyboardInterrupt:
+        logging.info("Process terminated by user")